@@ -1,17 +1,17 @@
 #!/usr/bin/python
-import argparse, sys, os, gzip, zlib, base64, pickle
-from shutil import rmtree
+import argparse, sys, os, gzip
+from shutil import rmtree, copyfileobj
 from multiprocessing import cpu_count
 from tempfile import mkdtemp, gettempdir
 from Bio.Structure import Transcriptome, Transcript
-from Bio.Format.Fasta import FastaData
+from Bio.Format.Fasta import read_reference
 from Bio.Format.GPD import GPD
+from Bio.Simulation.Emitter import write_emitter
 
 def main(args):
   sys.stderr.write("Reading reference fasta\n")
-  ref_genome = FastaData(open(args.reference_fasta,'rb').read())
+  ref_genome = read_reference(args.reference_fasta)
   sys.stderr.write("Reading in transcriptome\n")
-  output = {}
   txome = Transcriptome()
   z = 0
   with open(args.reference_gpd) as inf:
@@ -22,8 +22,6 @@ def main(args):
       gpd.set_sequence(ref_genome)
       txome.add_transcript(gpd)
   sys.stderr.write("\n")
-  sys.stderr.write("Serializing transcriptome\n")
-  output['txome'] = txome.dump_serialized()
   txweights = {}
   weight_type = 'uniform_distribution' #default
   if args.expression_table:
@@ -36,13 +34,16 @@ def main(args):
       f = line.rstrip().split("\t")
       txweights[f[0]] = float(f[1])
   elif args.exponential_distribution: weight_type = 'exponential_distribution'
-  output['weight_type'] = weight_type
-  output['weights'] = txweights #only matters for expression based
-  of = sys.stdout
-  if args.output: of = open(args.output,'w')
-  of.write(base64.b64encode(zlib.compress(pickle.dumps(output)))+"\n")
-  of.close()
-
+  sys.stderr.write("Writing emitter\n")
+  if args.output:
+    write_emitter(args.output,txome,weight_type,txweights)
+  else:
+    # binary file is written with seeks so put it together first
+    fname = args.tempdir+'/emitter'
+    write_emitter(fname,txome,weight_type,txweights)
+    with open(fname,'rb') as inf:
+      copyfileobj(inf,sys.stdout)
+    os.remove(fname)
 
   # Temporary working directory step 3 of 3 - Cleanup
   if not args.specific_tempdir:
@@ -52,7 +53,7 @@ def do_inputs():
   # Setup command line inputs
   parser=argparse.ArgumentParser(description="Establish the transcriptome to emit.  The type of read generated, and perterberations are defined when you emit.",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('reference_gpd',help="INPUT GenePred File")
-  parser.add_argument('reference_fasta',help="Reference fasta")
+  parser.add_argument('reference_fasta',help="Reference fasta or packed reference from fasta_to_packed_reference.py")
   
   group = parser.add_mutually_exclusive_group()
   group.add_argument('--uniform_distribution',default=True,action='store_true',help="Equal probability of any transcript")
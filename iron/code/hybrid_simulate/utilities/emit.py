@@ -1,10 +1,10 @@
 #!/usr/bin/python
 import argparse, sys, os, pickle, zlib, base64, json, math, gzip, re
-from shutil import rmtree
-from multiprocessing import cpu_count
+from shutil import rmtree, copyfileobj
+from multiprocessing import cpu_count, Pool
 from tempfile import mkdtemp, gettempdir
 from subprocess import PIPE, Popen
-from Bio.Simulation.Emitter import TranscriptomeEmitter
+from Bio.Simulation.Emitter import TranscriptomeEmitter, MappedEmitter, is_binary_emitter
 from Bio.Structure import Transcriptome
 from Bio.Simulation.RandomSource import RandomSource
 from Bio.Simulation.Permute import MakeCuts, random_flip, MakeErrors, rate_to_phred33, phred33_to_rate
@@ -21,13 +21,9 @@ def main(args):
     sys.exit()
   if args.sr_length < args.minimum_read_length:
     args.minimum_read_length = args.sr_length
-  inf = sys.stdin
-  if args.emitter != '-':
-    inf = open(args.emitter)
   sys.stderr.write("reading in transcriptome emitter\n")
-  indata = pickle.loads(zlib.decompress(base64.b64decode(inf.read().rstrip())))
-  txome = Transcriptome()
-  txome.load_serialized(indata['txome'])
+  indata = read_emitter(args.emitter)
+  txome = indata['txome']
   rnum = RandomSource()
   rnum_tx = RandomSource() # for drawing transcripts
   if args.seed: 
@@ -38,21 +34,13 @@ def main(args):
   if args.error_profile:
     sys.stderr.write("read in error profile\n")
     ep = ErrorProfilePermuter(args.error_profile,rnum,args.skew_profile_error_rate)
-  txemitter = TranscriptomeEmitter(txome,rand=rnum_tx)
   if indata['weight_type'] == 'expression_table':
     sys.stderr.write("Using expression table defined transcript expression\n")
-    txweight = indata['weights']
-    txemitter.set_weights_by_dict(txweight)
   elif indata['weight_type'] == 'exponential_distribution':
     sys.stderr.write("ERROR not yet implemented exponential distribution\n")
     sys.exit()
   elif indata['weight_type'] == 'uniform_distribution':
     sys.stderr.write("Using uniform distribution of transcript expression\n")
-  cutter = MakeCuts(rand=rnum_tx)
-  if args.sr:
-    cutter.set_custom(args.sr_gauss_min,args.sr_gauss_mu,args.sr_gauss_sigma)
-  elif args.lr:
-    cutter.set_custom(args.lr_gauss_min,args.lr_gauss_mu,args.lr_gauss_sigma)
   # Prepare outputs
   of1 = sys.stdout
   if args.output[0][-3:] == '.gz':
@@ -78,10 +66,123 @@ def main(args):
     else:
       of_sc = open(args.output_sequence_change,'w')
   
-  absmax = args.count*100
+  if args.threads > 1:
+    emit_sharded(txome,indata,ep,args,of1,of2,of_origin,of_sc)
+  else:
+    [txemitter,cutter] = get_emitters(txome,indata,rnum_tx,args)
+    emit_reads(args.count,rnum,rnum_tx,txemitter,cutter,ep,args,of1,of2,of_origin,of_sc)
+  sys.stderr.write("\n")
+  of1.close()
+  if of2:
+    of2.close()
+  if of_origin:
+    of_origin.close()
+  if of_sc:
+    of_sc.close()
+  # Temporary working directory step 3 of 3 - Cleanup
+  if not args.specific_tempdir:
+    rmtree(args.tempdir)
+
+# Pre: emitter file name or - for STDIN
+# Post: dict with the 'txome' Transcriptome, the 'weight_type' and
+#       either a 'weight_list' in transcript order (binary emitter) or
+#       'weights' by transcript name (older base64 pickled emitter)
+#       A binary emitter file is memory mapped and its transcripts
+#       are only built when they are drawn
+def read_emitter(fname):
+  if fname == '-':
+    data = sys.stdin.read()
+  else:
+    with open(fname,'rb') as inf:
+      data = inf.read(4)
+  if is_binary_emitter(data):
+    if fname == '-': me = MappedEmitter(data=data)
+    else: me = MappedEmitter(fname)
+    indata = {'txome':me.get_transcriptome(),'weight_type':me.get_weight_type()}
+    if indata['weight_type'] == 'expression_table':
+      indata['weight_list'] = me.get_weights()
+    return indata
+  if fname != '-':
+    with open(fname) as inf:
+      data = inf.read()
+  indata = pickle.loads(zlib.decompress(base64.b64decode(data.rstrip())))
+  txome = Transcriptome()
+  txome.load_serialized(indata['txome'])
+  indata['txome'] = txome
+  return indata
+
+# Pre: transcriptome, emitter data, random source for transcripts
+# Post: [transcript emitter, cutter] drawing from that source
+def get_emitters(txome,indata,rnum_tx,args):
+  txemitter = TranscriptomeEmitter(txome,rand=rnum_tx)
+  if indata['weight_type'] == 'expression_table':
+    if 'weight_list' in indata: txemitter.set_weights(indata['weight_list'])
+    else: txemitter.set_weights_by_dict(indata['weights'])
+  cutter = MakeCuts(rand=rnum_tx)
+  if args.sr:
+    cutter.set_custom(args.sr_gauss_min,args.sr_gauss_mu,args.sr_gauss_sigma)
+  elif args.lr:
+    cutter.set_custom(args.lr_gauss_min,args.lr_gauss_mu,args.lr_gauss_sigma)
+  return [txemitter,cutter]
+
+# Loaded data the shard processes inherit when they are forked
+_shared = {}
+
+# Split the count into one shard per thread.  Each shard gets a seed
+# drawn from the --seed (or an unseeded) RandomSource so the same seed
+# and thread count give the same reads.  Shards write to temporary
+# files which are copied to the outputs in shard order.
+def emit_sharded(txome,indata,ep,args,of1,of2,of_origin,of_sc):
+  global _shared
+  _shared = {'txome':txome,'indata':indata,'ep':ep,'args':args}
+  rseed = RandomSource()
+  if args.seed: rseed = RandomSource(args.seed)
+  shards = []
+  for i in range(0,args.threads):
+    count = args.count/args.threads
+    if i < args.count % args.threads: count += 1
+    shards.append([i,count,rseed.randint(1,2147483647)])
+  p = Pool(processes=args.threads)
+  finished_count = 0
+  for [count,fnames] in p.imap(do_shard,shards):
+    for [fname,of] in zip(fnames,[of1,of2,of_origin,of_sc]):
+      if not fname: continue
+      with open(fname) as inf:
+        copyfileobj(inf,of)
+      os.remove(fname)
+    finished_count += count
+    sys.stderr.write(str(finished_count)+'/'+str(args.count)+"   \r")
+  p.close()
+  p.join()
+
+# Pre: [shard number, read count, seed]
+# Post: [read count, [fastq 1, fastq 2, original source, sequence change]]
+#       temporary file names, None for outputs that are not used
+def do_shard(shard):
+  [i,count,seed] = shard
+  args = _shared['args']
+  rnum = RandomSource(seed)
+  rnum_tx = RandomSource(seed)
+  ep = _shared['ep']
+  if ep: ep.set_random(rnum)
+  [txemitter,cutter] = get_emitters(_shared['txome'],_shared['indata'],rnum_tx,args)
+  base = args.tempdir+'/shard.'+str(i)+'.'
+  fnames = [base+'1.fq',None,None,None]
+  if len(args.output) > 1: fnames[1] = base+'2.fq'
+  if args.output_original_source: fnames[2] = base+'origin.txt'
+  if args.output_sequence_change: fnames[3] = base+'change.txt'
+  ofs = [open(x,'w') if x else None for x in fnames]
+  emit_reads(count,rnum,rnum_tx,txemitter,cutter,ep,args,ofs[0],ofs[1],ofs[2],ofs[3],progress=False)
+  for of in ofs:
+    if of: of.close()
+  return [count,fnames]
+
+# Emit count reads to the outputs, drawing from the random sources given
+def emit_reads(count,rnum,rnum_tx,txemitter,cutter,ep,args,of1,of2,of_origin,of_sc,progress=True):
+  absmax = count*100
   finished_count = 0
   z = 0
-  while finished_count < args.count:
+  while finished_count < count:
     z += 1
     if z > absmax: break
     tx = txemitter.emit_transcript()
@@ -214,106 +315,73 @@ def main(args):
                 + stage1seq+"\t"+stage2seq+"\t"+stage3left+"\t"+stage3right+"\t"+stage4left+"\t"+stage4right+"\n")
     if r_fastq: stage4right = r_fastq.seq
     finished_count += 1
-    if finished_count %1000==0: sys.stderr.write(str(finished_count)+'/'+str(args.count)+"   \r")
-  sys.stderr.write("\n")
-  of1.close()
-  if of2:
-    of2.close()
-  if of_origin:
-    of_origin.close()
-  if of_sc:
-    of_sc.close()
-  # Temporary working directory step 3 of 3 - Cleanup
-  if not args.specific_tempdir:
-    rmtree(args.tempdir)
+    if progress and finished_count %1000==0: sys.stderr.write(str(finished_count)+'/'+str(count)+"   \r")
 
 def do_quality_mismatch(fastq,rnum):
   sequence = fastq.seq
   quality = fastq.qual
   #five possible errors 3 base changes a deletion or insertion
-  seq = ''
-  qual = ''
+  seq = list(sequence)
+  rand = rnum.random
+  rates = _quality_rates(quality)
   for i in range(0,len(sequence)):
-    rate = phred33_to_rate(quality[i])
-    if rnum.random() > rate:
-      seq += sequence[i]
-      qual += quality[i]
-      continue
-    seq += rnum.different_random_nt(sequence[i])
-    qual += quality[i]
+    if rand() > rates[i]: continue
+    seq[i] = rnum.different_random_nt(sequence[i])
     #for del type we do nothing ... cause its not getting added
-  return Fastq([fastq.name,seq,'+',qual])
+  return Fastq([fastq.name,''.join(seq),'+',quality])
 
 def do_quality_any(fastq,rnum):
-  sequence = fastq.seq
-  quality = fastq.qual
-  #five possible errors 3 base changes a deletion or insertion
-  seq = ''
-  qual = ''
-  for i in range(0,len(sequence)):
-    rate = phred33_to_rate(quality[i])
-    if rnum.random() > rate:
-      seq += sequence[i]
-      qual += quality[i]
-      continue
-    type = rnum.choice(['ins','del','mis','mis','mis'])
-    if type == 'mis':
-      seq += rnum.different_random_nt(sequence[i])
-      qual += quality[i]
-    elif type == 'ins':
-      if rnum.random() < 0.5:
-        seq += sequence[i]+rnum.random_nt()
-        qual += quality[i]+quality[i]
-      else:
-        seq += rnum.random_nt()+sequence[i]
-        qual += quality[i]+quality[i]
-    #for del type we do nothing ... cause its not getting added
-  return Fastq([fastq.name,seq,'+',qual])
+  return _do_any(fastq,rnum,_quality_rates(fastq.qual))
 
 def do_uniform_any(fastq,rnum,rate):
   #ibase = rate_to_phred33(rate)
   #six error possibilies
-  sequence = fastq.seq
-  quality = fastq.qual
-  #five possible errors 3 base changes a deletion or insertion
-  seq = ''
-  qual = ''
-  for i in range(0,len(sequence)):
-    if rnum.random() > rate:
-      seq += sequence[i]
-      qual += quality[i]
-      continue
-    type = rnum.choice(['ins','del','mis','mis','mis'])
-    if type == 'mis':
-      seq += rnum.different_random_nt(sequence[i])
-      qual += quality[i]
-    elif type == 'ins':
-      if rnum.random() < 0.5:
-        seq += sequence[i]+rnum.random_nt()
-        qual += quality[i]+quality[i]
-      else:
-        seq += rnum.random_nt()+sequence[i]
-        qual += quality[i]+quality[i]
-    #for del type we do nothing ... cause its not getting added
-  return Fastq([fastq.name,seq,'+',qual])
+  return _do_any(fastq,rnum,[rate]*len(fastq.seq))
 
 def do_uniform_mismatch(fastq,rnum,rate):
   #ibase = rate_to_phred33(rate)
   #six error possibilies
+  sequence = fastq.seq
+  #five possible errors 3 base changes a deletion or insertion
+  seq = list(sequence)
+  rand = rnum.random
+  for i in range(0,len(sequence)):
+    if rand() > rate: continue
+    seq[i] = rnum.different_random_nt(sequence[i])
+  return Fastq([fastq.name,''.join(seq),'+',fastq.qual])
+
+# error rate at each base from its phred33 quality
+def _quality_rates(quality):
+  rates = {}
+  for q in set(quality): rates[q] = phred33_to_rate(q)
+  return [rates[q] for q in quality]
+
+# Pre: fastq, random source, and the error rate at each base
+# Post: fastq with mismatches, insertions and deletions (3:1:1)
+def _do_any(fastq,rnum,rates):
   sequence = fastq.seq
   quality = fastq.qual
   #five possible errors 3 base changes a deletion or insertion
-  seq = ''
-  qual = ''
+  seq = []
+  qual = []
+  rand = rnum.random
   for i in range(0,len(sequence)):
-    if rnum.random() > rate:
-      seq += sequence[i]
-      qual += quality[i]
+    if rand() > rates[i]:
+      seq.append(sequence[i])
+      qual.append(quality[i])
       continue
-    seq += rnum.different_random_nt(sequence[i])
-    qual += quality[i]
+    type = rnum.choice(['ins','del','mis','mis','mis'])
+    if type == 'mis':
+      seq.append(rnum.different_random_nt(sequence[i]))
+      qual.append(quality[i])
+    elif type == 'ins':
+      if rand() < 0.5:
+        seq.append(sequence[i]+rnum.random_nt())
+      else:
+        seq.append(rnum.random_nt()+sequence[i])
+      qual.append(quality[i]+quality[i])
     #for del type we do nothing ... cause its not getting added
-  return Fastq([fastq.name,seq,'+',qual])
+  return Fastq([fastq.name,''.join(seq),'+',''.join(qual)])
 
 def fit_length(fastq,target_length,rnum):
   sequence = fastq.seq
@@ -440,97 +508,115 @@ class ErrorProfilePermuter:
       for m in self.gins:
         if m != '-': self.gins[m] = self.gins[m]*factor
       self.gins['-'] = 1 - min(sum([self.gins[x] for x in self.gmd[r] if x!='-']),1)
+    self._build_samplers()
+
+  # Sort the choices of each distribution once and keep a sampler for
+  # it, so a draw is a binary search instead of rebuilding the weights
+  def _build_samplers(self):
+    self._gmd_draw = {}
+    for r in self.gmd:
+      self._gmd_draw[r] = self._sampler(self.gmd[r])
+    self._gins_draw = self._sampler(self.gins)
+    self._md_draw = {}
+    for b in self.md:
+      for a in self.md[b]:
+        for r in self.md[b][a]:
+          self._md_draw[(b,a,r)] = self._sampler(self.md[b][a][r])
+    self._ins_draw = {}
+    for b in self.ins:
+      for a in self.ins[b]:
+        self._ins_draw[(b,a)] = self._sampler(self.ins[b][a])
+
+  # Draw from a different random source, such as one per shard
+  def set_random(self,rnum):
+    self.random = rnum
+    self._build_samplers()
+
+  def _sampler(self,dist):
+    mods = sorted(dist.keys())
+    return [mods,self.random.get_weighted_sampler([dist[x] for x in mods])]
+
   def draw_general_error(self,reference):
-    md = self.gmd[reference]
-    mods = sorted(md.keys())
-    vals = [md[x] for x in mods]
-    ind = self.random.get_weighted_random_index(vals)
-    return mods[ind]
+    [mods,sampler] = self._gmd_draw[reference]
+    return mods[sampler.draw()]
 
   def draw_general_insert(self):
-    mods = sorted(self.gins.keys())
-    vals = [self.gins[x] for x in mods]
-    #print mods
-    #print vals
-    ind = self.random.get_weighted_random_index(vals)
-    #print ind
+    [mods,sampler] = self._gins_draw
+    ind = sampler.draw()
     if mods[ind] == '-': return None
     return mods[ind]
 
   # based on error probability 
   def draw_context_error(self,before,after,reference):
-    md = self.md[before][after][reference]
-    #print md
-    mods = sorted(md.keys())
-    vals = [md[x] for x in mods]
-    #print vals
-    ind = self.random.get_weighted_random_index(vals)
-    return mods[ind]
+    [mods,sampler] = self._md_draw[(before,after,reference)]
+    return mods[sampler.draw()]
   def draw_context_insert(self,before,after):
-    ins = self.ins[before][after]
-    mods = sorted(ins.keys())
-    vals = [ins[x] for x in mods]
-    ind = self.random.get_weighted_random_index(vals)
+    [mods,sampler] = self._ins_draw[(before,after)]
+    ind = sampler.draw()
     if mods[ind] == '-': return None
     return mods[ind]
 
   # modify a sequence by general error rates
   def permute_general(self,fastq):
-    seq = ''
-    qual = ''
+    seq = []
+    qual = []
+    rand = self.random.random
     for i in range(0,len(fastq.seq)):
       # see about inserts
       bseq = ''
       bqual = ''
-      if self.random.random() < 0.5:
+      if rand() < 0.5:
         err = self.draw_general_insert()
         if err:
           bseq = err
           bqual = fastq.qual[i]
       aseq = ''
       aqual = ''
-      if self.random.random() < 0.5:
+      if rand() < 0.5:
         err = self.draw_general_insert()
         if err:
           aseq = err
           aqual = fastq.qual[i]
       err = self.draw_general_error(fastq.seq[i])
       if err != '-':
-        seq += bseq+err+aseq
-        qual += bqual+fastq.qual[i]+aqual
+        seq.append(bseq+err+aseq)
+        qual.append(bqual+fastq.qual[i]+aqual)
       else:
-        seq += bseq+aseq
-        qual += bqual+aqual
-    return Fastq([fastq.name,seq,'+',qual])
+        seq.append(bseq+aseq)
+        qual.append(bqual+aqual)
+    return Fastq([fastq.name,''.join(seq),'+',''.join(qual)])
 
   # modify sequence by context
   def permute_context(self,fastq):
     if len(fastq.seq) < 2: return fastq
-    seq = fastq.seq[0]
-    qual = fastq.qual[0]
+    seq = [fastq.seq[0]]
+    qual = [fastq.qual[0]]
+    rand = self.random.random
     for i in range(1,len(fastq.seq)-1):
       insbefore = ''
       qualbefore = ''
-      if self.random.random() < 0.5:
+      if rand() < 0.5:
         insdrawn = self.draw_context_insert(fastq.seq[i-1],fastq.seq[i])
         if insdrawn: 
           insbefore = insdrawn
           qualbefore = fastq.qual[i]
       insafter = ''
       qualafter = ''
-      if self.random.random() < 0.5:
+      if rand() < 0.5:
         insdrawn = self.draw_context_insert(fastq.seq[i],fastq.seq[i+1])
         if insdrawn: 
           insafter = insdrawn
           qualafter = fastq.qual[i]
       err = self.draw_context_error(fastq.seq[i-1],fastq.seq[i],fastq.seq[i+1])
       if err != '-':
-          seq += insbefore+err+insafter
-          qual += qualbefore+fastq.qual[i]+qualafter
+        seq.append(insbefore+err+insafter)
+        qual.append(qualbefore+fastq.qual[i]+qualafter)
       else:
-        seq += insbefore+insafter
-        qual += qualbefore+qualafter
-    return Fastq([fastq.name,seq+fastq.seq[-1],'+',qual+fastq.qual[-1]])
+        seq.append(insbefore+insafter)
+        qual.append(qualbefore+qualafter)
+    seq.append(fastq.seq[-1])
+    qual.append(fastq.qual[-1])
+    return Fastq([fastq.name,''.join(seq),'+',''.join(qual)])
 
   def emit_qual(self,slen):
     full_len = ''
@@ -550,7 +636,7 @@ def do_inputs():
 
   parser.add_argument('--minimum_read_length',type=int,default=200,help="Minimum read length (is over-ridden by sr_length if it is smaller)")
   parser.add_argument('--seed',type=int,help="Set a seed. If seed has been set in an emitter, then you set it here, this one replace the old one.")
-  #parser.add_argument('--threads',type=int,default=cpu_count(),help="INT number of threads to run. Default is system cpu count")
+  parser.add_argument('--threads',type=int,default=1,help="INT number of processes to split the reads across. Output is reproducible for the same seed and thread count")
 
   group5 = parser.add_argument_group(title="Output options")
   group5.add_argument('--output_original_source',help="Attribute each read to its original transcript and gene\n<read> <gene> <transcript>")
@@ -1,10 +1,10 @@
 #!/usr/bin/python
 import argparse, sys, os, random, json, zlib, base64, gzip
 from shutil import rmtree
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count, Pool
 from tempfile import mkdtemp, gettempdir
 from Bio.Format.Sam import BAMFile
-from Bio.Format.Fasta import FastaData
+from Bio.Format.Fasta import read_reference
 from collections import Counter
 from Bio.Errors import ErrorProfileFactory
 
@@ -15,36 +15,44 @@ from Bio.Errors import ErrorProfileFactory
 
 def main(args):
   sys.stderr.write("Read reference fasta\n")
-  fasta = FastaData(open(args.reference_fasta).read())
-  sys.stderr.write("Read alignment file\n")
-  bf = BAMFile(args.bam_input,reference=fasta)
-  bf.read_index()
-  total_qualities = []
-  for j in range(0,100):
-    total_qualities.append([])
+  fasta = read_reference(args.reference_fasta)
+  sys.stderr.write("Sample alignments from alignment file\n")
+  sample = sample_alignment_coords(args.bam_input,args.max_alignments)
+  sys.stderr.write(str(len(sample))+" alignments sampled\n")
+  # chunks are in random order for early stopping but each is read in
+  # file order so the workers only seek forward
+  chunks = [sorted(sample[i:i+args.chunk_size]) for i in range(0,len(sample),args.chunk_size)]
+  global _shared
+  _shared = {'reference':fasta,'bam':args.bam_input}
+  if args.threads > 1:
+    p = Pool(processes=args.threads)
+    results = p.imap(do_chunk,chunks)
+  else:
+    results = (do_chunk(x) for x in chunks)
   ef = ErrorProfileFactory()
+  quality_tally = [{} for j in range(0,100)]
   mincontext = 0
-  alignments = 0
-  for i in range(0,args.max_alignments):
-    rname = random.choice(bf.index.get_names())
-    coord = bf.index.get_longest_target_alignment_coords_by_name(rname)
-    if not coord: continue
-    bam = bf.fetch_by_coord(coord)
-    qual = bam.value('qual')
-    do_qualities(total_qualities,qual)
-    if not bam.is_aligned(): continue
-    alignments += 1
-    ef.add_alignment(bam)
-    if i%100 == 0:
-      mincontext = ef.get_min_context_count('target')
-      if mincontext:
-        if mincontext >= args.min_context and alignments >= args.min_alignments: break
-    sys.stderr.write(str(i+1)+" lines   "+str(alignments)+"/"+str(args.min_alignments)+" alignments   "+str(mincontext)+"/"+str(args.min_context)+" mincontext        \r")
+  tried = 0
+  for [chunk_profile,chunk_quality,chunk_tried] in results:
+    tried += chunk_tried
+    ef.merge(ErrorProfileFactory(serialized=chunk_profile))
+    alignments = ef.get_alignment_count()
+    for j in range(0,100):
+      for k in chunk_quality[j]:
+        if k not in quality_tally[j]: quality_tally[j][k] = 0
+        quality_tally[j][k] += chunk_quality[j][k]
+    mincontext = ef.get_min_context_count('target')
+    sys.stderr.write(str(tried)+" lines   "+str(alignments)+"/"+str(args.min_alignments)+" alignments   "+str(mincontext)+"/"+str(args.min_context)+" mincontext        \r")
+    if mincontext >= args.min_context and alignments >= args.min_alignments: break
+  if args.threads > 1:
+    p.terminate()
+    p.join()
   sys.stderr.write("\n")
   sys.stderr.write(str(mincontext)+" minimum contexts observed\n")
   target_context = ef.get_target_context_error_report()
-  general_error_stats = ef.get_alignment_errors().get_stats()
-  general_error_report = ef.get_alignment_errors().get_report()
+  general = ef.get_alignment_errors()
+  general_error_stats = general.get_stats()
+  general_error_report = general.get_report()
   # convert report to table
   general_all = [x.split("\t") for x in general_error_report.rstrip().split("\n")]
   general_head = general_all[0]
@@ -52,16 +60,10 @@ def main(args):
   general_data = [[y[0],y[1],int(y[2]),int(y[3])] for y in general_all[1:]]
   general_error_report = {'head':general_head,'data':general_data}
   quality_counts = []
-  for vals in total_qualities:
+  for grp in quality_tally:
     garr = []
-    grp = {}
-    for v in vals:
-      if v[0] not in grp: grp[v[0]] = {}# check ordinal
-      if v[1] not in grp[v[0]]: grp[v[0]][v[1]] = 0 # run length
-      grp[v[0]][v[1]]+=1
-    for ordval in sorted(grp.keys()):
-      for runlen in sorted(grp[ordval].keys()):
-        garr.append([ordval,runlen,grp[ordval][runlen]])
+    for [ordval,runlen] in sorted(grp.keys()):
+      garr.append([ordval,runlen,grp[(ordval,runlen)]])
     quality_counts.append(garr)
   #Quailty counts now has 100 bins, each has an ordered array of
   # [ordinal_quality, run_length, observation_count]
@@ -82,7 +84,48 @@ def main(args):
   if not args.specific_tempdir:
     rmtree(args.tempdir)
 
-def do_qualities(total_qualities,qual):
+# Pre: bam file, number of alignments to keep
+# Post: [blockStart,innerStart] coordinates of up to count primary
+#       entries chosen uniformly with a reservoir sample in one
+#       sequential pass that only decodes the fixed fields
+#       Unmapped reads are primary too and are kept, their qualities
+#       are counted though they add no alignment errors
+def sample_alignment_coords(path,count):
+  bf = BAMFile(path,lazy=True)
+  sample = []
+  n = 0
+  for e in bf:
+    if e.value('flag') & 2304: continue # secondary or supplementary
+    n += 1
+    if len(sample) < count:
+      sample.append(e.get_coord())
+      continue
+    i = random.randint(0,n-1)
+    if i < count: sample[i] = e.get_coord()
+  bf.close()
+  random.shuffle(sample)
+  return sample
+
+# Loaded data the chunk workers inherit when they are forked
+_shared = {}
+
+# Pre: coordinates of alignments in file order
+# Post: [serialized ErrorProfileFactory, quality tally, tried]
+#       for the alignments of this chunk, ready to be merged
+def do_chunk(coords):
+  bf = BAMFile(_shared['bam'],reference=_shared['reference'])
+  ef = ErrorProfileFactory()
+  quality_tally = [{} for j in range(0,100)]
+  for coord in coords:
+    bf.seek(coord)
+    bam = bf.read_entry()
+    do_qualities(quality_tally,bam.value('qual'))
+    if not bam.is_aligned(): continue
+    ef.add_alignment(bam)
+  bf.close()
+  return [ef.get_serialized(),quality_tally,len(coords)]
+
+def do_qualities(quality_tally,qual):
     qualities = []
     for j in range(0,100):
       qualities.append([])
@@ -96,22 +139,26 @@ def do_qualities(total_qualities,qual):
     ind = 0
     for vals in hp:
       frac = 100*float(ind)/float(len(qual))
-      qualities[int(frac)].append([ord(vals[0]),len(vals)])
+      qualities[int(frac)].append((ord(vals[0]),len(vals)))
       ind += len(vals)
     prev = []
     for j in range(0,100):
       if len(qualities[j]) > 0: prev = qualities[j]
       else: qualities[j] = prev[:]
+    # count each [ordinal quality, run length] seen in each bin
     for j in range(0,100):
-      total_qualities[j]+=qualities[j]
+      for k in qualities[j]:
+        if k not in quality_tally[j]: quality_tally[j][k] = 0
+        quality_tally[j][k] += 1
 
 def do_inputs():
   parser=argparse.ArgumentParser(description="",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument('bam_input',help="INPUT FILE")
-  parser.add_argument('reference_fasta',help="Reference Fasta")
+  parser.add_argument('reference_fasta',help="Reference Fasta or packed reference from fasta_to_packed_reference.py")
   parser.add_argument('-o','--output',required=True,help="OUTPUTFILE can be gzipped")
   parser.add_argument('--threads',type=int,default=cpu_count(),help="INT number of threads to run. Default is system cpu count")
   parser.add_argument('--max_alignments',type=int,default=1000000,help="The absolute maximum number of alignments to try")
+  parser.add_argument('--chunk_size',type=int,default=500,help="Alignments given to a worker at a time")
   parser.add_argument('--min_alignments',type=int,default=1000,help="Visit at least this many alignments")
   parser.add_argument('--min_context',type=int,default=10000,help="Stop after seeing this many of each context")
   
@@ -153,4 +200,4 @@ def external_cmd(cmd,version=None):
 if __name__=="__main__":
   #do our inputs
   args = do_inputs()
-  main()
+  main(args)
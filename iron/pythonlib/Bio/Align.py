@@ -4,6 +4,8 @@ from Bio.Range import GenomicRange
 from Bio.Structure import Transcript, Exon, Junction
 
 from string import maketrans
+from itertools import imap, izip
+from operator import ne
 # Basic class for common elements of alignments
 # You don't have to have a query sequence and a reference sequence to do an alignment
 # But 
@@ -77,9 +79,15 @@ class Alignment:
   def get_alignment_ranges(self):
     return self._alignment_ranges
 
-  # Process the alignment to get information like
-  # the alignment strings for each exon
-  def get_alignment_strings(self,min_intron_size=68):
+  # Walk the alignment blocks once in target order
+  # Post: generator of [exon, op, target start, query start,
+  #                     target bases, query bases, query quality]
+  #       op is 'M' for an aligned block, 'D' for target bases between
+  #       blocks that have no query and 'I' for query bases between
+  #       blocks that have no target.  Starts are 1-based, bases are
+  #       upper case and the query is on the target's strand.
+  #       A target gap of min_intron_size or more starts the next exon.
+  def walk_alignment(self,min_intron_size=68):
     qseq = self.get_query_sequence()
     if not qseq:
       sys.exit("ERROR: Query sequence must be accessable to get alignment strings\n")
@@ -91,58 +99,87 @@ class Alignment:
     if self.get_strand() == '-': 
       qseq = rc(qseq)
       qual = qual[::-1]
-    tarr = []
-    qarr = []
-    yarr = []
-    tdone = ''
-    qdone = ''
-    ydone = '' #query quality
-    for i in range(len(self.get_alignment_ranges())):
-      [t,q] = self.get_alignment_ranges()[i]
-      textra = ''
-      qextra = ''
-      yextra = ''
+    ar = self.get_alignment_ranges()
+    exon = 0
+    for i in range(len(ar)):
+      [t,q] = ar[i]
       if i >= 1:
-        dift = t.start-self.get_alignment_ranges()[i-1][0].end-1
-        difq = q.start-self.get_alignment_ranges()[i-1][1].end-1
+        dift = t.start-ar[i-1][0].end-1
+        difq = q.start-ar[i-1][1].end-1
         if dift < min_intron_size:
           if dift > 0:
-            textra = ref[t.chr][t.start-dift-1:t.start-1].upper()
-            qextra = '-'*dift
-            yextra = '\0'*dift
+            yield [exon,'D',t.start-dift,ar[i-1][1].end+1,ref[t.chr][t.start-dift-1:t.start-1].upper(),'','']
           elif difq > 0:
-            textra = '-'*difq
-            qextra = qseq[q.start-difq-1:q.start-1].upper()
-            yextra = qual[q.start-difq-1:q.start-1]
+            yield [exon,'I',ar[i-1][0].end+1,q.start-difq,'',qseq[q.start-difq-1:q.start-1].upper(),qual[q.start-difq-1:q.start-1]]
         else:
-          tarr.append(tdone)
-          qarr.append(qdone)
-          yarr.append(ydone)
-          tdone = ''
-          qdone = ''
-          ydone = ''
-      tdone += textra+ref[t.chr][t.start-1:t.end].upper()
-      qdone += qextra+qseq[q.start-1:q.end].upper()
-      ydone += yextra+qual[q.start-1:q.end]
-    if len(tdone) > 0: 
-      tarr.append(tdone)
-      qarr.append(qdone)
-      yarr.append(ydone)
+          exon += 1
+      yield [exon,'M',t.start,q.start,ref[t.chr][t.start-1:t.end].upper(),qseq[q.start-1:q.end].upper(),qual[q.start-1:q.end]]
+
+  # Process the alignment to get information like
+  # the alignment strings for each exon
+  def get_alignment_strings(self,min_intron_size=68):
+    tarr = []
+    qarr = []
+    yarr = []
+    for [exon,op,tstart,qstart,tseq,qseq,qual] in self.walk_alignment(min_intron_size=min_intron_size):
+      if exon == len(tarr):
+        tarr.append([])
+        qarr.append([])
+        yarr.append([])
+      if op == 'D':
+        tarr[-1].append(tseq)
+        qarr[-1].append('-'*len(tseq))
+        yarr[-1].append('\0'*len(tseq))
+      elif op == 'I':
+        tarr[-1].append('-'*len(qseq))
+        qarr[-1].append(qseq)
+        yarr[-1].append(qual)
+      else:
+        tarr[-1].append(tseq)
+        qarr[-1].append(qseq)
+        yarr[-1].append(qual)
+    tarr = [''.join(x) for x in tarr]
+    qarr = [''.join(x) for x in qarr]
+    yarr = [''.join(x) for x in yarr]
     if self.get_query_quality() == '*': yarr = [x.replace('I',' ') for x in yarr]
     #query, target, query_quality
     return [qarr,tarr,yarr]
 
+  # Post: list of the differences between query and target as
+  #       [type, target start, query start, target bases, query bases]
+  #       where type is mismatch, insertion or deletion
+  #       (coordinates as in walk_alignment)
+  def get_error_events(self,min_intron_size=68):
+    events = []
+    for [exon,op,tstart,qstart,tseq,qseq,qual] in self.walk_alignment(min_intron_size=min_intron_size):
+      if op == 'D':
+        events.append(['deletion',tstart,qstart,tseq,''])
+      elif op == 'I':
+        events.append(['insertion',tstart,qstart,'',qseq])
+      elif tseq != qseq:
+        for j in [j for j in range(len(qseq)) if _is_mismatch(tseq[j],qseq[j])]:
+          events.append(['mismatch',tstart+j,qstart+j,tseq[j],qseq[j]])
+    return events
+
   def _analyze_alignment(self,min_intron_size=68):
-    [qstrs,tstrs,ystrs] = self.get_alignment_strings(min_intron_size=min_intron_size)
     matches = sum([x[0].length() for x in self.get_alignment_ranges()]) 
     misMatches = 0
-    for i in range(len(qstrs)):
-      misMatches += sum([int(qstrs[i][j]!=tstrs[i][j] and qstrs[i][j]!='-' and tstrs[i][j]!='-' and tstrs[i][j]!='N') for j in range(len(qstrs[i]))])
-    nCount = sum([len([y for y in list(x) if y == 'N'])  for x in tstrs])
-    qNumInsert = sum([len(re.findall('[-]+',x)) for x in tstrs])
-    qBaseInsert = sum([len(re.findall('[-]',x)) for x in tstrs])
-    tNumInsert = sum([len(re.findall('[-]+',x)) for x in qstrs])
-    tBaseInsert = sum([len(re.findall('[-]',x)) for x in qstrs])
+    nCount = 0
+    qNumInsert = 0
+    qBaseInsert = 0
+    tNumInsert = 0
+    tBaseInsert = 0
+    for [exon,op,tstart,qstart,tseq,qseq,qual] in self.walk_alignment(min_intron_size=min_intron_size):
+      if op == 'M':
+        misMatches += count_mismatches(tseq,qseq)
+        nCount += tseq.count('N')
+      elif op == 'D':
+        nCount += tseq.count('N')
+        tNumInsert += 1
+        tBaseInsert += len(tseq)
+      else:
+        qNumInsert += 1
+        qBaseInsert += len(qseq)
     matches = matches - misMatches - nCount
     return {'matches':matches,\
             'misMatches':misMatches,\
@@ -311,3 +348,15 @@ class Alignment:
     tx.set_transcript_name(self.get_alignment_ranges()[0][1].chr)
     tx.set_gene_name(self.get_alignment_ranges()[0][1].chr)
     return tx
+
+def _is_mismatch(t,q):
+  return t != q and q != '-' and t != '-' and t != 'N'
+
+# Pre: target and query strings of an aligned block
+# Post: number of columns that differ, not counting a gap or a
+#       target N.  Blocks without those are compared with imap in C.
+def count_mismatches(tseq,qseq):
+  if tseq == qseq: return 0
+  if 'N' in tseq or '-' in tseq or '-' in qseq:
+    return sum([1 for [t,q] in izip(tseq,qseq) if _is_mismatch(t,q)])
+  return sum(imap(ne,tseq,qseq))
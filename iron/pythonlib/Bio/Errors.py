@@ -1,5 +1,7 @@
 from Bio.Sequence import rc
-import sys
+import sys, json, zlib, base64
+from array import array
+from itertools import groupby, izip
 ### Error Analysis ####
 # I am to describe errors at several levels
 # 
@@ -26,58 +28,130 @@ import sys
 #
 valid_types = set(['match','mismatch','total_insertion','total_deletion','homopolymer_insertion','homopolymer_deletion'])
 
+# Accumulates error profiles over a stream of alignments
+# Each alignment is folded into count tables when it is added and
+# then dropped, so memory does not grow with the number of alignments.
+#   context errors  [before][after][base]{'total':count,'types':{base:count}}
+#   homopolymers    (type, nt, target length, query length) -> count
+#   qualities       [type][quality character] -> count
+# Factories built in parallel can be combined with merge, and passed
+# around as a compact string with get_serialized / ErrorProfileFactory(serialized=)
 class ErrorProfileFactory:
-  def __init__(self):
-    self._alignment_errors = []
-    self._target_context_errors = None
-    self._query_context_errors = None
+  def __init__(self,serialized=None):
+    self._alignment_count = 0
+    self._target_context_errors = {}
+    self._query_context_errors = {}
     self._general_errors = GeneralErrorStats()
+    self._homopolymer_counts = {}
+    self._quality_counts = {}
+    self._target_bases = 0
+    self._target_error = 0.0
+    self._query_bases = 0
+    self._query_error = 0.0
+    if serialized: self.load_serialized(serialized)
     return
 
   def close(self):
     self._target_context_errors = None
     self._query_context_errors = None
     self._general_errors = None
-    for ae in self._alignment_errors:
-      ae.close()
-    self._alignment_errors = None
-      
+    self._homopolymer_counts = None
+    self._quality_counts = None
 
+  # Fold the counts of an AlignmentErrors into the tables
   def add_alignment_errors(self,ae):
-    self._target_context_errors = None
-    self._query_context_errors = None
-    self._alignment_errors.append(ae)
+    self._alignment_count += 1
     self._general_errors.add_alignment_errors(ae)
+    if len(ae.get_HPAGroups()) == 0: return # nothing was aligned
+    merge_context_errors(self._target_context_errors,ae.get_context_target_errors())
+    merge_context_errors(self._query_context_errors,ae.get_context_query_errors())
+    self._target_bases += len(ae.get_target_sequence())
+    self._target_error += ae.get_error_probability_sum('target')
+    self._query_bases += len(ae.get_query_sequence())
+    self._query_error += ae.get_error_probability_sum('query')
+    for h in ae.get_HPAGroups():
+      l = h.get_length()
+      k = (h.type(),h.get_nt(),l['target'],l['query'])
+      if k not in self._homopolymer_counts: self._homopolymer_counts[k] = 0
+      self._homopolymer_counts[k] += 1
+      if not ae.has_quality(): continue
+      if h.type() not in self._quality_counts: self._quality_counts[h.type()] = {}
+      q = self._quality_counts[h.type()]
+      for c in h.get_quality():
+        if c not in q: q[c] = 0
+        q[c] += 1
 
   def add_alignment(self,align):
-    self._target_context_errors = None
-    self._query_context_errors = None
     ae = AlignmentErrors(align)
-    self._alignment_errors.append(ae)
-    self._general_errors.add_alignment_errors(ae)
+    self.add_alignment_errors(ae)
+    ae.close()
+
+  # Add the counts of another factory into this one
+  def merge(self,other):
+    self._alignment_count += other._alignment_count
+    self._general_errors.merge(other._general_errors)
+    merge_context_errors(self._target_context_errors,other._target_context_errors)
+    merge_context_errors(self._query_context_errors,other._query_context_errors)
+    self._target_bases += other._target_bases
+    self._target_error += other._target_error
+    self._query_bases += other._query_bases
+    self._query_error += other._query_error
+    for k in other._homopolymer_counts:
+      if k not in self._homopolymer_counts: self._homopolymer_counts[k] = 0
+      self._homopolymer_counts[k] += other._homopolymer_counts[k]
+    for type in other._quality_counts:
+      if type not in self._quality_counts: self._quality_counts[type] = {}
+      q = self._quality_counts[type]
+      for c in other._quality_counts[type]:
+        if c not in q: q[c] = 0
+        q[c] += other._quality_counts[type][c]
+
+  # Post: the counts as a compressed base64 string of json
+  def get_serialized(self):
+    data = {}
+    data['alignment_count'] = self._alignment_count
+    data['general_errors'] = self._general_errors.__dict__
+    data['target_context_errors'] = self._target_context_errors
+    data['query_context_errors'] = self._query_context_errors
+    data['homopolymer_counts'] = [list(k)+[v] for k,v in self._homopolymer_counts.iteritems()]
+    data['quality_counts'] = self._quality_counts
+    data['bases'] = [self._target_bases,self._target_error,self._query_bases,self._query_error]
+    return base64.b64encode(zlib.compress(json.dumps(data),9))
+
+  # Pre: string from get_serialized
+  # Post: this factory holds those counts
+  def load_serialized(self,instr):
+    data = json.loads(zlib.decompress(base64.b64decode(instr)))
+    self._alignment_count = data['alignment_count']
+    self._general_errors = GeneralErrorStats()
+    for k in data['general_errors']:
+      setattr(self._general_errors,str(k),_str_keys(data['general_errors'][k]))
+    self._target_context_errors = _str_keys(data['target_context_errors'])
+    self._query_context_errors = _str_keys(data['query_context_errors'])
+    self._homopolymer_counts = {}
+    for [type,nt,tlen,qlen,cnt] in data['homopolymer_counts']:
+      self._homopolymer_counts[(str(type),str(nt),tlen,qlen)] = cnt
+    self._quality_counts = _str_keys(data['quality_counts'])
+    [self._target_bases,self._target_error,self._query_bases,self._query_error] = data['bases']
+
+  def get_alignment_count(self):
+    return self._alignment_count
 
   def get_alignment_errors(self):
     return self._general_errors
 
+  # Post: dict of (type, nt, target length, query length) -> count
+  def get_homopolymer_counts(self):
+    return self._homopolymer_counts
+
+  # Post: dict of [type][quality character] -> count
+  def get_quality_counts(self):
+    return self._quality_counts
+
   def get_target_context_error_report(self):
-    report = {}
-    report['header'] = ['before','after','reference','query','fraction']
-    report['data'] = []
-    r = self.get_target_context_errors()
-    for b in sorted(r.keys()):
-      for a in sorted(r[b].keys()):
-        for t in sorted(r[b][a]):
-          for q in sorted(r[b][a]):
-            v = 0
-            if r[b][a][t]['total'] > 0:
-              v = float(r[b][a][t]['types'][q])/float(r[b][a][t]['total'])
-            report['data'].append([b,a,t,q,v])
-    return report
+    return target_context_error_report(self.get_target_context_errors())
 
   def get_min_context_count(self,context_type):
-    cnt = 10000000000
-    bases = ['A','C','G','T']
-    basesplus = ['A','C','G','T','-']
     r = None
     if context_type == 'target':
       r = self.get_target_context_errors()
@@ -86,11 +160,7 @@ class ErrorProfileFactory:
     else:
       sys.stderr.write("ERROR incorrect context type\n")
       sys.exit()
-    for b1 in bases:
-      for b2 in bases:
-        for b3 in basesplus:
-          if r[b1][b2][b3]['total'] < cnt: cnt = r[b1][b2][b3]['total']
-    return cnt
+    return min_context_count(r)
 
   def write_context_error_report(self,file,context_type):
     if context_type == 'target':
@@ -122,71 +192,81 @@ class ErrorProfileFactory:
     return report
 
   def get_target_context_errors(self):
-    if not self._target_context_errors:
-      self.combine_context_errors()
     return self._target_context_errors
 
   def get_query_context_errors(self):
-    if not self._query_context_errors:
-      self.combine_context_errors()
     return self._query_context_errors
 
-  def combine_context_errors(self):
-    r = {}
-    if self._target_context_errors: r = self._target_context_errors
-    for k in [x.get_context_target_errors() for x in self._alignment_errors]:
-      for b in k:
-        if b not in r: r[b] = {}
-        for c in k[b]:
-          if c not in r[b]: r[b][c] = {}
-          for a in k[b][c]:
-            if a not in r[b][c]: 
-              r[b][c][a] = {}
-              r[b][c][a]['total'] = 0
-              r[b][c][a]['types'] = {}
-            r[b][c][a]['total'] += k[b][c][a]['total']
-            for type in k[b][c][a]['types']:
-              if type not in r[b][c][a]['types']: r[b][c][a]['types'][type] = 0
-              r[b][c][a]['types'][type] += k[b][c][a]['types'][type]
-    self._target_context_errors = r
-    r = {}
-    if self._query_context_errors: r = self._query_context_errors
-    for k in [x.get_context_query_errors() for x in self._alignment_errors]:
-      for b in k:
-        if b not in r: r[b] = {}
-        for c in k[b]:
-          if c not in r[b]: r[b][c] = {}
-          for a in k[b][c]:
-            if a not in r[b][c]: 
-              r[b][c][a] = {}
-              r[b][c][a]['total'] = 0
-              r[b][c][a]['types'] = {}
-            r[b][c][a]['total'] += k[b][c][a]['total']
-            for type in k[b][c][a]['types']:
-              if type not in r[b][c][a]['types']: r[b][c][a]['types'][type] = 0
-              r[b][c][a]['types'][type] += k[b][c][a]['types'][type]
-    self._query_context_errors = r
-
   def __str__(self):
     return self.get_string()
 
   def get_string(self):
     ostr = ''
-    ostr += str(len(self._alignment_errors))+" Alignments\n"
+    ostr += str(self._alignment_count)+" Alignments\n"
     ostr += 'Target: '+"\n"
-    totbases = sum([len(x.get_target_sequence()) for x in self._alignment_errors])
-    ostr += '  '+str(totbases)+" Target Bases\n"
-    adjerror = sum([sum([y.get_error_probability() for y in x.get_target_errors()]) for x in self._alignment_errors])
-    ostr += '  '+str(adjerror)+" Approximate error count\n"
-    ostr += '  '+str(float(adjerror)/float(totbases))+" Error rate\n"
+    ostr += '  '+str(self._target_bases)+" Target Bases\n"
+    ostr += '  '+str(self._target_error)+" Approximate error count\n"
+    ostr += '  '+str(float(self._target_error)/float(self._target_bases))+" Error rate\n"
     ostr += 'Query: '+"\n"
-    totbases = sum([len(x.get_query_sequence()) for x in self._alignment_errors])
-    ostr += '  '+str(totbases)+" Query Bases\n"
-    adjerror = sum([sum([y.get_error_probability() for y in x.get_query_errors()]) for x in self._alignment_errors])
-    ostr += '  '+str(adjerror)+" Approximate error count\n"
-    ostr += '  '+str(float(adjerror)/float(totbases))+" Error rate\n"
+    ostr += '  '+str(self._query_bases)+" Query Bases\n"
+    ostr += '  '+str(self._query_error)+" Approximate error count\n"
+    ostr += '  '+str(float(self._query_error)/float(self._query_bases))+" Error rate\n"
     return ostr
 
+# json gives back unicode keys, put them back to str
+def _str_keys(v):
+  if isinstance(v,dict):
+    return dict([(str(k),_str_keys(x)) for k,x in v.iteritems()])
+  return v
+
+# Pre: r and k are context error dicts
+#      [before][after][base]{'total':count,'types':{base:count}}
+# Post: the counts of k are added into r
+def merge_context_errors(r,k):
+  for b in k:
+    if b not in r: r[b] = {}
+    for c in k[b]:
+      if c not in r[b]: r[b][c] = {}
+      for a in k[b][c]:
+        if a not in r[b][c]: 
+          r[b][c][a] = {}
+          r[b][c][a]['total'] = 0
+          r[b][c][a]['types'] = {}
+        r[b][c][a]['total'] += k[b][c][a]['total']
+        for type in k[b][c][a]['types']:
+          if type not in r[b][c][a]['types']: r[b][c][a]['types'][type] = 0
+          r[b][c][a]['types'][type] += k[b][c][a]['types'][type]
+
+# Pre: target context error dict
+# Post: report dict with a header and rows of
+#       before, after, reference, query, fraction
+def target_context_error_report(r):
+  report = {}
+  report['header'] = ['before','after','reference','query','fraction']
+  report['data'] = []
+  for b in sorted(r.keys()):
+    for a in sorted(r[b].keys()):
+      for t in sorted(r[b][a]):
+        for q in sorted(r[b][a]):
+          v = 0
+          if r[b][a][t]['total'] > 0:
+            v = float(r[b][a][t]['types'][q])/float(r[b][a][t]['total'])
+          report['data'].append([b,a,t,q,v])
+  return report
+
+# Pre: context error dict
+# Post: the fewest observations of any context, 0 if one is missing
+def min_context_count(r):
+  cnt = 10000000000
+  bases = ['A','C','G','T']
+  basesplus = ['A','C','G','T','-']
+  for b1 in bases:
+    for b2 in bases:
+      for b3 in basesplus:
+        if b1 not in r or b2 not in r[b1] or b3 not in r[b1][b2]: return 0
+        if r[b1][b2][b3]['total'] < cnt: cnt = r[b1][b2][b3]['total']
+  return cnt
+
 class BaseError():
   def __init__(self,type):
     self._type = type
@@ -459,6 +539,10 @@ class AlignmentErrors:
     self._target_errors = None
     self._context_query_errors = None
     self._context_target_errors = None
+    self._query_hpa_index = array('i')
+    self._query_hpa_pos = array('i')
+    self._target_hpa_index = array('i')
+    self._target_hpa_pos = array('i')
     astrings = self._alignment.get_alignment_strings(min_intron_size=self._min_intron_size)
     if self._alignment.get_query_quality(): self._has_quality = True
     if len(astrings) == 0: return None
@@ -472,31 +556,15 @@ class AlignmentErrors:
     #  alns = alns[::-1]
     #get homopolymer alignments
     self._hpas = self._misalign_split(alns) # split alignment into homopolymer groups
-    self._query_hpas = []
-    self._target_hpas = []
-    qi = 0
+    # for each base of the query and of the target keep the index of its
+    # homopolymer group and its position within that group
     for i in range(len(self._hpas)):
-      prev = None
-      if i > 0: prev = self._hpas[i-1]
-      foll = None
-      if i + 1 < len(self._hpas): foll = self._hpas[i+1]
       qlen = len(self._hpas[i].get_query())
-      for j in range(0,qlen):
-        self._query_hpas.append({'hpa':self._hpas[i],'pos':j,'prev-hpa':prev,'next-hpa':foll})
-      qi+=qlen
-    ti = 0
-    for i in range(len(self._hpas)):
-      prev = None
-      if i > 0: prev = self._hpas[i-1]
-      foll = None
-      if i + 1 < len(self._hpas): foll = self._hpas[i+1]
+      self._query_hpa_index.extend([i]*qlen)
+      self._query_hpa_pos.extend(range(0,qlen))
       tlen = len(self._hpas[i].get_target())
-      for j in range(0,tlen):
-        self._target_hpas.append({'hpa':self._hpas[i],'pos':j,'prev-hpa':prev,'next-hpa':foll})
-      ti+=tlen
-    self._target_errors = self.get_target_errors()
-    self._query_errors = self.get_query_errors()  
-    self._context_target_errors = self.get_context_target_errors()
+      self._target_hpa_index.extend([i]*tlen)
+      self._target_hpa_pos.extend(range(0,tlen))
 
   def close(self):
       self._min_intron_size= None
@@ -511,8 +579,10 @@ class AlignmentErrors:
       self._context_query_errors = None
       self._context_target_errors = None
       self._hpas = None # split alignment into homopolymer groups
-      self._query_hpas = None
-      self._target_hpas = None
+      self._query_hpa_index = None
+      self._query_hpa_pos = None
+      self._target_hpa_index = None
+      self._target_hpa_pos = None
       self._target_errors = None
       self._query_errors = None
       self._context_target_errors = None
@@ -530,7 +600,7 @@ class AlignmentErrors:
 
   def get_context_target_errors(self):
     if self._context_target_errors:  return self._context_target_errors
-    if len(self._query_errors) < 3: return {}
+    if len(self._query_hpa_index) < 3: return {}
     nts = ['A','C','G','T']
     poss = ['A','C','G','T','-']
     r = {}
@@ -546,16 +616,14 @@ class AlignmentErrors:
           for l in poss:
             if l not in r[i][j][k]['types']: r[i][j][k]['types'][l] = 0
     # now r is initialized
-    for i in range(1,len(self._target_errors)-1):
-
-      tobs = self._target_errors[i].get_observable()
-      tunobs = self._target_errors[i].get_unobservable()
-      otype = tobs.get_type()
-      op = tobs.get_error_probability()
-      before = tunobs.get_before_type()
-      bp = tunobs.get_before_probability()
-      after = tunobs.get_after_type()
-      ap = tunobs.get_after_probability()
+    seq = self.get_target_sequence()
+    groups = self._group_errors('target')
+    hpa_index = self._target_hpa_index
+    hpa_pos = self._target_hpa_pos
+    for i in range(1,len(hpa_index)-1):
+      [otype,op,before,bp,after,ap,glen] = groups[hpa_index[i]]
+      if hpa_pos[i] != 0: [before,bp] = [None,0]
+      if hpa_pos[i] != glen-1: [after,ap] = [None,0]
       if otype[2][0][0] == 'N': continue
       if otype[2][1][0] == 'N': continue
       if before:
@@ -565,9 +633,9 @@ class AlignmentErrors:
         if after[2][0][0] == 'N': continue
         if after[2][1][0] == 'N': continue
 
-      tbefore = self._target_errors[i-1].get_base()
-      t = self._target_errors[i].get_base()
-      tafter = self._target_errors[i+1].get_base()
+      tbefore = seq[i-1]
+      t = seq[i]
+      tafter = seq[i+1]
 
       if tbefore == 'N' or tafter == 'N' or t == 'N': continue
       r[tbefore][t]['-']['total'] += 0.5
@@ -623,11 +691,12 @@ class AlignmentErrors:
       for a in r:
         val = sum([r[b][a]['-']['types'][q] for q in nts])
         r[b][a]['-']['types']['-'] = r[b][a]['-']['total'] - val
+    self._context_target_errors = r
     return r
 
   def get_context_query_errors(self):
     if self._context_query_errors:  return self._context_query_errors
-    if len(self._query_errors) < 3: return {}
+    if len(self._query_hpa_index) < 3: return {}
     nts = ['A','C','G','T']
     poss = ['A','C','G','T','-']
     r = {}
@@ -643,16 +712,14 @@ class AlignmentErrors:
           for l in poss:
             if l not in r[i][j][k]['types']: r[i][j][k]['types'][l] = 0
     # now r is initialized
-    for i in range(1,len(self._query_errors)-1):
-
-      tobs = self._query_errors[i].get_observable()
-      tunobs = self._query_errors[i].get_unobservable()
-      otype = tobs.get_type()
-      op = tobs.get_error_probability()
-      before = tunobs.get_before_type()
-      bp = tunobs.get_before_probability()
-      after = tunobs.get_after_type()
-      ap = tunobs.get_after_probability()
+    seq = self.get_query_sequence()
+    groups = self._group_errors('query')
+    hpa_index = self._query_hpa_index
+    hpa_pos = self._query_hpa_pos
+    for i in range(1,len(hpa_index)-1):
+      [otype,op,before,bp,after,ap,glen] = groups[hpa_index[i]]
+      if hpa_pos[i] != 0: [before,bp] = [None,0]
+      if hpa_pos[i] != glen-1: [after,ap] = [None,0]
       if otype[2][0][0] == 'N': continue
       if otype[2][1][0] == 'N': continue
       if before:
@@ -662,9 +729,9 @@ class AlignmentErrors:
         if after[2][0][0] == 'N': continue
         if after[2][1][0] == 'N': continue
 
-      tbefore = self._query_errors[i-1].get_base()
-      t = self._query_errors[i].get_base()
-      tafter = self._query_errors[i+1].get_base()
+      tbefore = seq[i-1]
+      t = seq[i]
+      tafter = seq[i+1]
 
       if tbefore == 'N' or tafter == 'N' or t == 'N': continue
       r[tbefore][t]['-']['total'] += 0.5
@@ -716,32 +783,82 @@ class AlignmentErrors:
       for a in r:
         val = sum([r[b][a]['-']['types'][q] for q in nts])
         r[b][a]['-']['types']['-'] = r[b][a]['-']['total'] - val
+    self._context_query_errors = r
     return r
 
+  # Pre: 'target' or 'query' perspective
+  # Post: for each homopolymer group the parts of a BaseError its bases share
+  #       [observable type, observable probability,
+  #        before type, before probability, after type, after probability,
+  #        length in this perspective]
+  #       before only applies to the first base of the group and after
+  #       to the last
+  def _group_errors(self,type):
+    output = []
+    for g in range(len(self._hpas)):
+      h = self._hpas[g]
+      be = BaseError(type)
+      be.set_observable(h.get_target(),h.get_query())
+      prev = None
+      if g > 0: prev = self._hpas[g-1]
+      foll = None
+      if g+1 < len(self._hpas): foll = self._hpas[g+1]
+      if type == 'query':
+        glen = len(h.get_query())
+        if prev and len(prev.get_query()) == 0: # total deletion
+          be.set_unobserved_before(len(prev.get_target()),0,prev.get_target()[0],0.5)
+        if foll and len(foll.get_query()) == 0:
+          be.set_unobserved_after(len(foll.get_target()),0,foll.get_target()[0],0.5)
+      else:
+        glen = len(h.get_target())
+        if prev and len(prev.get_target()) == 0: # total insertion
+          be.set_unobserved_before(0,len(prev.get_query()),prev.get_query()[0],0.5)
+        if foll and len(foll.get_target()) == 0:
+          be.set_unobserved_after(0,len(foll.get_query()),foll.get_query()[0],0.5)
+      obs = be.get_observable()
+      unobs = be.get_unobservable()
+      output.append([obs.get_type(),obs.get_error_probability(),unobs.get_before_type(),unobs.get_before_probability(),unobs.get_after_type(),unobs.get_after_probability(),glen])
+    return output
+
+  # Pre: 'target' or 'query' perspective
+  # Post: sum of get_error_probability over every base's BaseError
+  #       without making the BaseErrors
+  def get_error_probability_sum(self,type):
+    if type == 'query':
+      [hpa_index,hpa_pos] = [self._query_hpa_index,self._query_hpa_pos]
+    else:
+      [hpa_index,hpa_pos] = [self._target_hpa_index,self._target_hpa_pos]
+    groups = self._group_errors(type)
+    last = len(hpa_index)-1
+    total = 0
+    for i in range(len(hpa_index)):
+      [otype,a,before,bp,after,ap,glen] = groups[hpa_index[i]]
+      if i == 0 or hpa_pos[i] != 0: bp = 0
+      if i == last or hpa_pos[i] != glen-1: ap = 0
+      b = bp+(1-bp)*ap
+      total += a+(1-a)*b
+    return total
+
   def get_query_errors(self):
     if self._query_errors: return self._query_errors
-    v = []
-    for i in range(len(self._query_hpas)):
-      v.append(self.get_query_error(i))
-    return v
+    self._query_errors = [self.get_query_error(i) for i in range(len(self._query_hpa_index))]
+    return self._query_errors
 
   # Pre:  given an index in the aligned query
   # Post: return the error description for that base
   def get_query_error(self,i):
-    x = self._query_hpas[i]
-    h = x['hpa']
-    pos = x['pos']
-    prob = 0
+    g = self._query_hpa_index[i]
+    h = self._hpas[g]
+    pos = self._query_hpa_pos[i]
     be = BaseError('query')
     be.set_observable(h.get_target(),h.get_query())
-    #print pos
     if i != 0 and pos == 0: # check for a total deletion before
-      prev = x['prev-hpa']
+      prev = self._hpas[g-1]
       if len(prev.get_query()) == 0: # total deletion
         be.set_unobserved_before(len(prev.get_target()),0,prev.get_target()[0],0.5)
-    if i != len(self._query_hpas)-1 and pos == len(h.get_query())-1: # check for a total deletion before
-      if x['next-hpa']:
-        foll = x['next-hpa']
+    if i != len(self._query_hpa_index)-1 and pos == len(h.get_query())-1: # check for a total deletion before
+      if g+1 < len(self._hpas):
+        foll = self._hpas[g+1]
         if len(foll.get_query()) == 0: # total deletion
           be.set_unobserved_after(len(foll.get_target()),0,foll.get_target()[0],0.5)
     #else: print h
@@ -749,37 +866,32 @@ class AlignmentErrors:
 
   def get_target_errors(self):
     if self._target_errors: return self._target_errors
-    v = []
-    for i in range(len(self._target_hpas)):
-      v.append(self.get_target_error(i))
-    return v
+    self._target_errors = [self.get_target_error(i) for i in range(len(self._target_hpa_index))]
+    return self._target_errors
 
   # Pre:  given an index in the aligned query
   # Post: return the error description for that base
   def get_target_error(self,i):
-    x = self._target_hpas[i]
-    h = x['hpa']
-    pos = x['pos']
-    prob = 0
+    g = self._target_hpa_index[i]
+    h = self._hpas[g]
+    pos = self._target_hpa_pos[i]
     be = BaseError('target')
     be.set_observable(h.get_target(),h.get_query())
-    #print pos
     if i != 0 and pos == 0: # check for a total deletion before
-      prev = x['prev-hpa']
+      prev = self._hpas[g-1]
       if len(prev.get_target()) == 0: # total insertion
-        ilen = len(prev.get_query())
         be.set_unobserved_before(0,len(prev.get_query()),prev.get_query()[0],0.5)
-    if i != len(self._target_hpas)-1 and pos == len(h.get_target())-1: # check for a total deletion before
-      if x['next-hpa']:
-        foll = x['next-hpa']
+    if i != len(self._target_hpa_index)-1 and pos == len(h.get_target())-1: # check for a total deletion before
+      if g+1 < len(self._hpas):
+        foll = self._hpas[g+1]
         if len(foll.get_target()) == 0: # total insertion
           be.set_unobserved_after(0,len(foll.get_query()),foll.get_query()[0],0.5)
     return be
 
   def get_query_sequence(self):
-    return ''.join([x['hpa'].get_query()[0] for x in self._query_hpas])
+    return ''.join([x.get_query() for x in self._hpas])
   def get_target_sequence(self):
-    return ''.join([x['hpa'].get_target()[0] for x in self._target_hpas])
+    return ''.join([x.get_target() for x in self._hpas])
 
   # Go through HPAGroups and store the distro of ordinal values of quality scores
   def analyze_quality(self):
@@ -821,31 +933,28 @@ class AlignmentErrors:
       elif buffer['query'] != buffer['target']: buffer['nt'] = '*'
       else:
 	sys.stderr.write("WARNING unkonwn case\n")
-      for i in range(1,len(x['query'])):
-        qchar = x['query'][i]
-        tchar = x['target'][i]
-        qualchar = x['query_quality'][i]
+      # walk runs of identical alignment columns rather than single columns
+      i = 1
+      for [qchar,tchar],run in groupby(izip(x['query'][1:],x['target'][1:])):
+        l = sum(1 for c in run)
         if qchar != tchar and (qchar != '-' and tchar != '-'):
-          #classic mismatch
-          #print 'mismatch'
-          #print buffer
-          total.append(buffer)
-          buffer = {'query':qchar,'target':tchar,'query_quality':qualchar,'exon':exon_num}
-          buffer['nt'] = '*'
+          #classic mismatch, every column is its own group
+          for j in range(i,i+l):
+            total.append(buffer)
+            buffer = {'query':qchar,'target':tchar,'query_quality':x['query_quality'][j],'exon':exon_num}
+            buffer['nt'] = '*'
         elif qchar == buffer['nt'] or tchar == buffer['nt']:
           # its a homopolymer match
-          buffer['query'] += qchar
-
-          buffer['target'] += tchar
-          buffer['query_quality'] += qualchar
-          #print 'homopoly'
+          buffer['query'] += qchar*l
+          buffer['target'] += tchar*l
+          buffer['query_quality'] += x['query_quality'][i:i+l]
         else:
-          #print 'new thing'
-          #print buffer
+          # a new group that the rest of the run extends
           total.append(buffer)
-          buffer = {'query':qchar,'target':tchar,'query_quality':qualchar,'exon':exon_num}
+          buffer = {'query':qchar*l,'target':tchar*l,'query_quality':x['query_quality'][i:i+l],'exon':exon_num}
           if qchar == '-': buffer['nt'] = tchar
           else:  buffer['nt'] = qchar
+        i += l
       total.append(buffer)
     result = [AlignmentErrors.HPAGroup(self,y) for y in total]
     return result
@@ -985,6 +1094,18 @@ class GeneralErrorStats:
         ostr += target+ "\t"+query+"\t"+str(self.matrix[target][query])+"\t"+str(self.alignment_length)+"\n"
     return ostr
 
+  # Add the counts of another GeneralErrorStats into this one
+  def merge(self,other):
+    self.alignment_count += other.alignment_count
+    self.alignment_length += other.alignment_length
+    self.mismatches += other.mismatches
+    self.matches += other.matches
+    for k in self.deletions: self.deletions[k] += other.deletions[k]
+    for k in self.insertions: self.insertions[k] += other.insertions[k]
+    for p1 in self.matrix:
+      for p2 in self.matrix[p1]:
+        self.matrix[p1][p2] += other.matrix[p1][p2]
+
   def add_alignment_errors(self,ae):
     self.alignment_count += 1
     for v in ae.get_HPAGroups():
@@ -0,0 +1,142 @@
+import struct, sys
+
+# Read, build and query the UCSC style binning index used by .bai files
+# Coordinates here are 0-indexed starts and 1-indexed (exclusive) ends
+# Virtual offsets are bgzf block start << 16 | inner block start
+
+# Pre: beg and end of a region
+# Post: the smallest bin that fully contains it
+def reg2bin(beg,end):
+  end -= 1
+  if beg>>14 == end>>14: return ((1<<15)-1)/7 + (beg>>14)
+  if beg>>17 == end>>17: return ((1<<12)-1)/7 + (beg>>17)
+  if beg>>20 == end>>20: return ((1<<9)-1)/7 + (beg>>20)
+  if beg>>23 == end>>23: return ((1<<6)-1)/7 + (beg>>23)
+  if beg>>26 == end>>26: return ((1<<3)-1)/7 + (beg>>26)
+  return 0
+
+# Pre: beg and end of a region
+# Post: every bin that could hold an alignment overlapping it
+def reg2bins(beg,end):
+  end -= 1
+  bins = [0]
+  for [shift,offset] in [[26,1],[23,9],[20,73],[17,585],[14,4681]]:
+    bins.extend(range(offset+(beg>>shift),offset+(end>>shift)+1))
+  return bins
+
+def virtual_offset(coord):
+  return (coord[0] << 16) | coord[1]
+
+def coord_from_virtual_offset(voffset):
+  return [voffset >> 16, voffset & 0xFFFF]
+
+class BAI:
+  # Pre: (optional) index_file is a .bai to read, otherwise start empty
+  #      and fill with BAIBuilder
+  def __init__(self,index_file=None):
+    self._refs = [] # per reference [bins dict of chunk lists, linear index]
+    self._no_coor = None
+    if index_file: self._read(index_file)
+
+  def get_reference_count(self):
+    return len(self._refs)
+
+  # Pre: reference number and a 0-indexed start, 1-indexed end
+  # Post: sorted non-overlapping [start,end] virtual offset chunks that
+  #       hold every alignment overlapping the region
+  def get_chunks(self,ref_id,beg,end):
+    if ref_id < 0 or ref_id >= len(self._refs): return []
+    [bins,linear] = self._refs[ref_id]
+    min_offset = 0
+    if len(linear) > 0:
+      min_offset = linear[min(beg>>14,len(linear)-1)]
+    chunks = []
+    for bin in reg2bins(beg,end):
+      if bin not in bins: continue
+      for c in bins[bin]:
+        if c[1] > min_offset: chunks.append(c)
+    chunks.sort()
+    merged = []
+    for c in chunks:
+      if len(merged) > 0 and c[0] <= merged[-1][1]:
+        if c[1] > merged[-1][1]: merged[-1][1] = c[1]
+      else:
+        merged.append([c[0],c[1]])
+    return merged
+
+  def write(self,index_file):
+    of = open(index_file,'wb')
+    of.write('BAI\1')
+    of.write(struct.pack('<i',len(self._refs)))
+    for [bins,linear] in self._refs:
+      of.write(struct.pack('<i',len(bins)))
+      for bin in sorted(bins):
+        of.write(struct.pack('<Ii',bin,len(bins[bin])))
+        for c in bins[bin]:
+          of.write(struct.pack('<QQ',c[0],c[1]))
+      of.write(struct.pack('<i',len(linear)))
+      if len(linear) > 0:
+        of.write(struct.pack('<'+str(len(linear))+'Q',*linear))
+    if self._no_coor is not None:
+      of.write(struct.pack('<Q',self._no_coor))
+    of.close()
+
+  def _read(self,index_file):
+    with open(index_file,'rb') as inf:
+      data = inf.read()
+    if data[0:4] != 'BAI\1':
+      sys.stderr.write("ERROR: not a bai index "+index_file+"\n")
+      sys.exit()
+    n_ref = struct.unpack_from('<i',data,4)[0]
+    p = 8
+    for i in range(n_ref):
+      bins = {}
+      n_bin = struct.unpack_from('<i',data,p)[0]
+      p += 4
+      for j in range(n_bin):
+        [bin,n_chunk] = struct.unpack_from('<Ii',data,p)
+        p += 8
+        v = struct.unpack_from('<'+str(n_chunk*2)+'Q',data,p)
+        p += 16*n_chunk
+        bins[bin] = [[v[k],v[k+1]] for k in range(0,len(v),2)]
+      n_intv = struct.unpack_from('<i',data,p)[0]
+      p += 4
+      linear = list(struct.unpack_from('<'+str(n_intv)+'Q',data,p))
+      p += 8*n_intv
+      self._refs.append([bins,linear])
+    if p+8 <= len(data):
+      self._no_coor = struct.unpack_from('<Q',data,p)[0]
+
+# Build a BAI from coordinate sorted alignments as they are read
+class BAIBuilder:
+  def __init__(self,n_ref):
+    self._index = BAI()
+    self._index._refs = [[{},[]] for i in range(n_ref)]
+    self._last = None
+  # Pre: reference number, 0-indexed start, 1-indexed end of the
+  #      alignment on the target, and the virtual offsets where its
+  #      record starts and where the next record starts
+  def add(self,ref_id,beg,end,voffset_start,voffset_end):
+    if self._last and [ref_id,beg] < self._last:
+      sys.stderr.write("ERROR: alignments must be sorted by coordinate to build a region index\n")
+      sys.exit()
+    self._last = [ref_id,beg]
+    [bins,linear] = self._index._refs[ref_id]
+    bin = reg2bin(beg,end)
+    if bin not in bins: bins[bin] = []
+    chunks = bins[bin]
+    if len(chunks) > 0 and chunks[-1][1] == voffset_start:
+      chunks[-1][1] = voffset_end
+    else:
+      chunks.append([voffset_start,voffset_end])
+    last_window = (end-1)>>14
+    while len(linear) <= last_window: linear.append(0)
+    for w in range(beg>>14,last_window+1):
+      if linear[w] == 0 or voffset_start < linear[w]: linear[w] = voffset_start
+  # Post: the finished BAI
+  def get_index(self):
+    # empty windows take the offset of the window before them
+    for [bins,linear] in self._index._refs:
+      for w in range(1,len(linear)):
+        if linear[w] == 0: linear[w] = linear[w-1]
+    return self._index
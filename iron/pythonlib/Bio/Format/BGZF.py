@@ -1,4 +1,6 @@
 import struct, sys, zlib, StringIO, time
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 #Pre block starts
 #start 0-indexted, end 1-indexted
@@ -88,15 +90,43 @@ def is_bgzf(filename):
      return False
   return True
 
+# Pre: the raw bytes of one whole bgzf block, header through isize
+# Post: the decompressed data of the block
+#       Module level so it can be handed to a pool of workers
+#       Raises ValueError on a bad block rather than exiting, so from a
+#       worker the error comes back through the result's get()
+def inflate_block(raw):
+  extra_len = struct.unpack_from('<H',raw,10)[0]
+  d = zlib.decompressobj(-15)
+  data = d.decompress(raw[12+extra_len:len(raw)-8])+d.flush()
+  expected_crc, expected_size = struct.unpack_from('<II',raw,len(raw)-8)
+  if expected_size != len(data):
+    raise ValueError("unexpected size")
+  if zlib.crc32(data) & 0xffffffff != expected_crc:
+    raise ValueError("crc fail")
+  return data
+
 class reader:
   # Methods adapted from biopython's bgzf.py
   # Pre: Handle is a file handle to read from
   #      (optional) blockStart is the byte start location of a block
   #      (optional) innerStart says how far into a decompressed bock to start
-  def __init__(self,handle,blockStart=None,innerStart=None):
+  #      (optional) threads greater than 1 reads blocks ahead and inflates
+  #                 them on a pool of threads (zlib releases the GIL)
+  #      (optional) prefetch is how many blocks to keep in flight
+  #                 when threaded, defaults to four per thread
+  #      Blocks are always handed back in file order with their own
+  #      block starts so virtual offsets are the same either way
+  def __init__(self,handle,blockStart=None,innerStart=None,threads=1,prefetch=None):
     self.fh = handle
     self._pointer = 0
     self._block_start = 0
+    self._pool = None
+    self._ahead = deque() # [block start, block size, pending data]
+    self._prefetch = prefetch
+    if threads > 1:
+      self._pool = ThreadPool(threads)
+      if not self._prefetch: self._prefetch = threads*4
     if blockStart: 
       self.fh.seek(blockStart)
       self._pointer = blockStart
@@ -104,6 +134,11 @@ class reader:
     self._buffer = self._load_block()
     self._buffer_pos = 0
     if innerStart: self._buffer_pos = innerStart
+  def close(self):
+    if self._pool:
+      self._pool.terminate()
+      self._pool = None
+    self._ahead.clear()
   def get_block_start(self):
     return self._block_start
   def get_inner_start(self):
@@ -111,6 +146,7 @@ class reader:
   def seek(self,blockStart,innerStart):
     self.fh.seek(blockStart)
     self._pointer = blockStart
+    self._ahead.clear()
     self._buffer_pos = 0
     self._buffer = self._load_block()
     self._buffer_pos = innerStart
@@ -131,68 +167,106 @@ class reader:
         if len(self._buffer['data'])==0: return v
         done += len(vpart)
 
-  def _load_block(self):
-    #pointer_start = self.fh.tell()
-    if not self.fh: return {'block_size':0,'data':''}
-    #self._block_start = self.fh.tell()
-    self._block_start = self._pointer
-    magic = self.fh.read(4)
-    self._pointer += 4
-    if len(magic) < 4:
-      #print 'end?'
-      #print len(self.fh.read())
-      return {'block_size':0,'data':''}
-    gzip_mod_time, gzip_extra_flags, gzip_os,extra_len = struct.unpack("<LBBH",self.fh.read(8))
-    self._pointer += 8
+  # Pre: handle is at the start of a block
+  # Post: [block start, raw block bytes] or None at the end of the file
+  #       only the header is parsed, nothing is decompressed
+  def _read_raw_block(self):
+    header = self.fh.read(12)
+    if len(header) < 12: return None
+    extra_len = struct.unpack_from('<H',header,10)[0]
+    extra = self.fh.read(extra_len)
     pos = 0
     block_size = None
     #get block_size
     while pos < extra_len:
-      subfield_id = self.fh.read(2)
-      self._pointer += 2
-      subfield_len = struct.unpack("<H",self.fh.read(2))[0]
-      self._pointer += 2
-      subfield_data = self.fh.read(subfield_len)
-      self._pointer += subfield_len
+      subfield_len = struct.unpack_from('<H',extra,pos+2)[0]
+      if extra[pos:pos+2] == 'BC':
+        block_size = struct.unpack_from('<H',extra,pos+4)[0]+1
       pos += subfield_len+4
-      if subfield_id == 'BC':
-        block_size = struct.unpack("<H",subfield_data)[0]+1
-        #print 'blocksize :'+str(block_size)
     #block_size is determined
-    deflate_size = block_size - 1 - extra_len - 19
-    #deflate_size = block_size - extra_len - 19
-    d = zlib.decompressobj(-15)
-    data = d.decompress(self.fh.read(deflate_size))+d.flush()
-    self._pointer += deflate_size
-    expected_crc = self.fh.read(4)
-    self._pointer += 4
-    expected_size = struct.unpack("<I",self.fh.read(4))[0]
-    self._pointer += 4
-    #print len(data)
-    #print expected_size
-    if expected_size != len(data):
-      sys.stderr.write("ERROR unexpected size\n")
-      sys.exit()
-    crc = zlib.crc32(data)
-    if crc < 0:  crc = struct.pack("<i",crc)
-    else:  crc = struct.pack("<I",crc)
-    if crc != expected_crc:
-      sys.stderr.write("ERROR crc fail\n")
+    raw = header+extra+self.fh.read(block_size-12-extra_len)
+    block_start = self._pointer
+    self._pointer += block_size
+    return [block_start,raw]
+
+  def _load_block(self):
+    if not self.fh: return {'block_size':0,'data':''}
+    if not self._pool:
+      self._block_start = self._pointer
+      v = self._read_raw_block()
+      if not v: return {'block_size':0,'data':''}
+      return {'block_size':len(v[1]), 'data':self._inflated(inflate_block,v[1])}
+    # keep the pool busy with the blocks that come next
+    while len(self._ahead) < self._prefetch:
+      v = self._read_raw_block()
+      if not v: break
+      self._ahead.append([v[0],len(v[1]),self._pool.apply_async(inflate_block,(v[1],))])
+    if len(self._ahead) == 0:
+      self._block_start = self._pointer
+      return {'block_size':0,'data':''}
+    [block_start,block_size,pending] = self._ahead.popleft()
+    self._block_start = block_start
+    return {'block_size':block_size, 'data':self._inflated(pending.get)}
+
+  # Pre: a function that gives the inflated block and its arguments
+  # Post: the data, or report a bad block and exit here in the main thread
+  def _inflated(self,f,*args):
+    try:
+      return f(*args)
+    except (ValueError,zlib.error) as e:
+      sys.stderr.write("ERROR "+str(e)+" in bgzf block\n")
       sys.exit()
-    #print self._pointer-self._block_start
-    #print 'bsize '+str(block_size)
-    return {'block_size':block_size, 'data':data}
+
+# The empty block that marks the end of a bgzf file
+_bgzf_eof = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+_bgzf_header = struct.Struct('<BBBBIBBHBBHH')
+
+# Pre: uncompressed bytes (at most 64K) and a zlib compression level
+# Post: the bytes of one whole bgzf block
+#       Module level so it can be handed to a pool of workers
+def deflate_block(bytes,level=9):
+  d = zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS)
+  data = d.compress(bytes)+d.flush()
+  outsize = len(data)+19+6 # Total block size minus one
+  #ID1, ID2, CM, FLG, MTIME, XFL, OS = Unix, XLEN, SI1, SI2, SLEN, BSIZE
+  output = _bgzf_header.pack(31,139,8,4,int(time.time()),0,0x03,6,66,67,2,outsize)
+  output += data
+  output += struct.pack('<II',zlib.crc32(bytes) & 0xffffffff,len(bytes)) # crc and isize
+  return output
 
 class writer:
   #  Give it the handle of the stream to write to
-  def __init__(self,handle):
+  #  (optional) threads greater than 1 compresses blocks on a pool of threads
+  #             blocks are still written in order
+  #  (optional) level is the zlib compression level
+  #  (optional) prefetch is how many blocks can wait on the pool
+  #  (optional) eof writes the empty end of file block on close
+  #  (optional) offset_callback is called as callback(blockStart,innerStart,tag)
+  #             for every write, once the block it starts in is written.
+  #             blockStart counts from the first byte this writer writes
+  def __init__(self,handle,threads=1,level=9,prefetch=None,eof=True,offset_callback=None):
     #self.path = filename
     self.fh = handle
     self.buffer_size = 64000
     self.buffer = bytearray()
+    self._level = level
+    self._eof = eof
+    self._pool = None
+    self._pending = deque() # compressed blocks not yet written
+    self._prefetch = prefetch
+    if threads > 1:
+      self._pool = ThreadPool(threads)
+      if not self._prefetch: self._prefetch = threads*4
+    self._callback = offset_callback
+    self._marks = deque() # [block number, inner start, tag] for each write
+    self._block_number = 0 # blocks cut from the buffer so far
+    self._blocks_written = 0
+    self._written = 0 # compressed bytes written so far
+    self._closed = False
   def __del__(self): 
     self.close()
-  def write(self,bytes):
+  def write(self,bytes,tag=None):
+    if self._callback: self._marks.append([self._block_number,len(self.buffer),tag])
     self.buffer+=bytes
     if len(self.buffer) < self.buffer_size:
       return True
@@ -200,39 +274,44 @@ class writer:
       dobytes = self.buffer[0:self.buffer_size]
       self.buffer = self.buffer[self.buffer_size:]
       self._do_block(dobytes)
+      # marks further along fall in the next block
+      for m in self._marks:
+        if m[0] == self._block_number and m[1] >= self.buffer_size:
+          m[0] += 1
+          m[1] -= self.buffer_size
+      self._block_number += 1
     return
 
   def close(self):
-    if len(self.buffer) == 0:  return True
-    self._do_block(self.buffer)
-    self.buffer = []
+    if self._closed: return True
+    self._closed = True
+    if len(self.buffer) > 0:
+      self._do_block(self.buffer)
+      self._block_number += 1
+    self.buffer = bytearray()
+    while len(self._pending) > 0:
+      self._write_block(self._pending.popleft().get())
+    if self._pool:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+    if self._eof: self._write_block(_bgzf_eof)
     return True
 
   def _do_block(self,bytes):
-    # now we can output this  
-    isize = len(bytes)
-    s = StringIO.StringIO(bytes)
-    d = zlib.compressobj(9,zlib.DEFLATED,-zlib.MAX_WBITS)
-    data = d.compress(str(bytes))+d.flush()
-    datasize = len(data)
-    output = bytearray()
-    output += struct.pack('<B',31)  #IDentifier1
-    output += struct.pack('<B',139) #IDentifier2
-    output += struct.pack('<B',8)   #Compression Method
-    output += struct.pack('<B',4)   #FLaGs
-    output += struct.pack('<I',int(time.time())) #Modification TIME
-    output += struct.pack('<B',0)   #eXtra FLags
-    output += struct.pack('<B',0x03)   #Operating System = Unix
-    output += struct.pack('<H',6)   #eXtra LENgth
-    # Subfields
-    output += struct.pack('<B',66) #Subfield Identifier 1
-    output += struct.pack('<B',67) # Subfield Identifier 2
-    output += struct.pack('<H',2) #Subfield Length
-    outsize = datasize+19+6
-    output += struct.pack('<H',outsize) #Total block size minus one
-    output += data
-    crc = zlib.crc32(str(bytes))
-    if crc < 0:  output += struct.pack("<i",crc)
-    else:  output+= struct.pack("<I",crc)
-    output += struct.pack("<I",isize) #isize
-    self.fh.write(str(output))    
+    if not self._pool:
+      self._write_block(deflate_block(str(bytes),self._level))
+      return
+    self._pending.append(self._pool.apply_async(deflate_block,(str(bytes),self._level)))
+    while len(self._pending) > self._prefetch:
+      self._write_block(self._pending.popleft().get())
+
+  # Write a finished block and report the offsets that start in it
+  def _write_block(self,block):
+    block_start = self._written
+    self.fh.write(block)
+    self._written += len(block)
+    while len(self._marks) > 0 and self._marks[0][0] <= self._blocks_written:
+      m = self._marks.popleft()
+      self._callback(block_start,m[1],m[2])
+    self._blocks_written += 1
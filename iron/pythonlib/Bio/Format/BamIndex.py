@@ -1,6 +1,236 @@
-import gzip, sys, random, os
+import gzip, sys, random, os, struct, mmap, zlib, bisect
+from array import array
+from tempfile import TemporaryFile
 from Bio.Range import GenomicRange
-from Bio.Format.Sam import BAMFile
+from Bio.Format.Sam import BAMFile, SamtoolsBAMStream
+
+# Binary index file (the default written by write_index)
+# Everything little-endian.  A fixed header then one section per column
+# so it can be memory mapped and queried without being loaded
+#  header: magic 'BGI\x01', version, entry count, primary count
+#          then the byte offset of each section in _index_sections order
+#  filestart  uint64 per entry  bgzf block start
+#  innerstart uint32 per entry  bgzf inner block start
+#  flag       uint16 per entry
+#  basecount  uint32 per entry  aligned base count
+#  chr        int32 per entry   index into the chrs section, -1 unaligned
+#  start, end uint32 per entry  target range
+#  nameoffs   uint64 per entry plus one, into the names section
+#  names      all qnames concatenated
+#  namehash   uint64 per entry (crc32 of qname << 32 | entry number)
+#             sorted so a name is found by bisection
+#  primary    uint32 per primary entry, the entry numbers not flagged 2304
+#  chrs       newline separated chromosome names
+_index_magic = 'BGI\x01'
+_index_version = 1
+_index_sections = [['filestart','Q'],['innerstart','I'],['flag','H'],['basecount','I'],['chr','i'],['start','I'],['end','I'],['nameoffs','Q'],['names',None],['namehash','Q'],['primary','I'],['chrs',None]]
+_index_header = struct.Struct('<4sIQQ'+'Q'*len(_index_sections))
+
+# Pre: path to an index file
+# Post: True if it is the binary format, False for the gzipped TSV
+def is_binary_index(index_file):
+  with open(index_file,'rb') as inf:
+    return inf.read(4) == _index_magic
+
+# A column of fixed width values read straight from a mapped index
+# Behaves like a read only list so bisect can search it
+class _MappedColumn:
+  def __init__(self,mm,offset,code,length):
+    self._mm = mm
+    self._offset = offset
+    self._struct = struct.Struct('<'+code)
+    self._length = length
+  def __len__(self):
+    return self._length
+  def __getitem__(self,i):
+    if i < 0: i += self._length
+    if i < 0 or i >= self._length: raise IndexError('index out of range')
+    return self._struct.unpack_from(self._mm,self._offset+i*self._struct.size)[0]
+
+# unsigned 64 bit array type code ('Q' is not in python 2)
+_hash_code = 'L'
+if array(_hash_code).itemsize != 8: _hash_code = 'Q'
+
+# Write the binary index one entry at a time
+# Columns are spooled to temporary files so memory stays small.
+# Name hash keys go in 256 buckets on the top byte of the hash, each a
+# small array that is spooled to one shared temporary file whenever it
+# fills, so only a bucket at a time is ever held for sorting
+class BinaryIndexWriter:
+  def __init__(self,index_file,bucket_size=4096):
+    self.index_file = index_file
+    self._n = 0
+    self._primary = 0
+    self._chrs = {}
+    self._chr_names = []
+    self._name_bytes = 0
+    self._spools = {}
+    for [name,code] in _index_sections:
+      if name in ['chrs','namehash']: continue
+      self._spools[name] = TemporaryFile()
+    self._spools['nameoffs'].write(struct.pack('<Q',0))
+    self._bucket_size = bucket_size
+    self._hash_buckets = [array(_hash_code) for i in range(256)]
+    self._hash_spool = TemporaryFile()
+    self._hash_segments = [[] for i in range(256)] # [file offset, count] spooled
+  # Pre: rng is a GenomicRange or None if unaligned
+  def add(self,qname,rng,filestart,innerstart,basecount,flag):
+    chr = -1
+    start = 0
+    end = 0
+    if rng:
+      if rng.chr not in self._chrs:
+        self._chrs[rng.chr] = len(self._chr_names)
+        self._chr_names.append(rng.chr)
+      chr = self._chrs[rng.chr]
+      start = rng.start
+      end = rng.end
+    sp = self._spools
+    sp['filestart'].write(struct.pack('<Q',filestart))
+    sp['innerstart'].write(struct.pack('<I',innerstart))
+    sp['flag'].write(struct.pack('<H',flag))
+    sp['basecount'].write(struct.pack('<I',basecount))
+    sp['chr'].write(struct.pack('<i',chr))
+    sp['start'].write(struct.pack('<I',start))
+    sp['end'].write(struct.pack('<I',end))
+    sp['names'].write(qname)
+    self._name_bytes += len(qname)
+    sp['nameoffs'].write(struct.pack('<Q',self._name_bytes))
+    h = zlib.crc32(qname) & 0xffffffff
+    bucket = self._hash_buckets[h >> 24]
+    bucket.append((h << 32) | self._n)
+    if len(bucket) >= self._bucket_size: self._spool_bucket(h >> 24)
+    if flag & 2304 == 0:
+      sp['primary'].write(struct.pack('<I',self._n))
+      self._primary += 1
+    self._n += 1
+  def _spool_bucket(self,i):
+    self._hash_segments[i].append([self._hash_spool.tell(),len(self._hash_buckets[i])])
+    self._hash_buckets[i].tofile(self._hash_spool)
+    self._hash_buckets[i] = array(_hash_code)
+  # Post: the sorted keys of bucket i, read back from the spool
+  def _sorted_bucket(self,i):
+    keys = array(_hash_code)
+    for [offset,count] in self._hash_segments[i]:
+      self._hash_spool.seek(offset)
+      keys.fromfile(self._hash_spool,count)
+    keys.extend(self._hash_buckets[i])
+    self._hash_buckets[i] = None
+    keys = array(_hash_code,sorted(keys))
+    if sys.byteorder != 'little': keys.byteswap()
+    return keys
+  def close(self):
+    of = open(self.index_file,'wb')
+    of.write('\0'*_index_header.size)
+    offsets = []
+    for [name,code] in _index_sections:
+      offsets.append(of.tell())
+      if name == 'namehash':
+        # buckets are split on the top byte of the hash so sorting
+        # them in turn gives the whole table in order
+        for i in range(0,256):
+          self._sorted_bucket(i).tofile(of)
+        self._hash_buckets = None
+        self._hash_spool.close()
+      elif name == 'chrs':
+        of.write("\n".join(self._chr_names))
+      else:
+        spool = self._spools[name]
+        spool.seek(0)
+        while True:
+          buf = spool.read(1000000)
+          if not buf: break
+          of.write(buf)
+        spool.close()
+    offsets.append(of.tell())
+    of.seek(0)
+    of.write(_index_header.pack(_index_magic,_index_version,self._n,self._primary,*offsets[:-1]))
+    of.close()
+
+# Query a binary index through a memory map
+# Opening is constant time and nothing is read until it is asked for
+class MappedBAMIndex:
+  def __init__(self,index_file):
+    self.index_file = index_file
+    self._fh = open(index_file,'rb')
+    self._mm = mmap.mmap(self._fh.fileno(),0,access=mmap.ACCESS_READ)
+    v = _index_header.unpack_from(self._mm,0)
+    if v[0] != _index_magic or v[1] != _index_version:
+      sys.stderr.write("ERROR: not a supported binary index "+index_file+"\n")
+      sys.exit()
+    self._n = v[2]
+    self._primary_count = v[3]
+    self._offsets = dict(zip([x[0] for x in _index_sections],v[4:]))
+    self._columns = {}
+    for [name,code] in _index_sections:
+      if not code: continue
+      length = self._n
+      if name == 'nameoffs': length = self._n+1
+      elif name == 'primary': length = self._primary_count
+      self._columns[name] = _MappedColumn(self._mm,self._offsets[name],code,length)
+    chr_text = self._mm[self._offsets['chrs']:len(self._mm)]
+    self._chr_names = []
+    if len(chr_text) > 0: self._chr_names = chr_text.split("\n")
+  def destroy(self):
+    self._columns = None
+    self._mm.close()
+    self._fh.close()
+  def get_length(self):
+    return self._n
+  def get_primary_length(self):
+    return self._primary_count
+  # Post: the zero-indexed entry number of the nth primary alignment
+  def get_primary_entry(self,i):
+    return self._columns['primary'][i]
+  def get_qname(self,i):
+    offs = self._columns['nameoffs']
+    base = self._offsets['names']
+    return self._mm[base+offs[i]:base+offs[i+1]]
+  def get_coord(self,i):
+    return [self._columns['filestart'][i],self._columns['innerstart'][i]]
+  def get_flag(self,i):
+    return self._columns['flag'][i]
+  def get_range_string(self,i):
+    chr = self._columns['chr'][i]
+    if chr < 0: return ''
+    return self._chr_names[chr]+':'+str(self._columns['start'][i])+'-'+str(self._columns['end'][i])
+  # Post: a dict like the lines of the TSV index
+  def get_entry(self,i):
+    c = self._columns
+    return {'qname':self.get_qname(i),'rng_str':self.get_range_string(i),'filestart':c['filestart'][i],'innerstart':c['innerstart'][i],'basecount':c['basecount'][i],'flag':c['flag'][i]}
+  # Post: zero-indexed entry numbers for a qname in file order
+  def get_entries_by_name(self,name):
+    h = zlib.crc32(name) & 0xffffffff
+    table = self._columns['namehash']
+    i = bisect.bisect_left(table,h << 32)
+    found = []
+    while i < len(table):
+      key = table[i]
+      if key >> 32 != h: break
+      entry = key & 0xffffffff
+      if self.get_qname(entry) == name: found.append(entry)
+      i += 1
+    return found
+  # Post: zero-indexed entry number at a coordinate or None
+  #       entries are in file order so coordinates are sorted
+  def get_entry_by_coord(self,coord):
+    fs = self._columns['filestart']
+    ins = self._columns['innerstart']
+    i = bisect.bisect_left(fs,coord[0])
+    while i < self._n and fs[i] == coord[0]:
+      if ins[i] == coord[1]: return i
+      if ins[i] > coord[1]: return None
+      i += 1
+    return None
+  def get_names(self):
+    seen = set()
+    names = []
+    for i in range(self._n):
+      name = self.get_qname(i)
+      if name in seen: continue
+      seen.add(name)
+      names.append(name)
+    return names
 
 # Index file is a gzipped TSV file with these fields:
 # 1. qname
@@ -20,9 +250,15 @@ from Bio.Format.Sam import BAMFile
 # when the methods requring them are called the first time
 # This class is actually incredibly bulky for working with a big index
 # > 1M reads.  I think some more specific cases may need to be written
+# A binary index is memory mapped instead (see MappedBAMIndex) and the
+# same methods answer from it, so big indexes open instantly
 class BAMIndex:
   def __init__(self,index_file):
     self.index_file = index_file
+    self._mapped = None
+    if is_binary_index(index_file):
+      self._mapped = MappedBAMIndex(index_file)
+      return
     self._name_to_num = {} #name index to line number
     self._lines = []
     self._coords = {} # get the one indexed line number from coordinates
@@ -42,6 +278,10 @@ class BAMIndex:
     return
 
   def destroy(self):
+    if self._mapped:
+      self._mapped.destroy()
+      self._mapped = None
+      return
     self._name_to_num = None
     self._lines = None
     self._coords = None
@@ -70,9 +310,11 @@ class BAMIndex:
 
   # Return how many entries have been indexed
   def get_length(self):
+    if self._mapped: return self._mapped.get_length()
     return len(self._lines)
 
   def get_names(self):
+    if self._mapped: return self._mapped.get_names()
     return self._name_to_num.keys()
 
   def get_coords_by_name(self,name):
@@ -83,6 +325,11 @@ class BAMIndex:
   def get_longest_target_alignment_coords_by_name(self,name):
     longest = -1
     coord = None
+    if self._mapped:
+      for i in self._mapped.get_entries_by_name(name):
+        if self._mapped.get_flag(i) & 2304 == 0:
+          return self._mapped.get_coord(i)
+      return None
     #for x in self._queries[self._name_to_num[name]]:
     for line in [self._lines[x] for x in self._name_to_num[name]]:
       if line['flag'] & 2304 == 0: 
@@ -96,13 +343,18 @@ class BAMIndex:
     if lnum < 1: 
       sys.stderr.write("ERROR: line number should be greater than zero\n")
       sys.exit()
-    elif lnum > len(self._lines):
+    elif lnum > self.get_length():
       sys.stderr.write("ERROR: too far this line nuber is not in index\n")
       sys.exit()  
+    if self._mapped: return self._mapped.get_entry(lnum-1)
     return self._lines[lnum-1]
 
   # return the one-indexed line number given the coordinates
   def get_coord_line_number(self,coord):
+    if self._mapped:
+      i = self._mapped.get_entry_by_coord(coord)
+      if i is None: return None
+      return i+1
     if coord[0] in self._coords:
       if coord[1] in self._coords[coord[0]]:
         return self._coords[coord[0]][coord[1]]
@@ -149,19 +401,26 @@ class BAMIndexRandomAccessPrimary:
     self.verbose=verbose
     self.alignment_file = None
     if alignment_file: self.alignment_file = alignment_file
-    elif os.path.exists(input_index):
-      if os.path.exists(input_index[:-4]):
-        self.alignment_file = input_index[:-4]
+    elif index_file and os.path.exists(index_file):
+      if os.path.exists(index_file[:-4]):
+        self.alignment_file = index_file[:-4]
     self.index_file = None
     if index_file: self.index_file = index_file
     elif self.alignment_file:
       if os.path.exists(self.alignment_file+'.bgi'):
         self.index_file = self.alignment_file+'.bgi'
-    if not index_file:
+    if not self.index_file:
       sys.stderr.write("ERROR: Someway and somehow you need to define an index file.  Either through an alignment with one or directly or both\n")
       sys.exit()
-    fh = gzip.open(index_file)
+    self._mapped = None
     self.bests = []
+    if is_binary_index(self.index_file):
+      # primaries are already listed in the index
+      self._mapped = MappedBAMIndex(self.index_file)
+      if self.verbose:
+        sys.stderr.write(str(self._mapped.get_primary_length())+'/'+str(self._mapped.get_length())+' primary alignments read'+"\n")
+      return
+    fh = gzip.open(self.index_file)
     z = 0
     tot = 0
     for line in fh:
@@ -178,8 +437,14 @@ class BAMIndexRandomAccessPrimary:
     return
   def destroy(self):
     self.bests = []
+    if self._mapped:
+      self._mapped.destroy()
+      self._mapped = None
     return
   def get_random_coord(self):
+    if self._mapped:
+      i = random.randint(0,self._mapped.get_primary_length()-1)
+      return self._mapped.get_coord(self._mapped.get_primary_entry(i))
     return random.choice(self.bests)
   #def get_alignment(self):
   #  if not self.alignment_file:
@@ -193,115 +458,135 @@ def check_flag(flag,inbit):
   if flag & inbit: return True
   return False
       
-# Index file is a gzipped TSV file with these fields:
+# Index file is the binary format described at the top
+# or with binary=False a gzipped TSV file with these fields:
 # 1. qname
 # 2. target range
 # 3. bgzf file block start
 # 4. bgzf inner block start
 # 5. aligned base count
 # 6. flag
-def write_index(path,index_file,verbose=False,samtools=False):
-  if verbose:
-    sys.stderr.write("scanning for primaries\n")
-  reads = {}
-  z = 0
-  # force use of primary alignment flag if its not already used
-  # require one and only one primary alignment for each read (or mate)
-  fail_primary = False
+# The alignment file is read only once.  Every entry is spooled to a
+# temporary file with its coordinates, and a copy of what is needed to
+# choose primaries is split by name hash into partitions.  Primaries
+# (or the best alignment per read when they are not set properly) are
+# then resolved one partition at a time, so only a fraction of the read
+# names are ever held in memory.
+def write_index(path,index_file,verbose=False,samtools=False,binary=True,partitions=64):
+  spool = TemporaryFile()
+  parts = [TemporaryFile() for i in range(partitions)]
+  chrs = {}
+  chr_names = []
   b2 = None
   if samtools:
     b2 = SamtoolsBAMStream(path)
   else:
     b2 = BAMFile(path)
-
+  z = 0
   for e in b2:
-    z+=1
     if verbose:
-      if z %1000==0: sys.stderr.write(str(z)+"\r")
+      if z %1000==0: sys.stderr.write(str(z)+" reads scanned\r")
     name = e.value('qname')
-    if name not in reads:
-      reads[name] = {}
-    type = 'u'
+    flag = e.value('flag')
+    type = 0 # unpaired
     if e.check_flag(64):
-      type = 'l' #left mate
+      type = 1 #left mate
     elif e.check_flag(128):
-      type = 'r' #right mate
-    if not e.check_flag(2304):
-      if type not in reads[name]: reads[name][type] = 0
-      reads[name][type] += 1 # we have one
-      if reads[name][type] > 1: 
-        fail_primary = True
-        break # too many primaries set to be useful
-  # see if we have one primary set for each read
-  for name in reads:
-    for type in reads[name]:
-      if reads[name][type] != 1:
-        fail_primary = True
+      type = 2 #right mate
+    rng = e.get_target_range()
+    l = 0
+    chr = -1
+    start = 0
+    end = 0
+    if rng:
+      l = e.get_aligned_bases_count()
+      if rng.chr not in chrs:
+        chrs[rng.chr] = len(chr_names)
+        chr_names.append(rng.chr)
+      chr = chrs[rng.chr]
+      start = rng.start
+      end = rng.end
+    spool.write(_spool_entry.pack(e.get_block_start(),e.get_inner_start(),flag,l,chr,start,end,len(name))+name)
+    parts[(zlib.crc32(name) & 0xffffffff) % partitions].write(_spool_part.pack(z,type,flag,l,len(name))+name)
+    z += 1
   if verbose:
-    sys.stderr.write("\n")
-  if fail_primary:
-    sys.stderr.write("Failed to find a single primary for each read (or each mate).  Reading through bam to find best.\n")
-    best = {}
-    # must find the primary for each
-
-    b2 = None
-    if samtools:
-      b2 = SamtoolsBAMStream(path)
-    else:
-      b2 = BAMFile(path)
-    z = 0
-    for e in b2:
-      z += 1
-      if verbose:
-        if z %1000==0: sys.stderr.write(str(z)+"\r")
-      name = e.value('qname')
-      type = 'u'
-      if e.check_flag(64):
-        type = 'l' #left mate
-      elif e.check_flag(128):
-        type = 'r' #right mate
-      if name not in best: best[name] = {}
-      # get length
-      l = 0
-      if e.is_aligned():
-        l = e.get_aligned_bases_count()
-      if type not in best[name]: best[name][type] = {'line':z,'bpcnt':l}
-      if l > best[name][type]['bpcnt']: 
-        best[name][type]['bpcnt'] = l
-        best[name][type]['line'] = z
-    bestlinenumbers = set()
-    for name in best:
-      for type in best[name]:
-        bestlinenumbers.add(best[name][type]['line'])
-    if verbose:
-      sys.stderr.write("\n")
+    sys.stderr.write(str(z)+" reads scanned\n")
+  # force use of primary alignment flag if its not already used
+  # require one and only one primary alignment for each read (or mate)
+  best = _resolve_primaries(parts,z)
+  for part in parts: part.close()
+  if best is not None:
+    sys.stderr.write("Failed to find a single primary for each read (or each mate).  Using the alignment with the most aligned bases as the best.\n")
   of = None
   try:
-    of = gzip.open(index_file,'w')
+    if binary: of = BinaryIndexWriter(index_file)
+    else: of = gzip.open(index_file,'w')
   except IOError:
-    sys.sterr.write("ERROR: could not find or create index\n")
+    sys.stderr.write("ERROR: could not find or create index\n")
     sys.exit()
-
-
-  b2 = None
-  if samtools:
-    b2 = SamtoolsBAMStream(path)
-  else:
-    b2 = BAMFile(path)
+  spool.seek(0)
   z = 0
-  for e in b2:
-    z+=1
+  for [filestart,innerstart,myflag,l,chr,start,end,name] in _read_spool(spool,_spool_entry):
     if verbose:
       if z%1000==0:
         sys.stderr.write(str(z)+" reads indexed\r")
-    myflag = e.value('flag')
-    if fail_primary: # see if this should be a primary
-      if z not in bestlinenumbers:
-        myflag = myflag | 2304
-    rng = e.get_target_range()
-    if rng: 
-      l = e.get_aligned_bases_count()
-      of.write(e.value('qname')+"\t"+rng.get_range_string()+"\t"+str(e.get_block_start())+"\t"+str(e.get_inner_start())+"\t"+str(l)+"\t"+str(myflag)+"\n")
-    else: of.write(e.value('qname')+"\t"+''+"\t"+str(e.get_block_start())+"\t"+str(e.get_inner_start())+"\t"+'0'+"\t"+str(myflag)+"\n")
+    if best is not None and not best[z]: # see if this should be a primary
+      myflag = myflag | 2304
+    z += 1
+    rng = None
+    if chr >= 0: rng = GenomicRange(chr_names[chr],start,end)
+    if binary:
+      of.add(name,rng,filestart,innerstart,l,myflag)
+    elif rng: 
+      of.write(name+"\t"+rng.get_range_string()+"\t"+str(filestart)+"\t"+str(innerstart)+"\t"+str(l)+"\t"+str(myflag)+"\n")
+    else: of.write(name+"\t"+''+"\t"+str(filestart)+"\t"+str(innerstart)+"\t"+'0'+"\t"+str(myflag)+"\n")
+  spool.close()
   sys.stderr.write("\n")
   of.close()
+
+# Spooled entries for write_index, each followed by the qname
+# filestart, innerstart, flag, basecount, chr, start, end, qname length
+_spool_entry = struct.Struct('<QIHIiIIH')
+# entry number, mate type, flag, basecount, qname length
+_spool_part = struct.Struct('<IBHIH')
+
+# Pre: a spool file positioned at its start and the struct of its entries
+# Post: generate each entry as a list of its fields with the qname last
+def _read_spool(fh,entry_struct):
+  while True:
+    head = fh.read(entry_struct.size)
+    if len(head) < entry_struct.size: return
+    v = list(entry_struct.unpack(head))
+    v[-1] = fh.read(v[-1])
+    yield v
+
+# Pre: partition spools of entries split by qname, and the entry count
+# Post: None if every read (or mate) has at most one primary alignment
+#       otherwise a bytearray with a 1 for the entry to use as each
+#       read's (or mate's) best, the first one with the most aligned bases
+def _resolve_primaries(parts,count):
+  fail_primary = False
+  for part in parts:
+    part.seek(0)
+    reads = {}
+    for [num,type,flag,l,name] in _read_spool(part,_spool_part):
+      if flag & 2304: continue
+      key = (name,type)
+      if key not in reads: reads[key] = 0
+      reads[key] += 1
+      if reads[key] > 1:
+        fail_primary = True
+        break # too many primaries set to be useful
+    if fail_primary: break
+  if not fail_primary: return None
+  best = bytearray(count)
+  for part in parts:
+    part.seek(0)
+    reads = {}
+    for [num,type,flag,l,name] in _read_spool(part,_spool_part):
+      key = (name,type)
+      if key not in reads or l > reads[key][1]:
+        reads[key] = [num,l]
+    for [num,l] in reads.values():
+      best[num] = 1
+  return best
@@ -1,4 +1,4 @@
-import sys, uuid
+import sys
 import Bio.Structure
 from Bio.Range import GenomicRange
 
@@ -33,7 +33,7 @@ class Bed12(Bio.Structure.Transcript):
         junc.set_exon_right(self.exons[i+1])
         self.junctions.append(junc)
     self._range = GenomicRange(self.value('chrom'),self.value('chromStart')+1,self.value('chromEnd'))
-    self._id = str(uuid.uuid4())
+    self._id = None
     self._sequence = None
   def __str__(self):
     return self.get_bed_line()  
@@ -1,4 +1,6 @@
-import os, re, gzip
+import os, re, gzip, sys, struct, mmap, binascii
+from string import maketrans
+from collections import OrderedDict
 import Bio.Sequence
 
 #Iterable Stream
@@ -112,42 +114,58 @@ class FastaData:
 #          Slices are same as array - zero indexed
 # Post: Makes index if doesn't exist upon being called.
 #       Can access sequence
+#       Reads are at least window_size bases and the last cache_size
+#       windows are kept, so nearby requests (like the exons of a
+#       transcript) share one read
 # Modifies: File IO reads the fasta, and writes a fasta index file
 class FastaFile:
-  def __init__(self,fname,index=None):
+  def __init__(self,fname,index=None,window_size=100000,cache_size=16):
     self.fname = fname
     self.index = index
     self.fai = {}
+    self._window_size = window_size
+    self._cache_size = cache_size
+    self._cache = OrderedDict() # [chr,start,end] of a window to its bases, oldest first
     if not self.index:
       if os.path.isfile(self.fname+'.fai'): self.index = self.fname+'.fai'
     if not self.index:
       sys.stderr.write("Warning no index trying to create\n")
       self._make_index()
-    self._read_index()
-    self.fh = open(fname)
+    if self.index: self._read_index()
+    self.fh = open(fname,'rb')
 
   def __getitem__(self,key):
-    chr = FastaFile.Chromosome(self,key)
-    if chr.sliced: return chr
-    return self.get_sequence(key)
+    if key not in self.fai: raise KeyError(key)
+    return FastaFile.Chromosome(self,key)
+
+  def __contains__(self,key):
+    return key in self.fai
+
+  def keys(self):
+    return self.fai.keys()
 
   class Chromosome:
     def __init__(self,outer,chr):
       self.outer = outer
       self.chr = chr
-      self.sliced = False
 
     def __getitem__(self,val):
-      self.sliced = True
-      if val.step:  
-        sys.stderr.write("ERROR: FastaFile doesn't support step access\n")
-        sys.exit()
-      clen = self.outer.fai[self.chr]['length']
-      return self.outer.get_sequence(self.chr,val.start+1,min(val.stop,clen))
+      if isinstance(val,slice):
+        if val.step:  
+          sys.stderr.write("ERROR: FastaFile doesn't support step access\n")
+          sys.exit()
+        [start,end,step] = val.indices(len(self))
+        return self.outer._fetch(self.chr,start,end)
+      if val < 0: val += len(self)
+      if val < 0 or val >= len(self): raise IndexError('index out of range')
+      return self.outer._fetch(self.chr,val,val+1)
 
     def __len__(self):
       return self.outer.fai[self.chr]['length']
 
+    def __str__(self):
+      return self.outer._fetch(self.chr,0,len(self))
+
   def get_sequence(self,chr=None,start=None,end=None,dir=None,rng=None):
     if rng: 
       chr = rng.chr
@@ -157,59 +175,321 @@ class FastaFile:
     if not start: start = 1
     if not end: end = self.fai[chr]['length']
     if not dir: dir = '+'
-    [sblocks,srem] = divmod(start,self.fai[chr]['linebases'])
-    missing_start = sblocks*(self.fai[chr]['linewidth']-self.fai[chr]['linebases'])
-    [eblocks,erem] = divmod(end,self.fai[chr]['linebases'])
-    missing_end = eblocks*(self.fai[chr]['linewidth']-self.fai[chr]['linebases'])
-    pos_start = self.fai[chr]['offset']+start+missing_start-1
-    pos_end = self.fai[chr]['offset']+end+missing_end
-    self.fh.seek(pos_start)
-    v = self.fh.read(pos_end-pos_start).replace("\n",'')
+    v = self._fetch(chr,start-1,end)
     if dir == '-':
       return Bio.Sequence.rc(v)
     return v
 
+  # Pre: list of GenomicRange (one indexed)
+  # Post: list of their sequences in the same order
+  #       Requests are sorted by file position and those within
+  #       window_size of each other are served from a single read of
+  #       at most max_read bases
+  def get_sequences(self,rngs,max_read=10000000):
+    output = [None]*len(rngs)
+    order = sorted(range(len(rngs)),key=lambda i: [self.fai[rngs[i].chr]['offset'],rngs[i].start])
+    i = 0
+    while i < len(order):
+      chr = rngs[order[i]].chr
+      start = rngs[order[i]].start-1
+      end = rngs[order[i]].end
+      j = i+1
+      while j < len(order):
+        r = rngs[order[j]]
+        if r.chr != chr or r.start-1 > end+self._window_size or r.end-start > max_read: break
+        end = max(end,r.end)
+        j += 1
+      window = self._read(chr,start,end)
+      for k in order[i:j]:
+        v = window[rngs[k].start-1-start:rngs[k].end-start]
+        if rngs[k].direction == '-': v = Bio.Sequence.rc(v)
+        output[k] = v
+      i = j
+    return output
+
+  # Pre: zero indexed half open coordinates
+  # Post: the bases, from a cached window when one covers them
+  def _fetch(self,chr,start,end):
+    end = min(end,self.fai[chr]['length'])
+    if start >= end: return ''
+    for key in reversed(self._cache):
+      if key[0] == chr and key[1] <= start and end <= key[2]:
+        v = self._cache.pop(key)
+        self._cache[key] = v
+        return v[start-key[1]:end-key[1]]
+    if end-start > self._window_size:
+      return self._read(chr,start,end) # too big to be worth keeping
+    wend = min(start+self._window_size,self.fai[chr]['length'])
+    v = self._read(chr,start,wend)
+    self._cache[(chr,start,wend)] = v
+    if len(self._cache) > self._cache_size: self._cache.popitem(last=False)
+    return v[0:end-start]
+
+  # Post: byte position in the file of a zero indexed base
+  def _byte_offset(self,chr,pos):
+    f = self.fai[chr]
+    [lines,col] = divmod(pos,f['linebases'])
+    return f['offset']+lines*f['linewidth']+col
+
+  # Pre: zero indexed half open coordinates
+  # Post: the bases with one seek and read
+  def _read(self,chr,start,end):
+    end = min(end,self.fai[chr]['length'])
+    if start >= end: return ''
+    pos_start = self._byte_offset(chr,start)
+    pos_end = self._byte_offset(chr,end-1)+1
+    self.fh.seek(pos_start)
+    return self.fh.read(pos_end-pos_start).translate(None,"\r\n")
+
   def _read_index(self):
     with open(self.index) as inf:
       for line in inf:
-        v = line.rstrip().split("\t")
-        self.fai[v[0]] = {}
-        self.fai[v[0]]['name'] = v[0]
-        self.fai[v[0]]['length'] = int(v[1])
-        self.fai[v[0]]['offset'] = int(v[2])
-        self.fai[v[0]]['linebases'] = int(v[3])
-        self.fai[v[0]]['linewidth'] = int(v[4])
+        self._add_index_entry(line.rstrip().split("\t"))
+
+  # Pre: [name, length, offset, line bases, line bytes] as in a .fai
+  def _add_index_entry(self,v):
+    self.fai[v[0]] = {}
+    self.fai[v[0]]['name'] = v[0]
+    self.fai[v[0]]['length'] = int(v[1])
+    self.fai[v[0]]['offset'] = int(v[2])
+    self.fai[v[0]]['linebases'] = int(v[3])
+    self.fai[v[0]]['linewidth'] = int(v[4])
 
+  # Write the .fai in one pass over the file, a line at a time
+  # Every sequence line but the last of each entry must be the same length
+  # Sequences are named by the first word of the header like samtools faidx
+  # If the .fai can't be written (say a read-only reference directory)
+  # the index is only kept in memory
   def _make_index(self):
     of = None
     try:
       of = open(self.fname+'.fai','w')
+      self.index = self.fname+'.fai'
     except IOError:
-      sys.stderr.write("ERROR: could not open file\n")
-      sys.exit()
-    self.index = self.fname+'.fai'
-    # now we can parse the file
-    p1 = re.compile('>([^\r\n]+)([\n\r]+)([^>]+)')
-    p2 = re.compile('([^\r\n]+)($|[\n\r]+)')
+      sys.stderr.write("Warning could not write "+self.fname+".fai, indexing in memory\n")
     pos = 0
-    for m1 in p1.finditer(open(self.fname).read()):
-      name = m1.group(1)
-      pos += len(m1.group(1))+1+len(m1.group(2))
-      linewidth_bases = None
-      linewidth_bytes = None
-      seqlen = 0
-      nextoffset = len(m1.group(3))
-      for m2 in p2.finditer(m1.group(3)):
-        if not linewidth_bases: linewidth_bases = len(m2.group(1))
-        elif linewidth_bases != len(m2.group(1)) and len(m2.group(2)) > 0:
-          sys.stderr.write("ERROR: irregular line breaks\n")
+    entry = None # [name, length, offset, line bases, line bytes, last line seen]
+    with open(self.fname,'rb') as inf:
+      for line in inf:
+        if line[0] == '>':
+          if entry: self._index_entry(of,entry)
+          name = line[1:].split(None,1)
+          if len(name) > 0: name = name[0]
+          else: name = ''
+          entry = [name,0,pos+len(line),0,0,False]
+        elif entry:
+          bases = len(line.rstrip("\r\n"))
+          if bases == 0:
+            if entry[1] == 0: entry[2] = pos+len(line) # blank lines before the sequence
+          elif entry[5] or (entry[3] and bases > entry[3]):
+            sys.stderr.write("ERROR: irregular line breaks\n")
+            sys.exit()
+          else:
+            if not entry[3]:
+              entry[3] = bases
+              entry[4] = len(line)
+            elif bases != entry[3] or len(line) != entry[4]:
+              entry[5] = True # only the last line can differ
+            entry[1] += bases
+        pos += len(line)
+    if entry: self._index_entry(of,entry)
+    if of: of.close()
+
+  # Write an entry to the .fai, or when there is none keep it in memory
+  def _index_entry(self,of,entry):
+    if not of:
+      self._add_index_entry(entry)
+      return
+    of.write(entry[0] + "\t" + str(entry[1]) + "\t"+str(entry[2]) + "\t" + str(entry[3]) + "\t" + str(entry[4])+"\n")
+
+# Packed reference file (written by write_packed_fasta)
+# Bases are stored 2 bits each so a genome can be memory mapped and
+# shared read-only by many processes.  Everything little-endian.
+#  header: magic 'PFA\x01', version, sequence count
+#          then the byte offset of each section in _packed_sections order
+#  packed  every sequence 2-bit packed A=0 C=1 G=2 T=3, first base in the
+#          high bits, each sequence starting on a new byte
+#  table   per sequence uint64 length, packed byte offset, first N run,
+#          N run count, first mask run, mask run count
+#  runs    uint64 start, end pairs (0-based, half open) of N runs
+#          (any base other than ACGT) and lower case mask runs
+#  names   newline separated sequence names
+# Bases other than ACGTN come back as N.
+_packed_magic = 'PFA\x01'
+_packed_version = 1
+_packed_sections = ['packed','table','runs','names']
+_packed_header = struct.Struct('<4sIQ'+'Q'*len(_packed_sections))
+_packed_table = struct.Struct('<6Q')
+_packed_run = struct.Struct('<2Q')
+_pack_digits = maketrans('ACGTacgt','01230123')
+_pack_other = re.compile('[^0-3]')
+_byte_bases = [''.join(['ACGT'[(b>>s)&3] for s in [6,4,2,0]]) for b in range(0,256)]
+
+# Pre: first bytes of a file
+# Post: True if it is a packed reference
+def is_packed_fasta(data):
+  return data[0:4] == _packed_magic
+
+# Pre: sequence string with a length that is a multiple of 4
+# Post: the 2-bit packed bytes (non-ACGT are packed as A)
+def _pack_bases(seq):
+  if len(seq) == 0: return ''
+  digits = _pack_other.sub('0',seq.translate(_pack_digits))
+  # read as one base-4 number and write it back out as hex
+  return binascii.unhexlify(('%x' % int(digits,4)).zfill(len(digits)/2))
+
+# Pre: filename to write, iterable of Bio.Sequence.Seq
+#      like a FastaHandle
+# Post: writes the packed reference
+def write_packed_fasta(filename,seqs,chunk_size=4000000):
+  of = open(filename,'wb')
+  of.write('\0'*_packed_header.size)
+  offsets = [of.tell()]
+  table = []
+  runs = []
+  names = []
+  for s in seqs:
+    seq = s.seq.replace("\n",'').replace("\r",'')
+    names.append(s.name)
+    nfirst = len(runs)
+    runs += [[m.start(),m.end()] for m in re.finditer('[^ACGTacgt]+',seq)]
+    mfirst = len(runs)
+    runs += [[m.start(),m.end()] for m in re.finditer('[a-z]+',seq)]
+    table.append([len(seq),of.tell()-offsets[0],nfirst,mfirst-nfirst,mfirst,len(runs)-mfirst])
+    for i in range(0,len(seq),chunk_size):
+      chunk = seq[i:i+chunk_size]
+      of.write(_pack_bases(chunk+'A'*(-len(chunk)%4)))
+  offsets.append(of.tell())
+  for row in table: of.write(_packed_table.pack(*row))
+  offsets.append(of.tell())
+  for [start,end] in runs: of.write(struct.pack('<QQ',start,end))
+  offsets.append(of.tell())
+  of.write("\n".join(names))
+  of.seek(0)
+  of.write(_packed_header.pack(_packed_magic,_packed_version,len(names),*offsets))
+  of.close()
+
+# Read a packed reference through a memory map
+# Has the FastaData access of ref[chr][start:end] (zero indexed),
+# len(ref[chr]) and get_sequence (one indexed)
+class PackedFastaFile:
+  def __init__(self,fname):
+    self._fh = open(fname,'rb')
+    self._data = mmap.mmap(self._fh.fileno(),0,access=mmap.ACCESS_READ)
+    v = _packed_header.unpack_from(self._data,0)
+    if v[0] != _packed_magic or v[1] != _packed_version:
+      sys.stderr.write("ERROR: not a supported packed reference\n")
+      sys.exit()
+    n = v[2]
+    self._offsets = dict(zip(_packed_sections,v[3:]))
+    self._names = self._data[self._offsets['names']:len(self._data)].split("\n")
+    if n == 0: self._names = []
+    self._table = {}
+    for i in range(0,n):
+      self._table[self._names[i]] = _packed_table.unpack_from(self._data,self._offsets['table']+i*_packed_table.size)
+
+  def close(self):
+    self._data.close()
+    self._fh.close()
+
+  def keys(self):
+    return self._names[:]
+
+  def get_names(self):
+    return self._names[:]
+
+  def __contains__(self,key):
+    return key in self._table
+
+  def __getitem__(self,key):
+    if key not in self._table: raise KeyError(key)
+    return PackedFastaFile.Chromosome(self,key)
+
+  class Chromosome:
+    def __init__(self,outer,chr):
+      self.outer = outer
+      self.chr = chr
+
+    def __getitem__(self,val):
+      if isinstance(val,slice):
+        if val.step:  
+          sys.stderr.write("ERROR: PackedFastaFile doesn't support step access\n")
           sys.exit()
-        if not linewidth_bytes: linewidth_bytes = len(m2.group(1))+len(m2.group(2))
-        elif linewidth_bytes != len(m2.group(1))+len(m2.group(2)) and len(m2.group(2)) > 0:
-          sys.stderr.write("ERROR: irregular bytes line breaks\n")
-          sys.exit() 
-        seqlen += len(m2.group(1))      
-      of.write(name + "\t" + str(seqlen) + "\t"+str(pos)+"\t" + str(linewidth_bases) + "\t" + str(linewidth_bytes)+"\n")
-      pos += nextoffset
-    of.close()
+        [start,end,step] = val.indices(len(self))
+        return self.outer._slice(self.chr,start,end)
+      if val < 0: val += len(self)
+      if val < 0 or val >= len(self): raise IndexError('index out of range')
+      return self.outer._slice(self.chr,val,val+1)
+
+    def __len__(self):
+      return self.outer._table[self.chr][0]
+
+    def __str__(self):
+      return self.outer._slice(self.chr,0,len(self))
+
+  def get_sequence(self,chr=None,start=None,end=None,dir=None,rng=None):
+    if rng: 
+      chr = rng.chr
+      start = rng.start
+      end = rng.end
+      dir = rng.direction
+    if not start: start = 1
+    if not end: end = self._table[chr][0]
+    if not dir: dir = '+'
+    seq = self._slice(chr,start-1,end)
+    if dir == '-':
+      return Bio.Sequence.rc(seq)
+    return seq
+
+  # Pre: 0-based half open coordinates inside the sequence
+  def _slice(self,chr,start,end):
+    [length,offset,nfirst,ncount,mfirst,mcount] = self._table[chr]
+    end = min(end,length)
+    if start >= end: return ''
+    base = self._offsets['packed']+offset
+    b0 = start/4
+    b1 = (end+3)/4
+    seq = ''.join(map(_byte_bases.__getitem__,bytearray(self._data[base+b0:base+b1])))
+    seq = seq[start-4*b0:end-4*b0]
+    if ncount == 0 and mcount == 0: return seq
+    runs = self._offsets['runs']
+    seq = _apply_runs(seq,start,end,self._data,runs+nfirst*_packed_run.size,ncount,lambda x: 'N'*len(x))
+    return _apply_runs(seq,start,end,self._data,runs+mfirst*_packed_run.size,mcount,lambda x: x.lower())
+
+# Pre: seq covering start to end, the mapped data with the byte offset
+#      and count of a sorted non-overlapping run table in it, and a
+#      function to change the bases of a run
+# Post: seq with the parts inside the runs changed
+#       The run table is searched in place so nothing of it is copied
+#       into each process that maps the file
+def _apply_runs(seq,start,end,data,base,count,change):
+  # bisect for the last run starting at or before start
+  lo = 0
+  hi = count
+  while lo < hi:
+    mid = (lo+hi)/2
+    if start < _packed_run.unpack_from(data,base+mid*_packed_run.size)[0]: hi = mid
+    else: lo = mid+1
+  i = max(0,lo-1)
+  pieces = []
+  pos = start
+  while i < count:
+    [rstart,rend] = _packed_run.unpack_from(data,base+i*_packed_run.size)
+    if rstart >= end: break
+    rstart = max(rstart,start)
+    rend = min(rend,end)
+    if rend > rstart:
+      pieces.append(seq[pos-start:rstart-start])
+      pieces.append(change(seq[rstart-start:rend-start]))
+      pos = rend
+    i += 1
+  if pos == start: return seq
+  pieces.append(seq[pos-start:])
+  return ''.join(pieces)
 
+# Pre: a fasta (may be gzipped) or packed reference file name
+# Post: a PackedFastaFile for a packed reference, otherwise FastaData
+def read_reference(fname):
+  with open(fname,'rb') as inf:
+    if is_packed_fasta(inf.read(4)): return PackedFastaFile(fname)
+  return FastaData(file=fname)
@@ -1,16 +1,17 @@
-import uuid, sys, time, re
+import sys, time, gzip
 import Bio.Structure
 from Bio.Range import GenomicRange
-from subprocess import Popen, PIPE
+from Bio.Sort import ExternalSort
 
 # This whole format is a subclass of the Transcript subclass
 class GPD(Bio.Structure.Transcript):
   def __init__(self,gpd_line):
-    # Only store the line and ID at first.  
+    # Only store the line and range at first.  The ID is made by get_id
+    # if it is ever asked for
     self._line = gpd_line.rstrip()
-    self._id = str(uuid.uuid4())
-    m = re.match('[^\t]+\t[^\t]+\t([^\t]+)\t[^\t]+\t([^\t]+)\t([^\t]+)',gpd_line)
-    self._range = GenomicRange(m.group(1),int(m.group(2))+1,int(m.group(3)))
+    self._id = None
+    f = gpd_line.split("\t",6)
+    self._range = GenomicRange(f[2],int(f[4])+1,int(f[5]))
     self._initialized = False
     # Most of GPD has not been set yet.  Each method accessing GPD
     # will need to check to see if initialize has been run
@@ -106,41 +107,19 @@ class GPDStream:
       return r
 
 class SortedOutputFile:
-  def __init__(self,filename,type='location',tempdir=None):
+  def __init__(self,filename,type='location',tempdir=None,threads=1):
     if type not in ['location','name']:
       sys.stderr.write("ERROR: must be type location or name\n")
       sys.exit()
-    self._gz = False
-    self._fh = open(filename,'w')
-    self._sh = None
-    if filename[-3:] == '.gz':
-      self._gz = True
-    self._pipes  = []
-    scmd = "sort -k1,1 -k2,2"
-    if type == 'location':
-      scmd = "sort -k3,3 -k5,5n -k6,6n -k4,4"
-    if tempdir: scmd += " -T "+tempdir.rstrip('/')+'/'
-    if self._gz:
-      cmd1 = "gzip"
-      p1 = Popen(cmd1.split(),stdout=self._fh,stdin=PIPE,close_fds=True)
-      p2 = Popen(scmd.split(),stdout=p1.stdin,stdin=PIPE,close_fds=True)
-      self._sh = p2.stdin
-      self._pipes = [p2,p1]
-    else:
-      p = Popen(scmd.split(),stdout=self._fh,stdin=PIPE)
-      self._sh = p.stdin
-      self._pipes = [p]
+    self._filename = filename
+    self._sorter = ExternalSort(format='gpd',order=type,tempdir=tempdir,threads=threads)
   def write(self,value):
-    self._sh.write(value)
+    self._sorter.write(value)
   def close(self):
-    #self._sh.flush()
-    #self._sh.close()
-    for p in self._pipes:
-      #p.stdin.flush()
-      #p.stdin.close()
-      p.communicate()
-    #self._pipes[0].stdin.flush()
-    #self._pipes[0].stdin.close()
-    #self._pipes[1].stdin.flush()
-    #self._pipes[1].stdin.close()
-    self._fh.close()
+    if self._filename[-3:] == '.gz':
+      of = gzip.open(self._filename,'w')
+    else:
+      of = open(self._filename,'w')
+    self._sorter.write_sorted(of)
+    of.close()
+    self._sorter.close()
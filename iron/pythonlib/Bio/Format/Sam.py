@@ -5,10 +5,24 @@ from Bio.Sequence import rc
 from cStringIO import StringIO
 from string import maketrans
 from Bio.Range import GenomicRange
+from Bio.Format.BGZF import reader as BGZF_reader
+from Bio.Format.BAI import BAI, BAIBuilder, virtual_offset, coord_from_virtual_offset
 from subprocess import Popen, PIPE
 _bam_ops = maketrans('012345678','MIDNSHP=X')
 _bam_char = maketrans('abcdefghijklmnop','=ACMGRSVTWYHKDBN')
 _bam_value_type = {'c':[1,'<b'],'C':[1,'<B'],'s':[2,'<h'],'S':[2,'<H'],'i':[4,'<i'],'I':[4,'<I']}
+_bam_ops_chars = 'MIDNSHP=X'
+_bam_seq_chars = '=ACMGRSVTWYHKDBN'
+# Precompiled decoders for the fixed part of an alignment record
+# refID, pos, bin_mq_nl, flag_nc, l_seq, next_refID, next_pos, tlen
+_bam_fixed = struct.Struct('<iiIIiiii')
+_bam_int = struct.Struct('<i')
+_bam_ushort = struct.Struct('<H')
+# Lookup tables so sequence and quality bytes are decoded a whole
+# string at a time by str.translate rather than byte by byte
+_bam_seq_high = ''.join([_bam_seq_chars[x >> 4] for x in range(256)])
+_bam_seq_low = ''.join([_bam_seq_chars[x & 0xF] for x in range(256)])
+_bam_qual_table = ''.join([chr((x+33) & 0xFF) for x in range(256)])
 _sam_cigar_target_add = re.compile('[M=XDN]$')
 
 # A sam entry
@@ -306,6 +320,66 @@ class BAM(SAM):
     return self._private_values.get_entry(key)
 
 
+# A BAM record that decodes nothing up front
+# Holds a memoryview of the record inside its decompressed block and reads
+# flag, refID, pos, mapq and qname straight from their fixed offsets.
+# Anything else (cigar, seq, qual, tags, ranges, ...) builds a full BAM
+# entry the first time it is asked for and hands the call to it.
+# Use through BAMFile(filename,lazy=True) for filters that only need
+# a few fields from each record
+class LazyBAM(object):
+  __slots__ = ['_data','_ref_names','_ref_lengths','_reference','_file_name','_block_start','_inner_start','_line_number','_bam']
+  def __init__(self,bin_data,ref_names,fileName=None,blockStart=None,innerStart=None,ref_lengths=None,reference=None,line_number=None):
+    if not isinstance(bin_data,memoryview): bin_data = memoryview(bin_data)
+    self._data = bin_data
+    self._ref_names = ref_names
+    self._ref_lengths = ref_lengths
+    self._reference = reference
+    self._file_name = fileName
+    self._block_start = blockStart
+    self._inner_start = innerStart
+    self._line_number = line_number
+    self._bam = None
+
+  def value(self,key):
+    if key == 'flag':
+      return _bam_ushort.unpack_from(self._data,14)[0]
+    elif key == 'qname':
+      l_read_name = ord(self._data[8])
+      return self._data[32:32+l_read_name-1].tobytes()
+    elif key == 'rname':
+      return self._ref_names[_bam_int.unpack_from(self._data,0)[0]]
+    elif key == 'pos':
+      return _bam_int.unpack_from(self._data,4)[0]+1
+    elif key == 'mapq':
+      return ord(self._data[9])
+    return self.get_bam().value(key)
+  def check_flag(self,inbit):
+    if self.value('flag') & inbit: return True
+    return False
+  def is_aligned(self):
+    return not self.check_flag(0x4)
+  def get_line_number(self):
+    return self._line_number
+  def get_filename(self):
+    return self._file_name
+  def get_coord(self):
+    return [self._block_start,self._inner_start]
+  def get_block_start(self):
+    return self._block_start
+  def get_inner_start(self):
+    return self._inner_start
+
+  # Post: the fully parsed BAM entry for this record (made once)
+  def get_bam(self):
+    if self._bam is None:
+      self._bam = BAM(self._data.tobytes(),self._ref_names,fileName=self._file_name,blockStart=self._block_start,innerStart=self._inner_start,ref_lengths=self._ref_lengths,reference=self._reference,line_number=self._line_number)
+    return self._bam
+  def __str__(self):
+    return str(self.get_bam())
+  def __getattr__(self,name):
+    return getattr(self.get_bam(),name)
+
 class SAMHeader:
   def __init__(self,header_text):
     self._text = header_text
@@ -332,10 +406,14 @@ class SAMHeader:
 # reference is a dict
 class BAMFile:
   #def __init__(self,filename,blockStart=None,innerStart=None,cnt=None,index_obj=None,index_file=None,reference=None):
-  def __init__(self,filename,blockStart=None,innerStart=None,cnt=None,reference=None):
+  # lazy=True yields LazyBAM records that only decode fields when asked
+  # threads greater than 1 decompresses blocks ahead on that many threads
+  # prefetch sets how many blocks are decompressed ahead
+  def __init__(self,filename,blockStart=None,innerStart=None,cnt=None,reference=None,lazy=False,threads=1,prefetch=None):
     self.path = filename
+    self._lazy = lazy
     self._reference = reference # dict style accessable reference
-    self.fh = BGZF(filename)
+    self.fh = BGZF(filename,threads=threads,prefetch=prefetch)
     self._line_number = 0 # entry line number ... after header.  starts with 1
     # start reading the bam file
     self.header_text = None
@@ -345,6 +423,9 @@ class BAMFile:
     self.ref_names = []
     self.ref_lengths = {}
     self._output_range = None
+    self._pending = [] # whole records already cut from the current block
+    self._pending_pos = 0
+    self._region_index = None
     #self.index = index_obj
     self._read_reference_information()
     # prepare for specific work
@@ -411,6 +492,18 @@ class BAMFile:
     else: return e
 
   def read_entry2(self):
+    if self._pending_pos >= len(self._pending):
+      # decode every whole record of the current block in one go
+      self._pending = self.fh.read_block_records(zero_copy=self._lazy)
+      self._pending_pos = 0
+    record_type = BAM
+    if self._lazy: record_type = LazyBAM
+    if self._pending_pos < len(self._pending):
+      [bstart,innerstart,data] = self._pending[self._pending_pos]
+      self._pending_pos += 1
+      self._line_number += 1
+      return record_type(data,self.ref_names,fileName=self.path,blockStart=bstart,innerStart=innerstart,ref_lengths=self.ref_lengths,reference=self._reference,line_number = self._line_number)
+    # the next record spans a block boundary so read it the slow way
     bstart = self.fh.get_block_start()
     innerstart = self.fh.get_inner_start()
     b = self.fh.read(4) # get block size bytes
@@ -418,7 +511,7 @@ class BAMFile:
     block_size = struct.unpack('<i',b)[0]
     #print 'block_size '+str(block_size)
     self._line_number += 1
-    bam = BAM(self.fh.read(block_size),self.ref_names,fileName=self.path,blockStart=bstart,innerStart=innerstart,ref_lengths=self.ref_lengths,reference=self._reference,line_number = self._line_number)
+    bam = record_type(self.fh.read(block_size),self.ref_names,fileName=self.path,blockStart=bstart,innerStart=innerstart,ref_lengths=self.ref_lengths,reference=self._reference,line_number = self._line_number)
     return bam
 
   def _set_output_range(self,rng):
@@ -434,13 +527,71 @@ class BAMFile:
   #  bf2.close()
   #  return bam
 
-  #def fetch_by_range(self,rng):
-  #  coord = self.index.get_range_start_coord(rng)
-  #  line_number = self.index.get_range_start_line_number(rng)
-  #  if not coord: return None
-  #  b2 = BAMFile(self.path,blockStart=coord[0],innerStart=coord[1],index_obj=self.index,reference=self._reference)
-  #  b2._set_output_range(rng)
-  #  return b2
+  # Pre: a GenomicRange
+  # Post: generate the aligned entries overlapping the range, in file order
+  #       Uses the region index (see get_region_index) to seek straight
+  #       to the blocks that can hold them
+  def fetch_by_range(self,rng):
+    if rng.chr not in self.ref_lengths: return
+    ref_id = self.ref_names.index(rng.chr)
+    chunks = self.get_region_index().get_chunks(ref_id,rng.start-1,rng.end)
+    if len(chunks) == 0: return
+    b2 = BAMFile(self.path,reference=self._reference,lazy=self._lazy)
+    for [cstart,cend] in chunks:
+      b2.seek(coord_from_virtual_offset(cstart))
+      while True:
+        e = b2.read_entry2()
+        if not e: break
+        if virtual_offset(e.get_coord()) >= cend: break
+        if not e.is_aligned(): continue
+        trng = e.get_target_range()
+        if trng.chr != rng.chr or trng.start > rng.end:
+          b2.close()
+          return
+        if trng.overlaps(rng): yield e
+    b2.close()
+
+  # Pre: (optional) index_file is a .bai to use
+  # Post: the BAI binning index for this file.  Without index_file the
+  #       file name plus .bai is read if it exists, otherwise one is built
+  #       by reading the whole file, which must be sorted by coordinate
+  def get_region_index(self,index_file=None):
+    if self._region_index: return self._region_index
+    if not index_file and os.path.exists(self.path+'.bai'):
+      index_file = self.path+'.bai'
+    if index_file: self._region_index = BAI(index_file)
+    else: self._region_index = self._build_region_index()
+    return self._region_index
+
+  # Build the region index and save it, by default as the file name plus .bai
+  def write_region_index(self,index_file=None):
+    if not index_file: index_file = self.path+'.bai'
+    self._region_index = self._build_region_index()
+    self._region_index.write(index_file)
+
+  def _build_region_index(self):
+    ref_ids = {}
+    for i in range(len(self.ref_names)): ref_ids[self.ref_names[i]] = i
+    builder = BAIBuilder(len(self.ref_names))
+    b2 = BAMFile(self.path,lazy=True)
+    prev = None # alignment waiting on where the next record starts
+    for e in b2:
+      voffset = virtual_offset(e.get_coord())
+      if prev: builder.add(prev[0],prev[1],prev[2],prev[3],voffset)
+      prev = None
+      if not e.is_aligned(): continue
+      trng = e.get_target_range()
+      prev = [ref_ids[trng.chr],trng.start-1,trng.end,voffset]
+    if prev: builder.add(prev[0],prev[1],prev[2],prev[3],virtual_offset([b2.fh.get_block_start(),b2.fh.get_inner_start()]))
+    b2.close()
+    return builder.get_index()
+
+  # Move to a [blockStart,innerStart] coordinate so the next read_entry
+  # is the alignment there, reusing this open file
+  def seek(self,coord):
+    self.fh.seek(coord[0],coord[1])
+    self._pending = []
+    self._pending_pos = 0
 
   # A special way to access via bam
   #def fetch_by_query(self,name):
@@ -454,7 +605,7 @@ class BAMFile:
   # only get a single
   def fetch_by_coord(self,coord):
     #b2 = BAMFile(self.path,blockStart=coord[0],innerStart=coord[1],index_obj=self.index,reference=self._reference)
-    b2 = BAMFile(self.path,blockStart=coord[0],innerStart=coord[1],reference=self._reference)
+    b2 = BAMFile(self.path,blockStart=coord[0],innerStart=coord[1],reference=self._reference,lazy=self._lazy)
     bam = b2.read_entry()
     b2.close()
     b2 = None
@@ -462,7 +613,7 @@ class BAMFile:
 
   def fetch_starting_at_coord(self,coord):
     #b2 = BAMFile(self.path,blockStart=coord[0],innerStart=coord[1],index_obj=self.index,reference=self._reference)
-    b2 = BAMFile(self.path,blockStart=coord[0],innerStart=coord[1],reference=self._reference)
+    b2 = BAMFile(self.path,blockStart=coord[0],innerStart=coord[1],reference=self._reference,lazy=self._lazy)
     return b2
 
   def _read_reference_information(self):
@@ -479,62 +630,76 @@ class BAMFile:
     self.n_ref = struct.unpack('<i',self.fh.read(4))[0]
 
 def _parse_bam_data_block(bin_in,ref_names):
+  global _bam_fixed
   v = {}
-  data = StringIO(bin_in)
-  rname_num = struct.unpack('<i',data.read(4))[0]
+  rname_num, pos, bin_mq_nl, flag_nc, l_seq, rnext_num, pnext, tlen = _bam_fixed.unpack_from(bin_in)
   v['rname'] = ref_names[rname_num] #refID to check in ref names
-  v['pos'] = struct.unpack('<i',data.read(4))[0] + 1 #POS
-  bin_mq_nl = struct.unpack('<I',data.read(4))[0]
-  bin =  bin_mq_nl >> 16 
+  v['pos'] = pos + 1 #POS
   v['mapq'] = (bin_mq_nl & 0xFF00) >> 8 #mapq
   l_read_name = bin_mq_nl & 0xFF #length of qname
-  flag_nc = struct.unpack('<I',data.read(4))[0] #flag and n_cigar_op
   v['flag'] = flag_nc >> 16
   n_cigar_op = flag_nc & 0xFFFF
-  l_seq = struct.unpack('<i',data.read(4))[0]
-  rnext_num = struct.unpack('<i',data.read(4))[0]
   if rnext_num == -1:
     v['rnext'] = '*'
   else:
     v['rnext'] = ref_names[rnext_num] #next_refID in ref_names
-  v['pnext'] = struct.unpack('<i',data.read(4))[0]+1 #pnext
-  tlen = struct.unpack('<i',data.read(4))[0]
+  v['pnext'] = pnext+1 #pnext
   v['tlen'] = tlen
-  v['qname'] = data.read(l_read_name).rstrip('\0') #read_name or qname
-  #print 'n_cigar_op '+str(n_cigar_op)
-  v['cigar_bytes'] = data.read(n_cigar_op*4)
-  #print 'cigar bytes '+str(len(v['cigar_bytes']))
-  v['seq_bytes'] = data.read((l_seq+1)/2)
-  v['qual_bytes'] = data.read(l_seq)
-  v['extra_bytes'] = data.read()
+  p = 32
+  v['qname'] = bin_in[p:p+l_read_name].rstrip('\0') #read_name or qname
+  p += l_read_name
+  v['cigar_bytes'] = bin_in[p:p+n_cigar_op*4]
+  p += n_cigar_op*4
+  v['seq_bytes'] = bin_in[p:p+(l_seq+1)/2]
+  p += (l_seq+1)/2
+  v['qual_bytes'] = bin_in[p:p+l_seq]
+  p += l_seq
+  v['extra_bytes'] = bin_in[p:]
   #last second tweak
   if v['rnext'] == v['rname']: v['rnext'] = '='
   return v
 
+# Pre: a decompressed string and the position of a record's block_size
+#      (optional) source to slice the records from, a memoryview of data
+#      gives zero-copy records
+# Post: a list of [inner_start, record_bytes] for every complete record
+#       from that position onward, and the position of the first byte
+#       not consumed (the start of a record that runs past the string)
+def _split_bam_records(data,pos=0,source=None):
+  global _bam_int
+  if source is None: source = data
+  records = []
+  total = len(data)
+  while pos+4 <= total:
+    block_size = _bam_int.unpack_from(data,pos)[0]
+    if pos+4+block_size > total: break
+    records.append([pos,source[pos+4:pos+4+block_size]])
+    pos += 4+block_size
+  return [records,pos]
+
 def _bin_to_qual(qual_bytes):
+  global _bam_qual_table
   if len(qual_bytes) == 0: return '*'
-  if struct.unpack('<B',qual_bytes[0])[0] == 0xFF: return '*'
-  #print qual_bytes
-  #try:
-  qual = ''.join([chr(struct.unpack('<B',x)[0]+33) for x in qual_bytes])
-  #except:
-  #  return '*'
-  return qual
+  if qual_bytes[0] == '\xff': return '*'
+  return qual_bytes.translate(_bam_qual_table)
 
 def _bin_to_seq(seq_bytes):
+  global _bam_seq_high
+  global _bam_seq_low
   if len(seq_bytes) == 0: return None
-  global _bam_char
-  #print len(seq_bytes)
-  seq = ''.join([''.join([''.join([chr(z+97).translate(_bam_char) for z in  [y>>4,y&0xF]]) for y in struct.unpack('<B',x)]) for x in seq_bytes]).rstrip('=')
-  return seq
+  # each byte holds two bases, decode the high and low nibbles
+  # for the whole string and interleave them
+  seq = bytearray(len(seq_bytes)*2)
+  seq[0::2] = seq_bytes.translate(_bam_seq_high)
+  seq[1::2] = seq_bytes.translate(_bam_seq_low)
+  return str(seq).rstrip('=')
 
 def _bin_to_cigar(cigar_bytes):
-  global _bam_ops
+  global _bam_ops_chars
   if len(cigar_bytes) == 0: return [[],'*']
-  cigar_packed = [struct.unpack('<I',x)[0] for x in \
-             [cigar_bytes[i:i+4] for i in range(0,len(cigar_bytes),4)]]
-  cigar_array = [[c >> 4, str(c &0xF).translate(_bam_ops)] for c in cigar_packed]
-  cigar_seq = ''.join([''.join([str(x[0]),x[1]]) for x in cigar_array])
+  cigar_packed = struct.unpack('<'+str(len(cigar_bytes)/4)+'I',cigar_bytes)
+  cigar_array = [[c >> 4, _bam_ops_chars[c & 0xF]] for c in cigar_packed]
+  cigar_seq = ''.join([str(x[0])+x[1] for x in cigar_array])
   return [cigar_array,cigar_seq]
 
 #Pre all the reamining bytes of an entry
@@ -543,126 +708,83 @@ def _bin_to_cigar(cigar_bytes):
 # 2. A string of the remainder
 def _bin_to_extra(extra_bytes):
   global _bam_value_type
-  extra = StringIO(extra_bytes)
   tags = {}
-  rem = ''
-  while extra.tell() < len(extra_bytes):
-    tag = extra.read(2)
-    val_type = extra.read(1)
-    if val_type == 'Z':
-      rem += tag+':'
-      rem += val_type+':'
-      p = re.compile('([!-~])')
-      m = p.match(extra.read(1))
-      vre = ''
-      while m:
-        vre += m.group(1)
-        c = extra.read(1)
-        #print c
-        m = p.match(c)
-      rem += vre+"\t"
+  rem = []
+  pos = 0
+  total = len(extra_bytes)
+  while pos < total:
+    tag = extra_bytes[pos:pos+2]
+    val_type = extra_bytes[pos+2]
+    pos += 3
+    if val_type == 'Z' or val_type == 'H':
+      end = extra_bytes.find('\0',pos)
+      if end == -1: end = total
+      vre = extra_bytes[pos:end]
+      pos = end+1
+      rem.append(tag+':'+val_type+':'+vre)
       tags[tag] = {'type':val_type,'value':vre}
     elif val_type == 'A':
-      rem += tag+':'
-      rem += val_type+':'
-      vre = extra.read(1)
-      rem += vre+"\t"      
-      tags[tag] = {'type':val_type,'value':vre}      
+      vre = extra_bytes[pos]
+      pos += 1
+      rem.append(tag+':'+val_type+':'+vre)
+      tags[tag] = {'type':val_type,'value':vre}
     elif val_type in _bam_value_type:
-      rem += tag+':'
-      rem += 'i'+':'
-      val = struct.unpack(_bam_value_type[val_type][1],extra.read(_bam_value_type[val_type][0]))[0]
-      rem += str(val)+"\t"
+      [size,fmt] = _bam_value_type[val_type]
+      val = struct.unpack_from(fmt,extra_bytes,pos)[0]
+      pos += size
+      rem.append(tag+':i:'+str(val))
+      tags[tag] = {'type':val_type,'value':val}
+    elif val_type == 'f':
+      val = struct.unpack_from('<f',extra_bytes,pos)[0]
+      pos += 4
+      rem.append(tag+':f:'+str(val))
       tags[tag] = {'type':val_type,'value':val}
     elif val_type == 'B':
-      sys.sterr.write("WARNING array not implmented\n")
-      continue
-      rem += tag+':'
-      rem += val_type+':'
-      array_type = _bam_value_type[extra.read(1)]
-      element_count = struct.unpack('<I',extra.read(4))[0]
-      array_bytes = extra.read(element_count*_bam_value_type[array_type][0])
-      for by in [array_bytes[i:i+_bam_value_type[array_type][0]] for i in range(0,len(array_bytes),_bam_value_type[array_type][0])]:
-        aval = struct.unpack(_bam_value_type[array_type][1],by)
-  return [tags,rem.rstrip("\t")]
-
-
-class BGZF:
-  # Methods adapted from biopython's bgzf.py
-  def __init__(self,filename,blockStart=None,innerStart=None):
+      array_type = extra_bytes[pos]
+      element_count = struct.unpack_from('<I',extra_bytes,pos+1)[0]
+      pos += 5
+      if array_type == 'f': [size,fmt] = [4,'<f']
+      else: [size,fmt] = _bam_value_type[array_type]
+      vals = struct.unpack_from('<'+str(element_count)+fmt[1],extra_bytes,pos)
+      pos += size*element_count
+      rem.append(tag+':B:'+','.join([array_type]+[str(x) for x in vals]))
+      tags[tag] = {'type':val_type,'value':list(vals)}
+    else:
+      sys.stderr.write("WARNING unknown tag type "+val_type+"\n")
+      break
+  return [tags,"\t".join(rem)]
+
+
+class BGZF(BGZF_reader):
+  # A bgzf reader opened from a file name
+  # Pre: filename of a bgzf file
+  #      (optional) threads and prefetch set up read-ahead decompression
+  #                 as in Bio.Format.BGZF.reader
+  def __init__(self,filename,blockStart=None,innerStart=None,threads=1,prefetch=None):
     self.path = filename
-    self.fh = open(filename,'rb')
-    if blockStart: self.fh.seek(blockStart)
-    self._block_start = 0
-    #self.pointer = 0
-    #holds block_size and data
-    self._buffer = self._load_block()
-    self._buffer_pos = 0
-    if innerStart: self._buffer_pos = innerStart
+    BGZF_reader.__init__(self,open(filename,'rb'),blockStart=blockStart,innerStart=innerStart,threads=threads,prefetch=prefetch)
   def close(self):
+    BGZF_reader.close(self)
     self.fh.close()
-  def get_block_start(self):
-    return self._block_start
-  def get_inner_start(self):
-    return self._buffer_pos
-  def seek(self,blockStart,innerStart):
-    self.fh.seek(blockStart)
-    self._buffer_pos = 0
-    self._buffer = self._load_block()
-    self._buffer_pos = innerStart
-  def read(self,size):
-    done = 0 #number of bytes that have been read so far
-    v = ''
-    while True:
-      if size-done < len(self._buffer['data']) - self._buffer_pos:
-        v +=  self._buffer['data'][self._buffer_pos:self._buffer_pos+(size-done)]
-        self._buffer_pos += (size-done)
-        #self.pointer += size
-        return v
-      else: # we need more buffer
-        vpart = self._buffer['data'][self._buffer_pos:]
-        self._buffer = self._load_block()
-        v += vpart
-        self._buffer_pos = 0
-        if len(self._buffer['data'])==0: return v
-        done += len(vpart)
-
-  def _load_block(self):
-    #pointer_start = self.fh.tell()
-    if not self.fh: return {'block_size':0,'data':''}
-    self._block_start = self.fh.tell()
-    magic = self.fh.read(4)
-    if len(magic) < 4:
-      #print 'end?'
-      #print len(self.fh.read())
-      return {'block_size':0,'data':''}
-    gzip_mod_time, gzip_extra_flags, gzip_os,extra_len = struct.unpack("<LBBH",self.fh.read(8))
-    pos = 0
-    block_size = None
-    #get block_size
-    while pos < extra_len:
-      subfield_id = self.fh.read(2)
-      subfield_len = struct.unpack("<H",self.fh.read(2))[0]
-      subfield_data = self.fh.read(subfield_len)
-      pos += subfield_len+4
-      if subfield_id == 'BC':
-        block_size = struct.unpack("<H",subfield_data)[0]+1
-    #block_size is determined
-    deflate_size = block_size - 1 - extra_len - 19
-    d = zlib.decompressobj(-15)
-    data = d.decompress(self.fh.read(deflate_size))+d.flush()
-    expected_crc = self.fh.read(4)
-    expected_size = struct.unpack("<I",self.fh.read(4))[0]
-    if expected_size != len(data):
-      sys.stderr.write("ERROR unexpected size\n")
-      sys.exit()
-    crc = zlib.crc32(data)
-    if crc < 0:  crc = struct.pack("<i",crc)
-    else:  crc = struct.pack("<I",crc)
-    if crc != expected_crc:
-      sys.stderr.write("ERROR crc fail\n")
-      sys.exit()
-    return {'block_size':block_size, 'data':data}
+
+  # Pre: the reader is positioned at the start of a BAM record
+  # Post: a list of [blockStart,innerStart,record_bytes] for every whole
+  #       record left in the current block.  Empty if the next record
+  #       crosses into the following block.  Positions are the same
+  #       as reading the records one at a time with read()
+  #       zero_copy gives memoryviews into the block instead of strings
+  def read_block_records(self,zero_copy=False):
+    data = self._buffer['data']
+    source = None
+    if zero_copy: source = memoryview(data)
+    [records,pos] = _split_bam_records(data,self._buffer_pos,source)
+    if len(records) == 0: return []
+    bstart = self._block_start
+    self._buffer_pos = pos
+    if self._buffer_pos == len(data):
+      self._buffer = self._load_block()
+      self._buffer_pos = 0
+    return [[bstart,x[0],x[1]] for x in records]
 
 class SamStream:
   #  minimum_intron_size greater than zero will only show sam entries with introns (junctions)
@@ -0,0 +1,261 @@
+# Dynamic programming kernels for pairwise alignment
+#
+# Matrices are filled a row at a time.  Each row keeps the scores of
+# the previous row in a plain list, and the traceback pointers of a row
+# go in a bytearray, so a full alignment costs one byte per cell and a
+# score-only alignment keeps just two rows.  Match and mismatch scores
+# for a row are looked up from a profile of the sequence along the
+# columns, made once per character, and batches of pairs that share
+# that sequence share its profile.
+#
+# needleman_wunsch       global, linear gap, with traceback
+# needleman_wunsch_score global score only in linear memory
+# needleman_wunsch_scores a batch of global scores
+# smith_waterman         local, open/extend gaps, with traceback
+# smith_waterman_score   local score only in linear memory
+#
+# A band limits a global alignment to the diagonals within band of the
+# ones joining the corners, so only about (2*band+1) cells per row are
+# filled.  It gives the full matrix result whenever the best path
+# stays inside the band, which is the case for gap-limited searches.
+
+_DIAG = 0
+_UP = 1
+_LEFT = 2
+_NONE = 3
+
+_NEG = -(1<<62) # outside the band
+
+def _row_profile(profile,c,s,match,mismatch):
+  if c not in profile:
+    profile[c] = [match if x == c else mismatch for x in s]
+  return profile[c]
+
+# Pre: row, lengths, band (None for no band)
+# Post: [first column, last column] of the row to fill
+def _band_columns(i,n,m,band):
+  if band is None: return [1,m]
+  lo = max(1,i+min(0,m-n)-band)
+  hi = min(m,i+max(0,m-n)+band)
+  return [lo,hi]
+
+# Global alignment with a linear gap penalty
+# Pre: s1, s2 sequences
+#      (optional) match, mismatch and gap scores
+#      band (see above) None for the full matrix
+# Post: [aligned s1, aligned s2, score]  gaps are '-'
+#       Ties go to the diagonal, then a gap in s2, then a gap in s1
+def needleman_wunsch(s1,s2,match=10,mismatch=-5,gap=-15,band=None):
+  n = len(s1)
+  m = len(s2)
+  profile = {}
+  prev = [gap*j for j in range(0,m+1)]
+  pointers = [bytearray([_LEFT])*(m+1)]
+  if band is not None:
+    [lo,hi] = _band_columns(0,n,m,band)
+    for j in range(hi+1,m+1): prev[j] = _NEG
+  for i in range(1,n+1):
+    sub = _row_profile(profile,s1[i-1],s2,match,mismatch)
+    row = [_NEG]*(m+1)
+    ptr = bytearray([_UP])*(m+1)
+    [lo,hi] = _band_columns(i,n,m,band)
+    if lo == 1:
+      row[0] = gap*i
+    left = row[lo-1]
+    for j in range(lo,hi+1):
+      diag = prev[j-1]+sub[j-1]
+      up = prev[j]+gap
+      lf = left+gap
+      if diag >= up and diag >= lf:
+        left = diag
+        ptr[j] = _DIAG
+      elif up >= lf:
+        left = up
+      else:
+        left = lf
+        ptr[j] = _LEFT
+      row[j] = left
+    pointers.append(ptr)
+    prev = row
+  score = prev[m]
+  a1 = []
+  a2 = []
+  i = n
+  j = m
+  while i > 0 or j > 0:
+    if i == 0: p = _LEFT
+    elif j == 0: p = _UP
+    else: p = pointers[i][j]
+    if p == _DIAG:
+      a1.append(s1[i-1])
+      a2.append(s2[j-1])
+      i -= 1
+      j -= 1
+    elif p == _UP:
+      a1.append(s1[i-1])
+      a2.append('-')
+      i -= 1
+    else:
+      a1.append('-')
+      a2.append(s2[j-1])
+      j -= 1
+  a1.reverse()
+  a2.reverse()
+  return [''.join(a1),''.join(a2),score]
+
+# Pre: same as needleman_wunsch, plus a profile dict to reuse between
+#      calls on the same s2
+# Post: the global alignment score, keeping only two rows
+def needleman_wunsch_score(s1,s2,match=10,mismatch=-5,gap=-15,band=None,profile=None):
+  n = len(s1)
+  m = len(s2)
+  if profile is None: profile = {}
+  prev = [gap*j for j in range(0,m+1)]
+  if band is not None:
+    [lo,hi] = _band_columns(0,n,m,band)
+    for j in range(hi+1,m+1): prev[j] = _NEG
+  for i in range(1,n+1):
+    sub = _row_profile(profile,s1[i-1],s2,match,mismatch)
+    row = [_NEG]*(m+1)
+    [lo,hi] = _band_columns(i,n,m,band)
+    if lo == 1:
+      row[0] = gap*i
+    left = row[lo-1]
+    for j in range(lo,hi+1):
+      v = prev[j-1]+sub[j-1]
+      up = prev[j]+gap
+      if up > v: v = up
+      left += gap
+      if left > v: v = left
+      else: left = v
+      row[j] = v
+    prev = row
+  return prev[m]
+
+# Align many pairs at once
+# Pre: list of [s1, s2] pairs, scoring as in needleman_wunsch
+# Post: list of global alignment scores in the same order
+#       The score is the same with the sequences swapped, so each pair
+#       is filled with s1 along the columns and pairs with the same s1
+#       (like one read against many junction choices) share its profile
+def needleman_wunsch_scores(pairs,match=10,mismatch=-5,gap=-15,band=None):
+  profiles = {}
+  output = []
+  for [s1,s2] in pairs:
+    if s1 not in profiles: profiles[s1] = {}
+    output.append(needleman_wunsch_score(s2,s1,match,mismatch,gap,band,profiles[s1]))
+  return output
+
+# Local alignment
+# Rows run along s2 and columns along s1.  A gap is extended when the
+# cell above was reached by a gap in s1 (up) or in s2 (left), otherwise
+# it is opened, the scoring SmithWatermanAligner has always used.
+# Pre: s1 (target), s2 (query)
+#      (optional) match, mismatch, gapopen and gapextend scores
+# Post: [score, aligned s1, aligned s2, s1 start, s2 start]
+#       starts are the zero indexed positions the alignment begins at
+#       The first best cell in row order is used
+def smith_waterman(s1,s2,match=10,mismatch=-15,gapopen=-10,gapextend=-5):
+  n = len(s2)
+  m = len(s1)
+  profile = {}
+  prev = [0]*(m+1)
+  prevp = bytearray([_NONE])*(m+1)
+  pointers = [prevp]
+  max_score = 0
+  max_i = 0
+  max_j = 0
+  for i in range(1,n+1):
+    sub = _row_profile(profile,s2[i-1],s1,match,mismatch)
+    row = [0]*(m+1)
+    ptr = bytearray([_NONE])*(m+1)
+    left = 0
+    for j in range(1,m+1):
+      diag = prev[j-1]+sub[j-1]
+      above = prevp[j]
+      if above == _UP: up = prev[j]+gapextend
+      else: up = prev[j]+gapopen
+      if above == _LEFT: lf = left+gapextend
+      else: lf = left+gapopen
+      if diag <= 0 and up <= 0 and lf <= 0:
+        left = 0
+        continue
+      if diag >= up and diag >= lf:
+        left = diag
+        ptr[j] = _DIAG
+      elif up >= lf:
+        left = up
+        ptr[j] = _UP
+      else:
+        left = lf
+        ptr[j] = _LEFT
+      row[j] = left
+      if left > max_score:
+        max_score = left
+        max_i = i
+        max_j = j
+    pointers.append(ptr)
+    prev = row
+    prevp = ptr
+  a1 = []
+  a2 = []
+  i = max_i
+  j = max_j
+  while True:
+    p = pointers[i][j]
+    if p == _NONE: break
+    if p == _DIAG:
+      a1.append(s1[j-1])
+      a2.append(s2[i-1])
+      i -= 1
+      j -= 1
+    elif p == _LEFT:
+      a1.append(s1[j-1])
+      a2.append('-')
+      j -= 1
+    else:
+      a1.append('-')
+      a2.append(s2[i-1])
+      i -= 1
+  a1.reverse()
+  a2.reverse()
+  return [max_score,''.join(a1),''.join(a2),j,i]
+
+# Pre: same as smith_waterman
+# Post: the local alignment score, keeping only two rows
+def smith_waterman_score(s1,s2,match=10,mismatch=-15,gapopen=-10,gapextend=-5):
+  n = len(s2)
+  m = len(s1)
+  profile = {}
+  prev = [0]*(m+1)
+  prevp = bytearray([_NONE])*(m+1)
+  max_score = 0
+  for i in range(1,n+1):
+    sub = _row_profile(profile,s2[i-1],s1,match,mismatch)
+    row = [0]*(m+1)
+    ptr = bytearray([_NONE])*(m+1)
+    left = 0
+    for j in range(1,m+1):
+      diag = prev[j-1]+sub[j-1]
+      above = prevp[j]
+      if above == _UP: up = prev[j]+gapextend
+      else: up = prev[j]+gapopen
+      if above == _LEFT: lf = left+gapextend
+      else: lf = left+gapopen
+      if diag <= 0 and up <= 0 and lf <= 0:
+        left = 0
+        continue
+      if diag >= up and diag >= lf:
+        left = diag
+        ptr[j] = _DIAG
+      elif up >= lf:
+        left = up
+        ptr[j] = _UP
+      else:
+        left = lf
+        ptr[j] = _LEFT
+      row[j] = left
+      if left > max_score: max_score = left
+    prev = row
+    prevp = ptr
+  return max_score
@@ -1,4 +1,7 @@
-import sys, re, json
+import sys, re, json, pickle
+from bisect import bisect_left, bisect_right
+from array import array
+from multiprocessing import Pool
 # These classes are to help deal with genomic coordinates and 
 # this associated with those coordinates.
 
@@ -300,32 +303,44 @@ class Loci:
     self.loci = []
     for chrom in sorted(lbc.keys()):
       for locus in lbc[chrom].loci:  self.loci.append(locus)
+  # Combine loci that overlap (within the minimum distance) until none do
+  # Sorted by start, each locus either joins the one being built or
+  # starts a new one, so this is a single sweep per chromosome (and
+  # direction).  Loci keep the order of their first member locus and
+  # members are gathered in the order the loci were added
   def merge_down_loci(self):
-    old_locus_size = -1
-    z = 0
-    while len(self.loci) != old_locus_size:
-      z+=1
-      old_locus_size = len(self.loci)
-      locus_size = len(self.loci)
-      if self.verbose:
-        sys.stderr.write(str(locus_size)+" Combining down loci step "+str(z)+"       \r")
-      combined = set()
-      for i in range(0,locus_size):
-        if i in combined: continue
-        for j in range(i+1,locus_size):
-          if self.loci[i].range.overlaps_with_padding(self.loci[j].range,self.overhang):
-            if self.use_direction and self.loci[i].range.direction != self.loci[j].range.direction:  continue
-            for obj in self.loci[j].members:
-              self.loci[i].add_member(obj)
-            combined.add(j)
-            break
-      newloci = []
-      for i in range(0,locus_size):
-        if i not in combined:
-          newloci.append(self.loci[i])
-      self.loci = newloci
+    groups = {}
+    for i in range(0,len(self.loci)):
+      rng = self.loci[i].range
+      key = rng.chr
+      if self.use_direction: key = (rng.chr,rng.direction)
+      if key not in groups: groups[key] = []
+      groups[key].append(i)
+    components = []
+    for key in groups:
+      order = sorted(groups[key],key=lambda x: (self.loci[x].range.start,x))
+      current = None
+      end = None
+      for i in order:
+        rng = self.loci[i].range
+        if current is not None and rng.start <= end+self.overhang:
+          current.append(i)
+          if rng.end > end: end = rng.end
+        else:
+          current = [i]
+          end = rng.end
+          components.append(current)
+    newloci = []
+    for component in sorted(components,key=lambda x: min(x)):
+      component.sort()
+      locus = self.loci[component[0]]
+      for j in component[1:]:
+        for obj in self.loci[j].members:
+          locus.add_member(obj)
+      newloci.append(locus)
+    self.loci = newloci
     if self.verbose:
-      sys.stderr.write("Finished combining down "+str(len(self.loci))+" loci in "+str(z)+" steps   \n")
+      sys.stderr.write("Finished combining down "+str(len(self.loci))+" loci\n")
     return
 
 #pre an array of ranges
@@ -482,70 +497,190 @@ def string_to_genomic_range(rstring):
 def sort_genomic_ranges(rngs):
   return sorted(rngs, key=lambda x: (x.chr, x.start, x.end))
 
+# Pre: lists of 1-indexed starts and ends of ranges on one chromosome
+# Post: [start,end,depth] for each run of constant non-zero depth,
+#       1-indexed and in order
+#       Starts and ends are sorted once and swept together, so nothing
+#       is kept per position
+def coverage_runs(starts,ends):
+  starts = sorted(starts)
+  stops = sorted([x+1 for x in ends])
+  n = len(starts)
+  i = 0
+  j = 0
+  depth = 0
+  pstart = None
+  outputs = []
+  while j < n:
+    loc = stops[j]
+    if i < n and starts[i] < loc: loc = starts[i]
+    prev_depth = depth
+    while i < n and starts[i] == loc:
+      depth += 1
+      i += 1
+    while j < n and stops[j] == loc:
+      depth -= 1
+      j += 1
+    if prev_depth > 0 and prev_depth != depth:
+      outputs.append([pstart,loc-1,prev_depth]) # output what was before this if we are in something
+    if prev_depth != depth or depth == 0:
+      pstart = loc
+  return outputs
+
+def _coverage_runs_by_chr(v):
+  return [v[0],coverage_runs(v[1],v[2])]
+
+# Accumulate ranges per chromosome into arrays of starts and ends
+# and turn them into runs of depth (bedGraph style)
+class Coverage:
+  def __init__(self):
+    self._starts = {}
+    self._ends = {}
+  def add(self,rng):
+    self.add_range(rng.chr,rng.start,rng.end)
+  # Pre: chromosome, 1-indexed start and end
+  def add_range(self,chr,start,end):
+    if chr not in self._starts:
+      self._starts[chr] = array('l')
+      self._ends[chr] = array('l')
+    self._starts[chr].append(start)
+    self._ends[chr].append(end)
+  def get_chrs(self):
+    return sorted(self._starts.keys())
+  def get_runs(self,chr):
+    if chr not in self._starts: return []
+    return coverage_runs(self._starts[chr],self._ends[chr])
+  # Post: generate [chr,start,end,depth] 1-indexed by sorted chromosome
+  #       with threads greater than 1 chromosomes run on a process pool
+  def generate_runs(self,threads=1):
+    jobs = ([chr,self._starts[chr],self._ends[chr]] for chr in self.get_chrs())
+    if threads > 1:
+      p = Pool(processes=threads)
+      results = p.imap(_coverage_runs_by_chr,jobs)
+    else:
+      results = (_coverage_runs_by_chr(x) for x in jobs)
+    for [chr,runs] in results:
+      for r in runs: yield [chr,r[0],r[1],r[2]]
+    if threads > 1:
+      p.close()
+      p.join()
+  # Write bedGraph lines (0-indexed start) as chromosomes finish
+  def write_bedgraph(self,fh,threads=1,min_depth=1):
+    for [chr,start,end,depth] in self.generate_runs(threads):
+      if depth < min_depth: continue
+      fh.write(chr+"\t"+str(start-1)+"\t"+str(end)+"\t"+str(depth)+"\n")
+
 # take a list of ranges as an input
 # output a list of ranges and the coverage at each range
+# threads greater than 1 does chromosomes in parallel
 def ranges_to_coverage(rngs,threads=1):
-  # input is the bed ranges on a single chromosome
-  # out is the non-overlapping bed ranges with the edition of depth
-  def do_chr(rngs):
-    #starts = sorted(range(0,len(rngs)), key=lambda x: rngs[x].start)
-    #print starts
-    #ends = sorted(range(0,len(rngs)), key=lambda x: rngs[x].end)
-    start_events = [x.start for x in rngs]
-    end_events = [x.end+1 for x in rngs]
-    indexed_events = {}
-    for e in start_events:
-      if e not in indexed_events: indexed_events[e] = {'starts':0,'ends':0}
-      indexed_events[e]['starts']+=1
-    for e in end_events:
-      if e not in indexed_events: indexed_events[e] = {'starts':0,'ends':0}
-      indexed_events[e]['ends']+=1
-    cdepth = 0
-    pstart = None
-    pend = None
-    outputs = []
-    ordered_events = sorted(indexed_events.keys())
-    for loc in ordered_events:
-      prev_depth = cdepth # where we were
-      # see where we are before the change
-      cdepth += indexed_events[loc]['starts']
-      cdepth -= indexed_events[loc]['ends']
-      if prev_depth > 0 and prev_depth != cdepth:
-        outputs.append([rngs[0].chr,pstart,loc-1,prev_depth]) # output what was before this if we are in something
-      if prev_depth != cdepth or cdepth == 0:
-        pstart = loc
-    #print outputs
-    return outputs
-  
-  class Queue:
-    def __init__(self,val):
-      self.val = [val]
-    def get(self):
-      return self.val.pop(0)
-
-  ### START MAIN ####
-  srngs = sort_genomic_ranges(rngs)
-  # get the leftmost unique range
-  chr = srngs[0].chr
-  buffer = []
+  cov = Coverage()
+  for rng in rngs: cov.add(rng)
   results = []
-  prelim = []
-  for b in srngs:
-    if b.chr != chr:
-      rs = do_chr(buffer[:])
-      for r in rs:  
-        results.append(GenomicRange(r[0],r[1],r[2]))
-        results[-1].set_payload(r[3])
-      buffer = []
-    buffer.append(b)
-    chr = b.chr
-  if len(buffer) > 0:
-    rs = do_chr(buffer[:])
-    for r in rs: 
-      results.append(GenomicRange(r[0],r[1],r[2]))
-      results[-1].set_payload(r[3])
+  for [chr,start,end,depth] in cov.generate_runs(threads):
+    results.append(GenomicRange(chr,start,end))
+    results[-1].set_payload(depth)
   return results
 
+# An overlap index over many ranges, one sorted array per chromosome
+# Ranges are sorted by start and each chromosome keeps a running maximum
+# of the ends.  That maximum only grows, so bisecting it finds the first
+# range that could reach a query and bisecting the starts finds the last,
+# and only the ranges between are checked.
+# Works on anything with chr, start, and end (1-indexed inclusive)
+# Ranges can be added one at a time, the arrays are rebuilt on the next query
+class RangeIndex:
+  # Pre: (optional) a list of ranges to index
+  def __init__(self,rngs=None):
+    self._ranges = []
+    self._chrs = None # chr keyed [starts, max ends, range numbers]
+    if rngs:
+      for rng in rngs: self._ranges.append(rng)
+
+  def add(self,rng):
+    self._ranges.append(rng)
+    self._chrs = None
+
+  def length(self):
+    return len(self._ranges)
+
+  def _build(self):
+    bychr = {}
+    for i in range(len(self._ranges)):
+      c = self._ranges[i].chr
+      if c not in bychr: bychr[c] = []
+      bychr[c].append(i)
+    self._chrs = {}
+    for c in bychr:
+      order = sorted(bychr[c],key=lambda x: (self._ranges[x].start,self._ranges[x].end))
+      starts = [self._ranges[x].start for x in order]
+      max_ends = []
+      m = 0
+      for x in order:
+        if self._ranges[x].end > m: m = self._ranges[x].end
+        max_ends.append(m)
+      self._chrs[c] = [starts,max_ends,order]
+
+  # Post: the range numbers (order added) overlapping rng
+  #       padding widens the query by that much on each side
+  def _find(self,rng,padding=0):
+    if self._chrs is None: self._build()
+    if rng.chr not in self._chrs: return []
+    [starts,max_ends,order] = self._chrs[rng.chr]
+    qstart = max(1,rng.start-padding)
+    qend = rng.end+padding
+    lo = bisect_left(max_ends,qstart)
+    hi = bisect_right(starts,qend)
+    return [order[i] for i in range(lo,hi) if self._ranges[order[i]].end >= qstart]
+
+  # Pre: a range to check
+  # Post: the indexed ranges overlapping it in the order they were added
+  def get_overlapped(self,rng,use_direction=False,padding=0):
+    hits = sorted(self._find(rng,padding))
+    if use_direction:
+      hits = [x for x in hits if self._ranges[x].direction == rng.direction]
+    return [self._ranges[x] for x in hits]
+
+  def count_overlapped(self,rng,use_direction=False,padding=0):
+    if not use_direction: return len(self._find(rng,padding))
+    return len(self.get_overlapped(rng,use_direction,padding))
+
+  # Pre: a range to check
+  # Post: the indexed ranges closest to it, more than one if they are
+  #       equally close.  Overlapping ranges have a distance of zero.
+  #       Empty list if nothing is on its chromosome
+  def get_nearest(self,rng):
+    over = self.get_overlapped(rng)
+    if len(over) > 0: return over
+    if self._chrs is None: self._build()
+    if rng.chr not in self._chrs: return []
+    [starts,max_ends,order] = self._chrs[rng.chr]
+    best = None
+    bests = []
+    # nearest to the right starts just after the query
+    i = bisect_right(starts,rng.end)
+    if i < len(starts):
+      best = starts[i]-rng.end
+      bests = [x for x in order[i:bisect_right(starts,starts[i])]]
+    # nearest to the left has the largest end before the query
+    j = bisect_left(max_ends,rng.start)
+    if j > 0:
+      d = rng.start-max_ends[j-1]
+      left = [x for x in order[0:j] if self._ranges[x].end == max_ends[j-1]]
+      if best is None or d < best:
+        best = d
+        bests = left
+      elif d == best:
+        bests = bests+left
+    return [self._ranges[x] for x in sorted(bests)]
+
+  def dump_serialized(self):
+    return pickle.dumps(self._ranges)
+  def load_serialized(self,instr):
+    self._ranges = pickle.loads(instr)
+    self._chrs = None
+    return
+
 class BedArrayStream:
   def __init__(self,bedarray):
     self.prev = None
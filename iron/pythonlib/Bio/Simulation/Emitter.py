@@ -1,4 +1,116 @@
+import struct, mmap, sys
+from collections import OrderedDict
 from Bio.Simulation.RandomSource import RandomSource
+from Bio.Structure import Transcriptome, Transcript
+
+# Binary emitter file written by build_emitter and read by emit
+# Everything little-endian.  A fixed header then one section each so
+# the file can be memory mapped and transcripts built only when drawn
+#  header: magic 'BEM\x01', version, transcript count
+#          then the byte offset of each section in _emitter_sections order
+#  weights   double per transcript (expression_table weights)
+#  seqoffs   uint64 per transcript plus one, into the sequences section
+#  sequences every transcript sequence concatenated
+#  metaoffs  uint64 per transcript plus one, into the meta section
+#  meta      every Transcript structure line concatenated
+#  weight_type the weight type string
+_emitter_magic = 'BEM\x01'
+_emitter_version = 1
+_emitter_sections = [['weights','d'],['seqoffs','Q'],['sequences',None],['metaoffs','Q'],['meta',None],['weight_type',None]]
+_emitter_header = struct.Struct('<4sIQ'+'Q'*len(_emitter_sections))
+
+# Pre: the first bytes of an emitter file
+# Post: True if it is the binary format, False for the older
+#       base64 encoded pickle
+def is_binary_emitter(data):
+  return data[0:4] == _emitter_magic
+
+# Pre: filename, a Transcriptome with sequences set, weight type and
+#      for expression_table a dict of transcript name to weight
+# Post: writes the binary emitter file
+def write_emitter(filename,txome,weight_type,weights={}):
+  txs = txome.get_transcripts()
+  of = open(filename,'wb')
+  of.write('\0'*_emitter_header.size)
+  offsets = []
+  for [name,code] in _emitter_sections:
+    offsets.append(of.tell())
+    if name == 'weights':
+      vals = [float(weights.get(x.get_transcript_name(),0)) for x in txs]
+      of.write(struct.pack('<'+str(len(vals))+code,*vals))
+    elif name in ['seqoffs','metaoffs']:
+      vals = [0]
+      for tx in txs:
+        if name == 'seqoffs': l = len(tx.get_sequence())
+        else: l = len(tx.get_structure_line())
+        vals.append(vals[-1]+l)
+      of.write(struct.pack('<'+str(len(vals))+code,*vals))
+    elif name == 'sequences':
+      for tx in txs: of.write(tx.get_sequence())
+    elif name == 'meta':
+      for tx in txs: of.write(tx.get_structure_line())
+    elif name == 'weight_type':
+      of.write(weight_type)
+  of.seek(0)
+  of.write(_emitter_header.pack(_emitter_magic,_emitter_version,len(txs),*offsets))
+  of.close()
+
+# Read a binary emitter through a memory map (or from a string when
+# it comes on a stream).  Opening reads only the header and offsets
+# Only the cache_size most recently used transcripts are kept built
+class MappedEmitter:
+  def __init__(self,filename=None,data=None,cache_size=64):
+    self._fh = None
+    if filename:
+      self._fh = open(filename,'rb')
+      data = mmap.mmap(self._fh.fileno(),0,access=mmap.ACCESS_READ)
+    self._data = data
+    v = _emitter_header.unpack_from(data,0)
+    if v[0] != _emitter_magic or v[1] != _emitter_version:
+      sys.stderr.write("ERROR: not a supported binary emitter\n")
+      sys.exit()
+    self._n = v[2]
+    self._offsets = dict(zip([x[0] for x in _emitter_sections],v[3:]))
+    self._seqoffs = self._column('seqoffs',self._n+1)
+    self._metaoffs = self._column('metaoffs',self._n+1)
+    self._cache_size = cache_size
+    self._cache = OrderedDict() # transcript index to Transcript, oldest first
+  def _column(self,name,length):
+    code = dict(_emitter_sections)[name]
+    return struct.unpack_from('<'+str(length)+code,self._data,self._offsets[name])
+  def __len__(self):
+    return self._n
+  # Post: Transcript i with its sequence, built on first use
+  def __getitem__(self,i):
+    if i < 0: i += self._n
+    if i < 0 or i >= self._n: raise IndexError('index out of range')
+    if i in self._cache:
+      tx = self._cache.pop(i)
+      self._cache[i] = tx
+      return tx
+    base = self._offsets['meta']
+    tx = Transcript()
+    tx.load_structure_line(self._data[base+self._metaoffs[i]:base+self._metaoffs[i+1]])
+    base = self._offsets['sequences']
+    tx.set_sequence_string(self._data[base+self._seqoffs[i]:base+self._seqoffs[i+1]])
+    self._cache[i] = tx
+    if len(self._cache) > self._cache_size: self._cache.popitem(last=False)
+    return tx
+  def __iter__(self):
+    for i in xrange(self._n): yield self[i]
+  def get_weight_type(self):
+    return self._data[self._offsets['weight_type']:len(self._data)]
+  def get_weights(self):
+    return list(self._column('weights',self._n))
+  # Post: a Transcriptome whose transcripts are read from this file
+  def get_transcriptome(self):
+    txome = Transcriptome()
+    txome.set_transcripts(self)
+    return txome
+  def close(self):
+    if self._fh:
+      self._data.close()
+      self._fh.close()
 
 #Give it a transcriptome definition and a reference genome for it
 #initialy give it uniform probability
@@ -12,13 +124,24 @@ class TranscriptomeEmitter:
     ######
     tcnt = len(self._transcriptome.get_transcripts())
     self._weights = [float(i+1)/float(tcnt) for i in range(0,tcnt)]
+    self._sampler = self.random.get_weighted_sampler(self._weights)
     ## _log stores what we are emitting ##
     self._log = []
 
   def emit_transcript(self):
-    i = self.random.get_weighted_random_index(self._weights)
+    i = self._sampler.draw()
     return self._transcriptome.get_transcripts()[i]
 
+  # Post: a list of n transcripts, same as calling emit_transcript n times
+  def emit_transcripts(self,n):
+    txs = self._transcriptome.get_transcripts()
+    return [txs[i] for i in self._sampler.draw_n(n)]
+
+  # input: a weight for each transcript in transcriptome order
+  def set_weights(self,weights):
+    self._weights = [float(x) for x in weights]
+    self._sampler = self.random.get_weighted_sampler(self._weights)
+
   # input: an array of weights <<txname1> <weight1>> <<txname2> <weight2>>...
   def set_weights_by_dict(self,weights):
     self._weights = []
@@ -28,4 +151,5 @@ class TranscriptomeEmitter:
         self._weights.append(float(weights[txname]))
       else:
         self._weights.append(float(0))
+    self._sampler = self.random.get_weighted_sampler(self._weights)
     return
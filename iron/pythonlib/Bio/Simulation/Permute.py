@@ -27,112 +27,84 @@ class MakeErrors:
   def set_modified_base(self,base):
     self._modified_base = base
 
+  # Pre: position i in sequence
+  # Post: True if the before, after and observed base settings allow
+  #       an error at i
+  def _in_context(self,sequence,i):
+    if self._before_base and (i < 1 or sequence[i-1] != self._before_base):
+      return False
+    if self._after_base and (i >= len(sequence)-1 or sequence[i+1] != self._after_base):
+      return False
+    if self._observed_base and (sequence[i] != self._observed_base):
+      return False
+    return True
+
   def random_substitution(self,fastq,rate):
     sequence = fastq.seq
-    seq = ''
+    seq = list(sequence)
+    rand = self.random.random
     for i in range(len(sequence)):
-      # check context
-      prev = None
-      if i >= 1: prev = sequence[i-1]
-      next = None
-      if i < len(sequence)-1: next = sequence[i+1]
-      if self._before_base and (not prev or prev != self._before_base): 
-        seq+=sequence[i]
-        continue
-      if self._after_base and (not next or next != self._after_base): 
-        seq+=sequence[i]
-        continue
-      if self._observed_base and (sequence[i] != self._observed_base):
-        seq+=sequence[i]
-        continue
-
-      rnum = self.random.random()
-      if rnum < rate:
+      if not self._in_context(sequence,i): continue
+      if rand() < rate:
         if not self._modified_base:
-          seq += self.random.different_random_nt(sequence[i])
+          seq[i] = self.random.different_random_nt(sequence[i])
         else:
-          seq += self._modified_base
-      else:
-        seq += sequence[i]
-    return Fastq([fastq.name,seq,'+',fastq.qual])
+          seq[i] = self._modified_base
+    return Fastq([fastq.name,''.join(seq),'+',fastq.qual])
 
   def random_deletion(self,fastq,rate):
     sequence = fastq.seq
     quality = fastq.qual
-    seq = ''
-    qual = None
-    if quality: qual = ''
+    keep = []
+    rand = self.random.random
     for i in range(len(sequence)):
-      # check context
-      prev = None
-      if i >= 1: prev = sequence[i-1]
-      next = None
-      if i < len(sequence)-1: next = sequence[i+1]
-      if self._before_base and (not prev or prev != self._before_base): 
-        seq+=sequence[i]
-        if quality: qual+=quality[i]
-        continue
-      if self._after_base and (not next or next != self._after_base): 
-        seq+=sequence[i]
-        if quality: qual+=quality[i]
-        continue
-      if self._observed_base and (sequence[i] != self._observed_base):
-        seq+=sequence[i]
-        if quality: qual+=quality[i]
-        continue
-
-      rnum = self.random.random()
-      if rnum >= rate:
-        seq += sequence[i]
-        if quality: qual+=quality[i]
+      if not self._in_context(sequence,i) or rand() >= rate:
+        keep.append(i)
+    seq = ''.join([sequence[i] for i in keep])
+    qual = None
+    if quality: qual = ''.join([quality[i] for i in keep])
     return Fastq([fastq.name,seq,'+',qual])
 
-  def random_insertion(self,rate,max_inserts=1):
+  def random_insertion(self,fastq,rate,max_inserts=1):
     sequence = fastq.seq
     quality = fastq.qual
-    seq = ''
-    qual = None
+    seq = []
+    qual = []
     ibase = rate_to_phred33(rate)
-    if quality: qual = ''
+    rand = self.random.random
     z = 0
-    while self.random.random() < rate and z < max_inserts:
+    while rand() < rate and z < max_inserts:
       if self._before_base: break # can't do this one
       if self._after_base:
         if self._after_base != sequence[1]: break
       z += 1
       if self._modified_base:
-        seq += self._modified_base
-        if quality: qual += ibase
+        seq.append(self._modified_base)
       else:
-        seq += self.random.random_nt()
-        if quality: qual += ibase
+        seq.append(self.random.random_nt())
+      qual.append(ibase)
     z = 0
     for i in range(len(sequence)):
       # check context
       prev = sequence[i]
       next = None
       if i < len(sequence)-1: next = sequence[i+1]
-      if self._before_base and (not prev or prev != self._before_base): 
-        seq+=sequence[i]
-        if quality: qual+=quality[i]
+      seq.append(sequence[i])
+      if quality: qual.append(quality[i])
+      if self._before_base and (not prev or prev != self._before_base):
         continue
-      if self._after_base and (not next or next != self._after_base): 
-        seq+=sequence[i]
-        if quality: qual+= quality[i]
+      if self._after_base and (not next or next != self._after_base):
         continue
-
-      seq += sequence[i]
-      if quality: qual += quality[i]
-      while self.random.random() < rate and z < max_inserts:
+      while rand() < rate and z < max_inserts:
         z+=1
         if self._modified_base:
-          seq += self._modified_base
-          if quality: qual += ibase
+          seq.append(self._modified_base)
         else:
-          seq += self.random.random_nt()
-          if quality: qual += ibase
+          seq.append(self.random.random_nt())
+        qual.append(ibase)
       z = 0
-    return Fastq([fastq.name,seq,'+',qual])
+    if not quality: return Fastq([fastq.name,''.join(seq),'+',None])
+    return Fastq([fastq.name,''.join(seq),'+',''.join(qual)])
 
   def random_flip(self,sequence):
     if self.random.random() < 0.5:
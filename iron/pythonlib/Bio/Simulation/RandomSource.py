@@ -1,4 +1,6 @@
 import random, sys
+from array import array
+from bisect import bisect_right
 
 nts = ['A','C','G','T']
 
@@ -32,16 +34,49 @@ class RandomSource:
   
   # weights is an array with floats
   # if a random number between 0 and 1 is less than an index return the lowest index
+  # For repeated draws from the same weights use get_weighted_sampler
   def get_weighted_random_index(self,weights):
-    tot = float(sum([float(x) for x in weights]))
-    fracarray = [weights[0]]
+    return WeightedSampler(weights,self).draw()
+
+  # Pre: weights is an array with floats
+  # Post: a WeightedSampler drawing indecies from this source
+  def get_weighted_sampler(self,weights):
+    return WeightedSampler(weights,self)
+
+# Cumulative weights built once so each draw is a binary search
+# Draws use one random() each exactly like get_weighted_random_index
+# so a seeded source gives the same indecies either way
+class WeightedSampler:
+  def __init__(self,weights,rand):
+    self._random = rand
+    self._cumulative = array('d')
+    self._total = float(sum([float(x) for x in weights]))
+    if len(weights) == 0: return
+    prev = weights[0]
+    self._cumulative.append(prev)
     for w in weights[1:]:
-      prev = fracarray[-1]
-      fracarray.append(w+prev)
-    #print fracarray
-    rnum = self._random.random()*tot
-    #print rnum
-    #sys.exit()
-    for i in range(len(weights)):
-      if rnum < fracarray[i]: return i
-    sys.stderr.write("Warning unexpected no random\n")
+      prev = w+prev
+      self._cumulative.append(prev)
+
+  def __len__(self):
+    return len(self._cumulative)
+
+  def draw(self):
+    i = bisect_right(self._cumulative,self._random.random()*self._total)
+    if i >= len(self._cumulative):
+      sys.stderr.write("Warning unexpected no random\n")
+      return None
+    return i
+
+  # Post: a list of n indecies, same as calling draw n times
+  def draw_n(self,n):
+    cumulative = self._cumulative
+    total = self._total
+    rand = self._random.random
+    last = len(cumulative)-1
+    output = [bisect_right(cumulative,rand()*total) for i in xrange(n)]
+    for i in range(len(output)):
+      if output[i] > last:
+        sys.stderr.write("Warning unexpected no random\n")
+        output[i] = None
+    return output
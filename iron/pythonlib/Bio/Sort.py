@@ -0,0 +1,240 @@
+import sys, os, re, gzip, heapq
+from itertools import chain
+from shutil import rmtree
+from tempfile import mkdtemp
+from multiprocessing import Pool
+
+# External merge sort of text lines
+# Lines are buffered and sorted in memory as runs, runs that don't fit
+# are spilled compressed to a temporary directory, and everything is
+# combined with a k-way heapq.merge that only holds a bounded buffer of
+# each run at a time.
+#
+# Keys are either a --fields style string
+#   '1,2n,3ni' field 1 first, then field 2 numerically, then field 3
+#   numerically but inverted (fields are base-1 and tab separated)
+# or a known format and order
+#   format gpd, psl, sam or bed
+#   order  location (chromosome, start, end) or name
+# The whole line is always the final tie break.
+# A field a line doesn't have sorts as empty, and numeric fields use the
+# leading number of the value or 0 when there is none, like sort -n.
+# SAM header lines (@HD, @SQ, @PG ...) are kept in their input order
+# ahead of the sorted records.
+
+# Columns (base-1) for each format, matching the unix sort options
+# the rest of the package used for these files
+_format_fields = {
+  'gpd':{'location':'3,5n,6n,4','name':'1,2'},
+  'psl':{'location':'14,16n,17n,9','name':'10'},
+  'sam':{'location':'3,4n','name':'1'},
+  'bed':{'location':'1,2n,3n','name':'4'}
+}
+
+_leading_number = re.compile('\s*([+-]?(\d+\.?\d*|\.\d+))')
+
+# Pre: a field value
+# Post: its numeric value, or of its leading number, or 0
+def _numeric(v):
+  if 'e' not in v and 'E' not in v: # sort -n reads no exponents
+    try:
+      x = float(v)
+      if x-x == 0: return x # not nan or inf
+    except ValueError:
+      pass
+  m = _leading_number.match(v)
+  if m: return float(m.group(1))
+  return 0.0
+
+# Reverses the order of whatever it wraps for inverted fields
+class _Inverted(object):
+  __slots__ = ['value']
+  def __init__(self,value):
+    self.value = value
+  def __cmp__(self,other):
+    return cmp(other.value,self.value)
+
+# Pre: fields string like '1,2n,3ni' (see above)
+# Post: list of [zero-indexed column, is numeric, is inverted]
+def parse_fields(fields):
+  output = []
+  for f in fields.split(','):
+    m = re.search('(\d+)',f)
+    if not m:
+      sys.stderr.write("ERROR: must specify a field index (base-1) to sort on sort on with fields option\n")
+      sys.exit()
+    output.append([int(m.group(1))-1,'n' in f,'i' in f])
+  return output
+
+# Pre: a fields string, or a format and order
+# Post: function giving a comparable key for a line
+#       With neither set the line is its own key
+def get_sort_key(fields=None,format=None,order='location'):
+  if format:
+    if format not in _format_fields or order not in _format_fields[format]:
+      sys.stderr.write("ERROR: unknown sort format "+str(format)+" "+str(order)+"\n")
+      sys.exit()
+    fields = _format_fields[format][order]
+  if not fields: return None
+  cols = parse_fields(fields)
+  def key(line):
+    f = line.rstrip("\n").split("\t")
+    output = []
+    for [i,numeric,inverted] in cols:
+      v = ''
+      if i < len(f): v = f[i]
+      if numeric: v = _numeric(v)
+      if inverted:
+        if numeric: v = -v
+        else: v = _Inverted(v)
+      output.append(v)
+    output.append(line)
+    return output
+  return key
+
+def _sort_key_from_spec(spec):
+  return get_sort_key(fields=spec[0],format=spec[1],order=spec[2])
+
+# Pre: lines, sort key spec, file name to write the run to
+# Post: the run is written gzip compressed and the file name returned
+#       This is module level so it can be sent to a process pool
+def _write_run(lines,spec,filename,level):
+  key = _sort_key_from_spec(spec)
+  lines.sort(key=key)
+  of = gzip.open(filename,'wb',level)
+  of.write(''.join(lines))
+  of.close()
+  return filename
+
+# Read a run back with only about buffer_bytes of it in memory
+def _read_run(filename,key,buffer_bytes):
+  inf = gzip.open(filename,'rb')
+  while True:
+    lines = inf.readlines(buffer_bytes)
+    if not lines: break
+    if key:
+      for line in lines: yield [key(line),line]
+    else:
+      for line in lines: yield [line,line]
+  inf.close()
+
+class ExternalSort:
+  # Pre: (optional)
+  #      fields      sort fields like '1,2n,3ni'
+  #      format      gpd, psl, sam or bed to use its named order instead
+  #      order       location or name for the format
+  #      buffer_size lines held in memory per run
+  #      threads     processes sorting and spilling runs
+  #      tempdir     where the temporary directory of runs is made
+  #      level       gzip level of the spilled runs
+  #      merge_buffer bytes read at a time from each run while merging
+  #      merge_width most runs merged at once before merging the merges
+  def __init__(self,fields=None,format=None,order='location',buffer_size=1000000,threads=1,tempdir=None,level=1,merge_buffer=1000000,merge_width=128):
+    self._spec = [fields,format,order]
+    self._header_prefix = None
+    if format == 'sam': self._header_prefix = '@'
+    self._headers = []
+    self._key = _sort_key_from_spec(self._spec)
+    self._buffer_size = buffer_size
+    self._threads = threads
+    self._tempdir = tempdir
+    self._level = level
+    self._merge_buffer = merge_buffer
+    self._merge_width = merge_width
+    self._buffer = []
+    self._runs = []
+    self._pending = []
+    self._pool = None
+    self._dir = None
+    self._output = None
+    self._finished = False
+
+  # Add a line (with its newline) to be sorted
+  def write(self,line):
+    if self._header_prefix and line.startswith(self._header_prefix):
+      self._headers.append(line)
+      return
+    self._buffer.append(line)
+    if len(self._buffer) >= self._buffer_size:
+      self._spill()
+
+  def add(self,line):
+    self.write(line)
+
+  def _next_run_name(self):
+    if not self._dir:
+      if self._tempdir: self._dir = mkdtemp(prefix="weirathe.",dir=self._tempdir.rstrip('/'))
+      else: self._dir = mkdtemp(prefix="weirathe.")
+    return self._dir+'/r.'+str(len(self._runs)+len(self._pending))
+
+  def _spill(self):
+    if len(self._buffer) == 0: return
+    fname = self._next_run_name()
+    if self._threads > 1:
+      if not self._pool: self._pool = Pool(processes=self._threads)
+      # hold at most one outstanding run per process so memory stays bounded
+      while len(self._pending) >= self._threads:
+        self._runs.append(self._pending.pop(0).get())
+      self._pending.append(self._pool.apply_async(_write_run,args=(self._buffer,self._spec,fname,self._level)))
+    else:
+      self._runs.append(_write_run(self._buffer,self._spec,fname,self._level))
+    self._buffer = []
+
+  # Merge many runs into one so no more than merge_width are ever open
+  def _collapse_runs(self):
+    while len(self._runs) > self._merge_width:
+      group = self._runs[0:self._merge_width]
+      self._runs = self._runs[self._merge_width:]
+      fname = self._next_run_name()
+      of = gzip.open(fname,'wb',self._level)
+      for [k,line] in heapq.merge(*[_read_run(x,self._key,self._merge_buffer) for x in group]):
+        of.write(line)
+      of.close()
+      for x in group: os.remove(x)
+      self._runs.append(fname)
+
+  def _finish(self):
+    if self._finished: return
+    self._finished = True
+    if len(self._runs) == 0 and len(self._pending) == 0:
+      # everything fit in memory
+      self._buffer.sort(key=self._key)
+      self._output = chain(self._headers,self._buffer)
+      return
+    self._spill()
+    for r in self._pending: self._runs.append(r.get())
+    self._pending = []
+    if self._pool:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+    self._collapse_runs()
+    merged = heapq.merge(*[_read_run(x,self._key,self._merge_buffer) for x in self._runs])
+    self._output = chain(self._headers,(x[1] for x in merged))
+
+  # Post: the next sorted line, or an empty string when done
+  #       so the sorter can stand in for a file handle on a stream
+  #       like GPDStream feeding a LocusStream
+  def readline(self):
+    self._finish()
+    try:
+      return self._output.next()
+    except StopIteration:
+      return ''
+
+  def __iter__(self):
+    self._finish()
+    return self._output
+
+  # Write every sorted line to a file handle
+  def write_sorted(self,fh):
+    for line in self: fh.write(line)
+
+  # Remove the temporary runs
+  def close(self):
+    if self._pool:
+      self._pool.terminate()
+      self._pool = None
+    if self._dir:
+      rmtree(self._dir)
+      self._dir = None
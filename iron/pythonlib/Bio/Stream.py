@@ -1,6 +1,5 @@
-import sys
+import sys, gzip
 from Bio.Range import merge_ranges
-from subprocess import Popen, PIPE
 
 # Classes to help stream biological data
 
@@ -101,15 +100,11 @@ class MultiLocusStream:
     current_range.set_payload(output)
     return current_range
 
-# use gzip utility to compress output
+# gzip compressed output written in process
 class GZippedOutputFile:
   def __init__(self,filename):
-    self._fh = open(filename,'w')
-    cmd = "gzip"
-    self._pipe = Popen(cmd.split(),stdout=self._fh,stdin=PIPE,close_fds=True)
-    self._sh = self._pipe.stdin
+    self._sh = gzip.open(filename,'w')
   def write(self,value):
     self._sh.write(value)
   def close(self):
-    self._pipe.communicate()
-    self._fh.close()
+    self._sh.close()
@@ -1,8 +1,24 @@
-import sys, random, string, uuid, pickle, zlib, base64
-from Bio.Range import GenomicRange, ranges_to_coverage, merge_ranges
+import sys, os, random, string, pickle, zlib, base64
+from itertools import count
+from Bio.Range import GenomicRange, ranges_to_coverage, merge_ranges, RangeIndex
 from Bio.Sequence import rc
 import Bio.Graph
 
+_id_pid = None
+_id_count = None
+
+# Transcript ids are a counter prefixed by the process id, so they are
+# unique within a run including across pool workers, and cost a counter
+# step rather than a uuid4 from os.urandom
+# Post: a new id string
+def next_id():
+  global _id_pid, _id_count
+  pid = os.getpid()
+  if pid != _id_pid: # first call or we are a forked worker
+    _id_pid = pid
+    _id_count = count(1)
+  return str(pid)+'.'+str(next(_id_count))
+
 class Transcript:
   def __init__(self):
     self._exons = []
@@ -12,7 +28,7 @@ class Transcript:
     self._gene_name = None
     self._name = None # for a single name
     self._range = None # set if not chimeric
-    self._id = str(uuid.uuid4())
+    self._id = None # made by get_id when first needed
     self._payload = []
     self._sequence = None
 
@@ -98,7 +114,7 @@ class Transcript:
     self._initialize()
     ln = self.get_fake_gpd_line()
     return base64.b64encode(zlib.compress(pickle.dumps([ln,self._direction,self._transcript_name,self._gene_name,\
-                         self._range,self._id,self._payload,\
+                         self._range,self.get_id(),self._payload,\
                          self._sequence])))
   def load_serialized(self,instr):
     self._initialize()
@@ -115,6 +131,25 @@ class Transcript:
     self._payload = vals[6]
     self._sequence = vals[7]
 
+  # Post: one tab separated line of the direction, transcript name,
+  #       gene name, id and a gpd line of the exons
+  #       load_structure_line reads it back (no payload or sequence)
+  def get_structure_line(self):
+    self._initialize()
+    vals = [self._direction,self._transcript_name,self._gene_name]
+    vals = ['' if x is None else x for x in vals]
+    return "\t".join(vals+[self.get_id(),self.get_fake_gpd_line()])
+  def load_structure_line(self,line):
+    self._initialize()
+    f = line.split("\t",4)
+    import Bio.Format.GPD as inGPD
+    gpd = inGPD.GPD(f[4])
+    self.exons = gpd.exons
+    self.junctions = gpd.junctions
+    vals = [None if x == '' else x for x in f[0:3]]
+    [self._direction,self._transcript_name,self._gene_name] = vals
+    self._id = f[3]
+
   def get_junction_string(self):
     self._initialize()
     if len(self.exons) < 2: return None
@@ -127,8 +162,9 @@ class Transcript:
     self._initialize()
     return self._payload[0]
 
-  # Post: the unique python ID for this transcript
+  # Post: the unique ID for this transcript
   def get_id(self):
+    if self._id is None: self._id = next_id()
     return self._id
 
   # Post: Return the number of overlapping base pairs
@@ -247,6 +283,12 @@ class Transcript:
     self.set_sequence(ref_dict)
     return self._sequence
 
+  # Pre: the transcript sequence when it is already known
+  #      (like read from a stored emitter) rather than from a reference
+  def set_sequence_string(self,seq):
+    self._initialize()
+    self._sequence = seq
+
   def set_sequence(self,ref_dict):
     self._initialize()
     strand = '+'
@@ -645,24 +687,27 @@ class TranscriptLoci:
     self.merge_rules = TranscriptLociMergeRules('is_any_overlap')
     self.merge_rules.set_juntol(10)
     self.g = Bio.Graph.Graph()   
+    self._nodes = {} # transcript id to the node holding it
 
   def __str__(self):
     return str(len(self.g.get_nodes()))+ " nodes"  
 
+  # Rebuild the transcript id to node index, needed after graph
+  # operations like merge_cycles move transcripts between nodes
+  def _index_nodes(self):
+    self._nodes = {}
+    for n in self.g.get_nodes():
+      for tx in n.get_payload():
+        self._nodes[tx.get_id()] = n
+
   def remove_transcript(self,tx_id):
-    txs = self.get_transcripts()
-    if tx_id not in [x.get_id() for x in txs]:
+    if tx_id not in self._nodes:
       return
-    tx = [x for x in txs if x.get_id()==tx_id][0]
-    for n in [x for x in self.g.get_nodes()]:
-      if tx_id not in [y.get_id() for y in n.get_payload()]:
-        continue
+    n = self._nodes.pop(tx_id)
+    for tx in [x for x in n.get_payload() if x.get_id()==tx_id]:
       n.get_payload().remove(tx)
-      if len(n.get_payload())==0:
-        self.g.remove_node(n)      
-      #sys.stderr.write("\n"+str(n.get_payload())+"\n")
-      # 
-      #sys.stderr.write("\n"+str(len(n.get_payload()))+"\n")
+    if len(n.get_payload())==0:
+      self.g.remove_node(n)      
   def set_merge_rules(self,mr):  self.merge_rules = mr
 
   # using all the transcripts find the depth 
@@ -670,13 +715,13 @@ class TranscriptLoci:
     bedarray = []
     for tx in self.get_transcripts():
       for ex in [x.rng for x in tx.exons]: bedarray.append(ex)
-    cov = ranges_to_coverage(bedarray)
+    cov = RangeIndex(ranges_to_coverage(bedarray))
     results = {}
     for tx in self.get_transcripts():
       tlen = tx.get_length()
       bcov = []
       for ex in [x.rng for x in tx.exons]:     
-        excov = [[x.overlap_size(ex),x.get_payload()] for x in cov]
+        excov = [[x.overlap_size(ex),x.get_payload()] for x in cov.get_overlapped(ex)]
         for coved in [x for x in excov if x[0] > 0]:
           bcov.append(coved)
       total_base_coverage = sum([x[0]*x[1] for x in bcov])
@@ -717,6 +762,7 @@ class TranscriptLoci:
     #sys.stderr.write('-------partition_loci-----'+"\n")
     #sys.stderr.write(self.g.get_report()+"\n")
     self.g.merge_cycles()
+    self._index_nodes()
     #sys.stderr.write(self.g.get_report()+"\n")
     gs = self.g.partition_graph(verbose=verbose)
     tls = [] # makea list of transcript loci
@@ -740,16 +786,15 @@ class TranscriptLoci:
     return tls
 
   def add_transcript(self,tx):
-    for y in [x.get_payload() for x in self.g.get_nodes()]:
-      if tx.get_id in [z.get_id() for z in y]:
-        #if tx.get_id() in [[y.get_id() for y in x.get_payload()] for x in self.g.get_nodes()]:
-        sys.stderr.write("WARNING tx is already in graph\n")
-        return True
+    if tx.get_id() in self._nodes:
+      sys.stderr.write("WARNING tx is already in graph\n")
+      return True
     # transcript isn't part of graph yet
     n = Bio.Graph.Node([tx])
 
     other_nodes = self.g.get_nodes()
     self.g.add_node(n)
+    self._nodes[tx.get_id()] = n
     # now we need to see if its connected anywhere
     for n2 in other_nodes:
      tx2s = n2.get_payload()
@@ -1035,6 +1080,12 @@ class Transcriptome:
 
   def get_transcripts(self):
     return self.transcripts
+
+  # Pre: transcripts is a list, or anything that can be indexed and
+  #      iterated like one, such as transcripts built on demand from a
+  #      memory mapped file
+  def set_transcripts(self,transcripts):
+    self.transcripts = transcripts
       
   def add_transcript(self,transcript):
     self.transcripts.append(transcript)
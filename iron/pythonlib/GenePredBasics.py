@@ -714,25 +714,47 @@ def make_entry_from_starts_and_stops(name1,name2,chr,exons,strand):
   gpd.line_to_entry(line)
   return gpd  
 
+# A GenePredEntry that only reads the chromosome, strand and transcript
+# bounds from its line.  The exons and the rest of the entry are parsed
+# the first time entry, range_set, locus_range or junctions is used, so
+# streaming and grouping by locus only costs one short split per line.
+# Pre: a genepred line
+class LazyGenePredEntry(GenePredEntry):
+  def __init__(self,inline):
+    f = inline.split("\t",6)
+    self.line = inline
+    self.chrom = f[2]
+    self.strand = f[3]
+    self.txStart = int(f[4])
+    self.txEnd = int(f[5])
+  def __getattr__(self,name):
+    if name in ['entry','range_set','locus_range','junctions']:
+      self.line_to_entry(self.line)
+      return self.__dict__[name]
+    raise AttributeError(name)
+  def get_bed(self):
+    return RangeBasics.Bed(self.chrom,self.txStart,self.txEnd,self.strand)
+
 # Pre: Take a filehandle a reading in GenePred entries that have been sorted by location
 # Post: through the read_locus() method an array of genepred lines that are grouped by locus
 #       these have not been grouped by strand or overlap, only by outer bounds
+#       Entries are LazyGenePredEntry so each line is split once to find
+#       the locus and the exons are only parsed when they get used
+#       previous_range is [chrom, 1-based start, end] of the current locus
 class GenePredLocusStream:
   def __init__(self,fhin):
     self.fh = fhin
-    self.previous_line = self.fh.readline()
+    self.previous = None
     self.finished = False
-    self.range = None
     self.previous_range = None
     self.minimum_locus_gap = 0
-    if not self.previous_line:
+    line = self.fh.readline()
+    if not line:
       self.finished = True
       return
     # initialize previous range
-    gpd = GenePredEntry(self.previous_line)
-    bed = RangeBasics.Bed(gpd.entry['chrom'],gpd.entry['txStart'],gpd.entry['txEnd'])
-    self.previous_range = bed
-    #print "initialize"
+    self.previous = LazyGenePredEntry(line)
+    self.previous_range = [self.previous.chrom,self.previous.txStart+1,self.previous.txEnd]
     return
 
   def __iter__(self):
@@ -747,11 +769,10 @@ class GenePredLocusStream:
   def set_minimum_locus_gap(self,ingap):
     self.minimum_locus_gap = ingap
   def read_locus(self):
-    #print "open locus"
     if self.finished: return False
     buffer = []
-    if self.previous_line:
-      buffer.append(GenePredEntry(self.previous_line))
+    if self.previous:
+      buffer.append(self.previous)
     while True:
       line = self.fh.readline()
       if not line:
@@ -759,31 +780,43 @@ class GenePredLocusStream:
         if len(buffer) > 0:
           return buffer
         return None
-        # output buffer
-      if self.different_locus(line): # We have finished one locus
-        self.previous_line = line 
-        #print 'outputing'
+      gpd = LazyGenePredEntry(line)
+      self.previous = gpd
+      if self.different_locus(gpd): # We have finished one locus
         return buffer
-      buffer.append(GenePredEntry(line))
-      self.previous_line = line
-
-  def different_locus(self,gpd_line):
-    gpd = GenePredEntry(gpd_line)
-    bed = RangeBasics.Bed(gpd.entry['chrom'],gpd.entry['txStart'],gpd.entry['txEnd'])
+      buffer.append(gpd)
+
+  # Pre: batch_size maximum loci to return
+  # Post: a list of up to batch_size loci, empty when the stream is done
+  #       Lets a caller hand loci to a worker pool a batch at a time
+  def read_batch(self,batch_size):
+    batch = []
+    while len(batch) < batch_size:
+      locus = self.read_locus()
+      if not locus: break
+      batch.append(locus)
+    return batch
+
+  # Same test as Bed.overlaps_with_padding against the locus range
+  # padded by minimum_locus_gap, then merge it in
+  def different_locus(self,gpd):
+    chrom = gpd.chrom
+    start = gpd.txStart+1
+    end = gpd.txEnd
     if not self.previous_range:
-      self.previous_range = bed #update our range
+      self.previous_range = [chrom,start,end] #update our range
       return True
-    if bed.overlaps_with_padding(self.previous_range,self.minimum_locus_gap): # it overlaps with previous range
-      #print 'new old range:'
-      self.previous_range = self.previous_range.merge(bed)
-      #print self.previous_range.get_range_string()
+    [pchrom,pstart,pend] = self.previous_range
+    if chrom == pchrom and start <= pend+self.minimum_locus_gap and end >= max(1,pstart-self.minimum_locus_gap): # it overlaps with previous range
+      self.previous_range = [pchrom,min(pstart,start),max(pend,end)]
       return False
-    self.previous_range = bed
+    self.previous_range = [chrom,start,end]
     return True
 
 # Pre: Take 2 filehandles reading in GenePreds that have been sorted by position
 # Post: through the read_locus() method an array of genepred lines that are grouped by locus
 #       these have not been grouped by strand or overlap, only by outer bounds
+#       Entries are LazyGenePredEntry like GenePredLocusStream
 class GenePredDualLocusStream:
   def __init__(self,fhin1,fhin2):
     self.fh1 = fhin1
@@ -795,9 +828,9 @@ class GenePredDualLocusStream:
     self.used1 = False
     self.used2 = False
     if line1:
-      self.previous1 = GenePredEntry(line1)
+      self.previous1 = LazyGenePredEntry(line1)
     if line2:
-      self.previous2 = GenePredEntry(line2)
+      self.previous2 = LazyGenePredEntry(line2)
     self.finished1 = False
     self.finished2 = False
     #self.range1 = None
@@ -858,7 +891,7 @@ class GenePredDualLocusStream:
           self.finished1 = True
           # output buffer
         else:
-          g1 = GenePredEntry(line1)
+          g1 = LazyGenePredEntry(line1)
           if not buffer_range: buffer_range = g1.get_bed()
           #check and see if we are overlapped
           if g1.get_bed().overlaps_with_padding(buffer_range,self.minimum_locus_gap):
@@ -878,7 +911,7 @@ class GenePredDualLocusStream:
           self.finished2 = True
           # output buffer
         else:
-          g2 = GenePredEntry(line2)
+          g2 = LazyGenePredEntry(line2)
           if not buffer_range: buffer_range = g2.get_bed()
           if g2.get_bed().overlaps_with_padding(buffer_range,self.minimum_locus_gap):
             buffer[1].append(g2)
@@ -33,6 +33,8 @@
 # convert_entry_to_genepred_line() - change an entry (in dictionary format)
 #           to a genepred format line
 import re, sys
+from itertools import imap
+from operator import ne
 from RangeBasics import GenomicRange, Bed
 from SequenceBasics import rc as rc_seq
 
@@ -460,6 +462,14 @@ class PSL:
       qseq = query[qS:qE].upper()
       rseq = g[self.value('tName')][tS:tE].upper()
       #print qseq+"\n"+rseq+"\n"
+      if 'N' not in qseq and len(qseq) == blen and len(rseq) == blen:
+        # no N so the whole block can be compared at once
+        diff = sum(imap(ne,qseq,rseq))
+        misMatches += diff
+        matches += blen-diff
+        prev_qE = qE
+        prev_tE = tE
+        continue
       for j in range(0,blen):
         if qseq[j] == 'N':
           nCount += 1
@@ -1,5 +1,6 @@
 import sys, re
 from SequenceBasics import rc
+import Bio.Pairwise
 
 class PairwiseAlignment:
   def __init__(self):
@@ -45,42 +46,7 @@ def Snw(c1,c2):
   if c1 == c2: return 10
   else: return -5
 def needleman_wunsch(s1,s2):
-  F = []
-  d = -15
-  for i in range(0,len(s1)+1):
-    temp = []
-    F.append(temp)
-    for j in range(0,len(s2)+1):
-      F[i].append(0)
-  for i in range(0,len(s1)+1):
-    F[i][0] = d*i
-  for j in range(0,len(s2)+1):
-    F[0][j] = d*j
-  for i in range(1,len(F)):
-    for j in range(1,len(F[i])):
-      match = F[i-1][j-1]+Snw(s1[i-1],s2[j-1])
-      deletion = F[i-1][j]+d
-      insertion = F[i][j-1]+d
-      F[i][j] = max(match,deletion,insertion)
-  a1 = ''
-  a2 = ''
-  i = len(s1)
-  j = len(s2)
-  while i > 0 or j > 0:
-    if i > 0 and j > 0 and F[i][j] == F[i-1][j-1]+Snw(s1[i-1],s2[j-1]):
-      a1 = s1[i-1] + a1
-      a2 = s2[j-1] + a2
-      i -= 1
-      j -= 1
-    elif i > 0 and F[i][j] == F[i-1][j] + d:
-      a1 = s1[i-1] + a1
-      a2 = '-' + a2
-      i -= 1
-    else:
-      a1 = "-" + a1
-      a2 = s2[j-1]+a2
-      j -= 1
-  return [a1,a2,F[len(s1)][len(s2)]]
+  return Bio.Pairwise.needleman_wunsch(s1,s2,match=10,mismatch=-5,gap=-15)
 
 # The Alignment result from SmithWatermanAligner
 class Alignment:
@@ -254,79 +220,13 @@ class SmithWatermanAligner:
   # Modifies: STDOUT
   def print_matrix(self):
     M = self.M
-    if len(M) == 0: return
+    if not M: return
     for m in range(0,len(M)):
       oline = ''
       for n in range(0,len(M[0])):
         oline = oline + ' ' + str(M[m][n])
       print oline
 
+  # Post: [score, aligned s1, aligned s2, s1 start, s2 start]
   def execute_sw_alignment(self):
-    self.M = []
-    #Initialize Matrix
-    for i in range(0,len(self.s2)+1):
-      self.M.append([])
-      for j in range(0,len(self.s1)+1):
-        self.M[i].append({})
-        self.M[i][j]['score'] = 0
-        self.M[i][j]['pointer'] = 'none'
-    #Fill matrix
-    max_i = 0
-    max_j = 0
-    max_score = 0
-    for i in range(1,len(self.s2)+1):
-      for j in range(1,len(self.s1)+1):
-        diag_score = 0
-        left_score = 0
-        up_score = 0
-        chr1 = self.s1[j-1]
-        chr2 = self.s2[i-1]
-        if chr1 == chr2:
-          diag_score = self.M[i-1][j-1]['score']+self.match
-        else:
-          diag_score = self.M[i-1][j-1]['score']+self.mismatch
-        if self.M[i-1][j]['pointer'] == 'up':
-          up_score = self.M[i-1][j]['score']+self.gapextend
-        else:   
-          up_score = self.M[i-1][j]['score']+self.gapopen
-        if self.M[i-1][j]['pointer'] == 'left':
-          left_score = self.M[i][j-1]['score']+self.gapextend
-        else:
-          left_score = self.M[i][j-1]['score']+self.gapopen
-        if diag_score <= 0 and up_score <= 0 and left_score <= 0:
-          self.M[i][j]['score'] = 0
-          self.M[i][j]['pointer'] = 'none'
-          continue
-        if diag_score >= up_score and diag_score >= left_score:
-          self.M[i][j]['score'] = diag_score
-          self.M[i][j]['pointer'] = "diagonal"
-        elif up_score >= left_score:
-          self.M[i][j]['score'] = up_score
-          self.M[i][j]['pointer'] = "up"
-        else:
-          self.M[i][j]['score'] = left_score
-          self.M[i][j]['pointer'] = 'left'
-        if self.M[i][j]['score'] > max_score:
-          max_i = i
-          max_j = j
-          max_score = self.M[i][j]['score']
-    a1 = ''
-    a2 = ''
-    j = max_j
-    i = max_i
-    while True:
-      if self.M[i][j]['pointer'] == 'none': break
-      if self.M[i][j]['pointer'] == 'diagonal':
-        a1 = self.s1[j-1]+a1
-        a2 = self.s2[i-1]+a2
-        i-=1
-        j-=1
-      elif self.M[i][j]['pointer'] == 'left':
-        a1 = self.s1[j-1]+a1
-        a2 = '-'+ a2 
-        j-=1
-      elif self.M[i][j]['pointer'] == 'up':
-        a1 = '-'+a1
-        a2 = self.s2[i-1]+a2
-        i-=1
-    return [max_score, a1, a2, j, i]
+    return Bio.Pairwise.smith_waterman(self.s1,self.s2,match=self.match,mismatch=self.mismatch,gapopen=self.gapopen,gapextend=self.gapextend)
@@ -1,10 +1,14 @@
 import sys, re
+from Bio.Range import RangeIndex
 # These classes are to help deal with genomic coordinates and 
 # this associated with those coordinates.
 
 class GenomicRangeDictionary:
+  # Bigger than this and overlaps are found through a Bio.Range.RangeIndex
+  index_threshold = 32
   def __init__(self):
     self.members = []
+    self._index = None
 
   def length(self):
     return len(self.members)
@@ -17,10 +21,16 @@ class GenomicRangeDictionary:
 
   def add(self,genomic_range):
     self.members.append(genomic_range)
+    self._index = None
 
   # access based on key
   def get_overlapped(self,genomic_range):
     r = GenomicRangeDictionary()
+    if len(self.members) > self.index_threshold:
+      if not self._index: self._index = RangeIndex(self.members)
+      for m in self._index.get_overlapped(genomic_range):
+        r.add(m)
+      return r
     for m in self.members:
       if m.overlaps(genomic_range):
         r.add(m)
@@ -33,6 +43,7 @@ class GenomicRangeDictionary:
       if not m.overlaps(genomic_range):
         newmembers.append(m)
     self.members = newmembers
+    self._index = None
 
 #These are 1-index for both start and end
 class GenomicRange:
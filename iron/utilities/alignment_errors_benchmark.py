@@ -0,0 +1,91 @@
+#!/usr/bin/python
+import argparse, sys, time, random
+from Bio.Errors import AlignmentErrors
+
+# Time the homopolymer split and the per-base and context error
+# classification of AlignmentErrors
+# Reports alignments, aligned target bases, seconds and bases per second
+# With a bam and reference the alignments at least --min_length long are
+# used, otherwise --count synthetic reads of --length bases are made with
+# nanopore-like error rates
+
+def main():
+  args = do_inputs()
+  if args.bam:
+    alignments = bam_alignments(args)
+  else:
+    alignments = [SyntheticAlignment(args.length,args.error_rate) for i in range(0,args.count)]
+  z = 0
+  bases = 0
+  start = time.time()
+  for a in alignments:
+    ae = AlignmentErrors(a)
+    if len(ae.get_HPAGroups()) == 0: continue
+    z += 1
+    bases += len(ae.get_target_sequence())
+    ae.get_context_query_errors()
+    ae.close()
+  elapsed = time.time()-start
+  rate = 0
+  if elapsed > 0: rate = bases/elapsed
+  sys.stdout.write(str(z)+"\t"+str(bases)+"\t"+'{0:.3f}'.format(elapsed)+"\t"+'{0:.1f}'.format(rate)+"\n")
+
+def bam_alignments(args):
+  from Bio.Format.Sam import BAMFile
+  from Bio.Format.Fasta import FastaData
+  ref = FastaData(open(args.reference).read())
+  bf = BAMFile(args.bam,reference=ref)
+  output = []
+  for e in bf:
+    if not e.is_aligned(): continue
+    if e.get_target_range().length() < args.min_length: continue
+    output.append(e)
+    if len(output) >= args.count: break
+  bf.close()
+  return output
+
+# Stands in for an alignment with only what AlignmentErrors needs
+class SyntheticAlignment:
+  def __init__(self,length,error_rate):
+    target = []
+    query = []
+    for i in range(0,length):
+      nt = random.choice('ACGT')
+      r = random.random()
+      if r < error_rate/3: # deletion
+        target.append(nt)
+        query.append('-')
+      elif r < 2*error_rate/3: # insertion
+        target.extend(['-',nt])
+        query.extend([random.choice('ACGT'),nt])
+      elif r < error_rate: # mismatch
+        target.append(nt)
+        query.append(random.choice([x for x in 'ACGT' if x != nt]))
+      else:
+        target.append(nt)
+        query.append(nt)
+    self._query = ''.join(query)
+    self._target = ''.join(target)
+    self._quality = ''.join([chr(random.randint(33,60)) if x != '-' else '\0' for x in query])
+  def get_alignment_strings(self,min_intron_size=68):
+    return [[self._query],[self._target],[self._quality]]
+  def get_query_quality(self):
+    return self._quality.replace('\0','')
+  def get_strand(self):
+    return '+'
+
+def do_inputs():
+  parser = argparse.ArgumentParser(description="Report AlignmentErrors throughput as alignments, target bases, seconds, bases per second",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--bam',help="BAM file of alignments to use instead of synthetic reads")
+  parser.add_argument('--reference',help="reference fasta for --bam")
+  parser.add_argument('--min_length',type=int,default=5000,help="shortest target span of a --bam alignment to use")
+  parser.add_argument('--count',type=int,default=10,help="number of alignments")
+  parser.add_argument('--length',type=int,default=20000,help="synthetic read length")
+  parser.add_argument('--error_rate',type=float,default=0.12,help="synthetic read error rate")
+  args = parser.parse_args()
+  if args.bam and not args.reference:
+    parser.error("--reference is required with --bam")
+  return args
+
+if __name__=="__main__":
+  main()
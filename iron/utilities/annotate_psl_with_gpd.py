@@ -2,6 +2,8 @@
 import sys, re, random, os, multiprocessing
 import argparse
 import json
+from array import array
+from bisect import bisect_left, bisect_right
 import GenePredBasics, PSLBasics, FileBasics, BigFileBasics
 from shutil import rmtree
 
@@ -84,7 +86,9 @@ def main():
 
   # break the new gpd into jobs
   sys.stderr.write("Splitting job\n")
-  params['num_jobs'] = break_gpdfile(params['tdir'],params['args'].jobsize)
+  bfcr = BigFileBasics.BigFileChunkReader(params['tdir']+'/longreads.gpd')
+  bfcr.set_chunk_size_bytes(params['args'].jobsize)
+  params['num_jobs'] = bfcr.chunk_count
 
   simplenames = [] #names to be used to label columns
   for file in params['args'].gpdfile:
@@ -95,27 +99,23 @@ def main():
     simplenames.append(name)
   params['simplenames'] = simplenames
 
-  # convert reference genepreds to bed fies
+  # index the reference exons once, before the pool forks so every
+  # worker shares the same copy
+  global _reference
   sys.stderr.write("Parsing reference file\n")
-  parse_refgpd(params['tdir'],params['args'].gpdfile,params['simplenames'])
+  _reference = ReferenceExons(params['args'].gpdfile,params['simplenames'])
 
   if not params['args'].threads: params['args'].threads = multiprocessing.cpu_count()
-  if params['args'].threads > 1:
-    p = multiprocessing.Pool(processes=params['args'].threads)
-  # make a job list
   sys.stderr.write("Entering multiprocessing annotations "+str(params['num_jobs'])+" jobs on "+str(params['args'].threads)+" cpus\n")
-  for j in range(1,params['num_jobs']+1):
-    # The business happens here with execute job.
-    if params['args'].threads > 1:
-      p.apply_async(execute_job,[params['tdir'],j,params['args'].gpdfile,params['overlap_fraction'],params['args'].minmatchbases])
-    else:
-      execute_job(params['tdir'],j,params['args'].gpdfile,params['overlap_fraction'],params['args'].minmatchbases)
-    #execute_job(params['tdir'],j,params['args'].gpdfile,params['overlap_fraction'],params['args'].minmatchbases)
+  # The business happens here with execute job.
+  #   each job hands back its annotation rows, in job order
+  jobs = [[params['tdir'],j,params['args'].jobsize,params['overlap_fraction'],params['args'].minmatchbases] for j in range(1,params['num_jobs']+1)]
   if params['args'].threads > 1:
-    p.close()
-    p.join()
+    p = multiprocessing.Pool(processes=params['args'].threads)
+    job_rows = p.imap(execute_job_star,jobs)
+  else:
+    job_rows = (execute_job_star(x) for x in jobs)
 
-  
   # Print out the raw data here if we want it
   #   and save our best match per read/gpd 
   read_gpd = {}
@@ -125,32 +125,34 @@ def main():
   if params['args'].rawoutput:
     of_raw = open(params['args'].rawoutput,'w')
     of_raw.write(ostring)
-  for j in range(1,params['num_jobs']+1):
-    with open(params['tdir']+"/annotated_match."+str(j)+".txt") as inf:
-      for line in inf:
-        f = line.rstrip("\n").split("\t")
-        my_gpd = f[5]
-        my_read = f[1]
-        columns[int(f[4])] = my_gpd
-        if my_read not in read_gpd:  
-          read_gpd[my_read] = {}
-        if my_gpd not in read_gpd[my_read]:
-          read_gpd[my_read][my_gpd] = {}
-          read_gpd[my_read][my_gpd]['Full'] = {}
-          read_gpd[my_read][my_gpd]['Full']['best_hit'] = False
-          read_gpd[my_read][my_gpd]['Full']['matches'] = 0
-          read_gpd[my_read][my_gpd]['Partial'] = {}
-          read_gpd[my_read][my_gpd]['Partial']['best_hit'] = False
-          read_gpd[my_read][my_gpd]['Partial']['matches'] = 0
-          read_gpd[my_read][my_gpd]['Best'] = False
-        total_matches = int(f[11])
-        if f[9] == 'Full' and total_matches > read_gpd[my_read][my_gpd]['Full']['matches']:
-          read_gpd[my_read][my_gpd]['Full']['matches'] = total_matches
-          read_gpd[my_read][my_gpd]['Full']['best_hit'] = f
-        if f[9] == 'Partial' and total_matches > read_gpd[my_read][my_gpd]['Partial']['matches']:
-          read_gpd[my_read][my_gpd]['Partial']['matches'] = total_matches
-          read_gpd[my_read][my_gpd]['Partial']['best_hit'] = f
-        if params['args'].rawoutput: of_raw.write(line.rstrip("\n")+"\n")
+  for rows in job_rows:
+    for line in rows:
+      f = line.rstrip("\n").split("\t")
+      my_gpd = f[5]
+      my_read = f[1]
+      columns[int(f[4])] = my_gpd
+      if my_read not in read_gpd:  
+        read_gpd[my_read] = {}
+      if my_gpd not in read_gpd[my_read]:
+        read_gpd[my_read][my_gpd] = {}
+        read_gpd[my_read][my_gpd]['Full'] = {}
+        read_gpd[my_read][my_gpd]['Full']['best_hit'] = False
+        read_gpd[my_read][my_gpd]['Full']['matches'] = 0
+        read_gpd[my_read][my_gpd]['Partial'] = {}
+        read_gpd[my_read][my_gpd]['Partial']['best_hit'] = False
+        read_gpd[my_read][my_gpd]['Partial']['matches'] = 0
+        read_gpd[my_read][my_gpd]['Best'] = False
+      total_matches = int(f[11])
+      if f[9] == 'Full' and total_matches > read_gpd[my_read][my_gpd]['Full']['matches']:
+        read_gpd[my_read][my_gpd]['Full']['matches'] = total_matches
+        read_gpd[my_read][my_gpd]['Full']['best_hit'] = f
+      if f[9] == 'Partial' and total_matches > read_gpd[my_read][my_gpd]['Partial']['matches']:
+        read_gpd[my_read][my_gpd]['Partial']['matches'] = total_matches
+        read_gpd[my_read][my_gpd]['Partial']['best_hit'] = f
+      if params['args'].rawoutput: of_raw.write(line.rstrip("\n")+"\n")
+  if params['args'].threads > 1:
+    p.close()
+    p.join()
 
   if params['args'].bestoutput: 
     ostring = "psl_entry_id\tread_name\tread_exons\treference_exons\tgpd_column_number\t"
@@ -205,87 +207,164 @@ def get_cov(f1,f2):
   if f1 <= 0 or f2 <= 0: return 0
   return min(float(f1)/float(f2),float(f2)/float(f1))
 
+# The reference exons of every genepred file
+#   Built once by main before the workers are forked so they all
+#   read the same index without it being copied or written out
+_reference = None
+
+# Sorted, array backed index of the reference exons
+#   Each genepred file (column) keeps, per chromosome, exon starts
+#   sorted with their ends, a running maximum of the ends, and the
+#   exon's order in the file, entry number and exon number.
+#   The entry tables are indexed by entry number (1-based) which
+#   counts across all the files in the order given.
+class ReferenceExons:
+  # Pre: genepred filenames, and the short names used for their columns
+  def __init__(self,geneprednames,simplenames):
+    self.columns = [None] # column keyed chr keyed arrays
+    self.column = [0]
+    self.gpdname = [None]
+    self.gene = [None]
+    self.transcript = [None]
+    self.exon_count = array('i',[0])
+    self.strand = [None]
+    self.length = array('l',[0])
+    for file in geneprednames:
+      self._add_file(file,simplenames[len(self.columns)-1])
+
+  def _add_file(self,file,simplename):
+    column_number = len(self.columns)
+    bychr = {}
+    exon_order = 0
+    gfr = FileBasics.GenericFileReader(file)
+    while True:
+      line = gfr.readline()
+      if not line: break
+      if re.match('^#',line): continue
+      entry = GenePredBasics.line_to_entry(line.rstrip("\n"))
+      entry_number = len(self.column)
+      entry_length = 0
+      for i in range(0,len(entry['exonStarts'])): entry_length += entry['exonEnds'][i]-entry['exonStarts'][i]
+      self.column.append(column_number)
+      self.gpdname.append(simplename)
+      self.gene.append(entry['gene_name'])
+      self.transcript.append(entry['name'])
+      self.exon_count.append(len(entry['exonStarts']))
+      self.strand.append(entry['strand'])
+      self.length.append(entry_length)
+      if entry['chrom'] not in bychr: bychr[entry['chrom']] = []
+      for i in range(0,len(entry['exonStarts'])):
+        bychr[entry['chrom']].append((entry['exonStarts'][i],entry['exonEnds'][i],exon_order,entry_number,i+1))
+        exon_order += 1
+    gfr.close()
+    chrs = {}
+    for chr in bychr:
+      exons = sorted(bychr[chr])
+      max_ends = array('l')
+      m = 0
+      for e in exons:
+        if e[1] > m: m = e[1]
+        max_ends.append(m)
+      chrs[chr] = [array('l',[e[0] for e in exons]),array('l',[e[1] for e in exons]),max_ends, \
+                   array('l',[e[2] for e in exons]),array('l',[e[3] for e in exons]),array('i',[e[4] for e in exons])]
+    self.columns.append(chrs)
+
+  # Pre: column number (1-based), chromosome, bed style start and end
+  # Post: [exon order, entry number, exon number, overlap bases, exon length]
+  #       for each reference exon overlapping by at least one base
+  def overlaps(self,column,chr,start,end):
+    if chr not in self.columns[column]: return []
+    [starts,ends,max_ends,orders,entries,numbers] = self.columns[column][chr]
+    lo = bisect_right(max_ends,start)
+    hi = bisect_left(starts,end)
+    output = []
+    for i in range(lo,hi):
+      if ends[i] <= start: continue
+      output.append([orders[i],entries[i],numbers[i],min(end,ends[i])-max(start,starts[i]),ends[i]-starts[i]])
+    return output
+
 # This is how we call the process of working on one of our results
-# Pre: Temporary Directory, job number, list of genepred files, overlap_fraction
+# Pre: Temporary Directory, job number, job size, overlap_fraction
+#      minimum matched bases.
 #      where overlap fraction is an array of the required overlap for the
 #      first, internal, and last exons
-# 
-def execute_job(tdir,j,geneprednames,overlap_fraction,min_match_bp):
-  of = open(tdir+'/annotated_match.'+str(j)+'.txt','w')
-  for i in range(1,len(geneprednames)+1):
-    # Assign jobid as the job number, and the genepred column number
-    jobid = str(j)+"_"+str(i)
-    pre_annotate(tdir,tdir+'/reference.'+str(i)+'.bed',tdir+'/partreads.'+str(j)+'.bed',of,jobid,overlap_fraction,min_match_bp)
-  of.close()
-  #annotate(tdir,j,geneprednames)
-  return jobid
-
-# This pre-annotate is where we actually overlap the files
-#   We do an intersection opertation, then we read through the
-#   intersection seeing if it meets criteria for matching
-# Pre:  Temporary Directory
-#       Reference genepred bed file
-#       long reads job bed file
-#       output file handle for 'unannotated full match'
-#       jobid jobnumber underscore column number (genepred file number)
+# Post: the annotation rows for the job, one column after another
+def execute_job(tdir,j,job_size,overlap_fraction,min_match_bp):
+  reads = read_job(tdir,j,job_size)
+  rows = []
+  for i in range(1,len(_reference.columns)):
+    pre_annotate(reads,i,rows,overlap_fraction,min_match_bp)
+  return rows
+
+def execute_job_star(args):
+  return execute_job(*args)
+
+# Read one job's segment of the long read genepred
+# Pre:  Temporary directory, job number (1-based), job size (bytes)
+# Post: list of long reads
+#    [PSL entry number, read name, chrom, exon starts, exon ends]
+def read_job(tdir,j,job_size):
+  bfcr = BigFileBasics.BigFileChunkReader(tdir+'/longreads.gpd')
+  bfcr.set_chunk_size_bytes(job_size)
+  oc = bfcr.open_chunk(j-1)
+  reads = []
+  while True:
+    line = oc.read_line()
+    if not line: break
+    entry = GenePredBasics.line_to_entry(line.rstrip("\n"))
+    reads.append([int(entry['name']),entry['gene_name'],entry['chrom'],entry['exonStarts'],entry['exonEnds']])
+  oc.close()
+  return reads
+
+# This pre-annotate is where we actually overlap the reads
+#   Each read exon is looked up in the reference index, then we read
+#   through the overlaps seeing if they meet criteria for matching
+# Pre:  long reads from read_job
+#       column number of the genepred file to annotate against
+#       list to append the annotation rows to
 #       overlap fraction
-# Post: writes intersection of beds for each bed file
-#       into unannotated_match.(job).txt
+#       minimum matched bases
+# Post: appends an annotation row for each read and reference entry
 #   1.  Reads PSL entry number
 #   2.  Read name
 #   3.  Observed exon count
 #   4.  Reference exon count
-#   5.  Reference entry number
-#   6.  Consecutive exon match(s)
-
-def pre_annotate(tdir,ref_file,obs_file,of,jobid,overlap_fraction,min_match_bp):
-  #print ref_file + "\t" + obs_file
-  cmd = "bedtools intersect -wo " 
-  #if overlap_fraction > 0: cmd += "-r -f "+str(overlap_fraction)
-  cmd += " -a " + ref_file + " -b " + obs_file + " > " + tdir + "/intersect."+jobid+".bed" 
-  #print cmd
-  os.system(cmd)
-  # now parse the intersection file
-
-  # check for a full length match
+#   5.  Reference column number
+#   ... followed by the reference names and the match report
+
+def pre_annotate(reads,column,of,overlap_fraction,min_match_bp):
+  ref = _reference
+  hits = {}
+  first = {}
+  for [obs_id,obs_name,chr,starts,ends] in reads:
+    for k in range(0,len(starts)):
+      obslen = ends[k]-starts[k]
+      for [order,ref_id,ref_exon_number,overlap,reflen] in ref.overlaps(column,chr,starts[k],ends[k]):
+        if obs_id not in hits:
+          hits[obs_id] = []
+          first[obs_id] = order
+        elif order < first[obs_id]: first[obs_id] = order
+        hits[obs_id].append([order,k+1,ref_id,ref_exon_number,overlap,reflen,obslen,obs_name,len(starts)])
+
+  # Fill the results in the order the reference exons come in the file,
+  #   so the reads and references are met in the same order as before
   results = {}
-  with open(tdir+'/intersect.'+jobid+'.bed') as inf:
-    for line in inf:
-      f = line.rstrip("\n").split("\t")
-      ref_exon_count = int(f[6])
-      obs_exon_count = int(f[14])
-      #if ref_exon_count != obs_exon_count:
-      #  continue
-      ref_exon = f[0]+':'+f[1]+'-'+f[2]
-      obs_exon = f[9]+':'+f[10]+'-'+f[11]
-      ref_id = int(f[3])
-      obs_id = int(f[12])
-      obs_name = f[13]
-      if obs_id not in results:
-        results[obs_id] = {}
+  for obs_id in sorted(hits.keys(),key=lambda x: (first[x],x)):
+    results[obs_id] = {}
+    for [order,obs_exon_number,ref_id,ref_exon_number,overlap,reflen,obslen,obs_name,obs_exon_count] in sorted(hits[obs_id]):
       if ref_id not in results[obs_id]:
         results[obs_id][ref_id] = {}
         results[obs_id][ref_id]['read_name'] = obs_name
-        results[obs_id][ref_id]['matches'] = set()
-        results[obs_id][ref_id]['ref_exon_count'] = ref_exon_count
+        results[obs_id][ref_id]['ref_exon_count'] = ref.exon_count[ref_id]
         results[obs_id][ref_id]['obs_exon_count'] = obs_exon_count
-        results[obs_id][ref_id]['name'] = f[4]
-        results[obs_id][ref_id]['transcript'] = f[5]
-        results[obs_id][ref_id]['ref_strand'] = f[7]
+        results[obs_id][ref_id]['ref_strand'] = ref.strand[ref_id]
         results[obs_id][ref_id]['exons_ref'] = {}
         results[obs_id][ref_id]['exon_overlap'] = {}
-      results[obs_id][ref_id]['matches'].add(str(ref_exon)+'_'+str(obs_exon))
-      reflen = int(f[2])-int(f[1])
-      obslen = int(f[11])-int(f[10])
-      overlap = int(f[17])
       # get the overlap fraction
       if reflen == 0 or obslen == 0:
-        sys.stderr.write(line+"\n")
         smallest = 0
       else:
         smallest = sorted([float(overlap)/float(reflen), float(overlap)/float(obslen)])[0]
-      ref_exon_number = int(f[8])
-      obs_exon_number = int(f[16])
       results[obs_id][ref_id]['exons_ref'][ref_exon_number] = obs_exon_number
       if ref_exon_number not in results[obs_id][ref_id]['exon_overlap']:
         results[obs_id][ref_id]['exon_overlap'][ref_exon_number] = {}
@@ -293,19 +372,6 @@ def pre_annotate(tdir,ref_file,obs_file,of,jobid,overlap_fraction,min_match_bp):
       results[obs_id][ref_id]['exon_overlap'][ref_exon_number][obs_exon_number]['bp'] = overlap
       results[obs_id][ref_id]['exon_overlap'][ref_exon_number][obs_exon_number]['frac'] = smallest
 
-
-  d = {}
-  with open(tdir+"/entries.txt") as inf:
-    for line in inf:
-      f = line.rstrip("\n").split("\t")
-      ref_id = int(f[2])
-      if ref_id not in d: d[ref_id] = {}
-      d[ref_id]['column'] = int(f[0])
-      d[ref_id]['gpdname'] = f[1]
-      d[ref_id]['gene'] = f[3]
-      d[ref_id]['transcript'] = f[4]
-      d[ref_id]['length'] = f[5]
-
   #Go through the results and find the best consecutive exons
   for obs_id in results:
     for ref_id in results[obs_id]:
@@ -375,103 +441,16 @@ def pre_annotate(tdir,ref_file,obs_file,of,jobid,overlap_fraction,min_match_bp):
       gappedtype = 'N'
       if len(passing_consec) > 1:
         gappedtype = 'Y'
-      of.write(str(obs_id) + "\t" + results[obs_id][ref_id]['read_name'] + "\t" \
+      of.append(str(obs_id) + "\t" + results[obs_id][ref_id]['read_name'] + "\t" \
                + str(results[obs_id][ref_id]['obs_exon_count']) + "\t" \
                + str(results[obs_id][ref_id]['ref_exon_count']) + "\t" \
-               + str(d[ref_id]['column']) + "\t" + d[ref_id]['gpdname'] + "\t" \
-               + d[ref_id]['gene'] + "\t" + d[ref_id]['transcript'] + "\t" \
+               + str(ref.column[ref_id]) + "\t" + ref.gpdname[ref_id] + "\t" \
+               + ref.gene[ref_id] + "\t" + ref.transcript[ref_id] + "\t" \
                + matchstring + "\t"  \
                + matchtype + "\t" + gappedtype + "\t" \
                + str(total_aligned_bases) + "\t" + str(total_aligned_exons) + "\t" \
                + str(longest_fragment_aligned_bases) + "\t" + str(longest_fragment_exon_count) + "\t" \
-               + str(d[ref_id]['length']) + "\n")
-
-#Parse the reference genepred(s) into bed file
-#Pre: temporary directory, genepredfilenames, simplenames
-#     temporary directory - path to temporary directory
-#     genepredfilenames - list of reference gpd filenames
-#     simplenames - list of genepred short names
-#Post: Bed file with the following format
-#  1.  chrom
-#  2.  start 0-base
-#  3.  end 1-base
-#  4.  reference gpd entry line number
-#  5.  gene name
-#  6.  transcript name
-#  7.  number of exons in reference gpd entry
-#  8.  strand
-#  9.  exon number
-#  Writes to two places.  entries.txt and reference.(column_number).bed
-def parse_refgpd(tdir,geneprednames,simplenames):
-  # get the reference genepreds ready to use in work
-  column_number = 0
-  entry_number = 0
-  of_entries = open(tdir+"/entries.txt",'w')
-  for file in geneprednames:
-    column_number += 1
-    of_ref = open(tdir+"/reference."+str(column_number)+".bed",'w')
-    gfr = FileBasics.GenericFileReader(file)
-    while True:
-      line = gfr.readline()
-      if not line: break
-      if re.match('^#',line): continue
-      entry_number += 1
-      line = line.rstrip("\n")
-      entry = GenePredBasics.line_to_entry(line)
-      entry_length = 0
-      for i in range(0,len(entry['exonStarts'])): entry_length += entry['exonEnds'][i]-entry['exonStarts'][i]
-      of_entries.write(str(column_number)+ "\t" + simplenames[column_number-1] + "\t" + str(entry_number) + "\t" + entry['gene_name'] + "\t" + entry['name']+"\t"+str(entry_length)+"\n")
-      exon_number = 0
-      for i in range(0,len(entry['exonStarts'])):
-        exon_number += 1
-        of_ref.write(entry['chrom'] + "\t" + str(entry['exonStarts'][i]) + "\t" \
-                   + str(entry['exonEnds'][i]) + "\t" + str(entry_number) + "\t" \
-                   + entry['gene_name'] + "\t" \
-                   + entry['name'] + "\t" + str(len(entry['exonStarts'])) + "\t" \
-                   + entry['strand'] + "\t" + str(exon_number) \
-                   + "\n")
-    gfr.close()
-    of_ref.close()
-  of_entries.close()
-
-# Break the genpred into jobs
-# Pre:  Temporary directory, job size (int)
-# Post:  Write a bed file from each jobs segement of the genepred file
-#        Bed file format is as follows:
-#    1.  chrom
-#    2.  start
-#    3.  end
-#    4.  PSL entry number
-#    5.  read name
-#    6.  number of exons
-#    7.  strand
-#    8.  exon_number
-#  Write the bed files into partreads.(job).bed
-#  job is an integer 1-based
-#  we return the number of jobs also
-def break_gpdfile(tdir,job_size):
-  bfcr = BigFileBasics.BigFileChunkReader(tdir+'/longreads.gpd')
-  bfcr.set_chunk_size_bytes(job_size)
-  num_jobs = bfcr.chunk_count
-  for i in range(0,bfcr.chunk_count):
-    oc = bfcr.open_chunk(i)
-    job = i+1
-    of_bed = open(tdir+'/partreads.'+str(job)+'.bed','w')
-    while True:
-      line = oc.read_line()
-      if not line: break
-      line = line.rstrip("\n")
-      entry = GenePredBasics.line_to_entry(line)
-      exon_number = 0
-      for i in range(0,len(entry['exonStarts'])):
-        exon_number += 1
-        of_bed.write(entry['chrom'] + "\t" + str(entry['exonStarts'][i]) + "\t" \
-                     + str(entry['exonEnds'][i]) + "\t" + entry['name']+"\t" \
-                     + entry['gene_name'] + "\t" + str(len(entry['exonStarts'])) + "\t" \
-                     + entry['strand'] + "\t" + str(exon_number) + "\n")   
-    oc.close()
-    of_bed.close()
-  return num_jobs
+               + str(ref.length[ref_id]) + "\n")
 
 #Write the genepred
 # Pre: temp directory, the psl file, smoothing factor (min intron size)
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+import argparse, sys, time
+from Bio.Format.Sam import BAMFile
+
+# Measure how fast BAMFile can iterate and decode records
+# Reports records per second for a few levels of decoding
+#  basic  - only the fixed fields (qname, flag, position)
+#  cigar  - basic plus the cigar and target range
+#  full   - every field including sequence, quality and tags
+
+def main():
+  args = do_inputs()
+  for mode in args.modes:
+    bf = BAMFile(args.input,lazy=args.lazy,threads=args.threads)
+    z = 0
+    start = time.time()
+    for e in bf:
+      z += 1
+      e.value('qname')
+      e.value('flag')
+      if mode != 'basic':
+        e.get_cigar()
+        if e.is_aligned(): e.get_target_range()
+      if mode == 'full':
+        e.value('seq')
+        e.value('qual')
+        e.value('remainder')
+      if args.count and z >= args.count: break
+    bf.close()
+    elapsed = time.time()-start
+    rate = 0
+    if elapsed > 0: rate = z/elapsed
+    sys.stdout.write(mode+"\t"+str(z)+"\t"+'{0:.3f}'.format(elapsed)+"\t"+'{0:.1f}'.format(rate)+"\n")
+
+def do_inputs():
+  parser = argparse.ArgumentParser(description="Report BAM decoding throughput as mode, records, seconds, records per second",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('input',help="BAM file")
+  parser.add_argument('--modes',nargs='+',choices=['basic','cigar','full'],default=['basic','cigar','full'],help="decoding levels to time")
+  parser.add_argument('--lazy',action='store_true',help="iterate LazyBAM records that decode fields on demand")
+  parser.add_argument('--threads',type=int,default=1,help="threads for read-ahead block decompression")
+  parser.add_argument('--count',type=int,help="stop after this many records")
+  args = parser.parse_args()
+  return args
+
+if __name__=="__main__":
+  main()
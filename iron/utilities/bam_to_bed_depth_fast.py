@@ -1,10 +1,12 @@
 #!/usr/bin/python
 import sys, argparse, tempfile, os, StringIO, gzip
-from subprocess import PIPE, Popen
 from multiprocessing import Pool, cpu_count
 from Bio.Format.Sam import BAMFile, SAM
+from Bio.Range import GenomicRange, Coverage
 
-ps = None
+# Depth of aligned exons as bedGraph.  Each chromosome is read through
+# the region index and its coverage worked out in process, so the
+# output comes out sorted by chromosome and position without a sort.
 
 def main():
   parser = argparse.ArgumentParser(description="",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -16,71 +18,51 @@ def main():
   if args.tempdir: args.tempdir = args.tempdir.rstrip('/')
   bf = BAMFile(args.input)
   seqs = bf.get_header().get_sequence_lengths()
-  f = tempfile.NamedTemporaryFile(delete=False)
-  for seq in seqs:
-    f.write(seq+"\t"+str(seqs[seq])+"\n")
-  f.close()
+  # region index shared by every chromosome, built once if there is no .bai
+  args.index = args.input+'.bai'
+  index_temp = None
+  if not os.path.exists(args.index):
+    index_temp = tempfile.NamedTemporaryFile(delete=False,dir=args.tempdir)
+    index_temp.close()
+    args.index = index_temp.name
+    bf.write_region_index(args.index)
   bf.close()
-  fout = tempfile.NamedTemporaryFile(delete=False)
-  cmd = 'sort -k 1,1 -k2,2n -k3,3n -S4G --parallel='+str(args.threads)
-  if args.tempdir: cmd += ' -T '+args.tempdir
-  global ps
-  ps = Popen(cmd.split(),stdin=PIPE,stdout=fout)
-
-  if args.threads > 1:
-    poo = Pool(processes=args.threads)
-  for seq in seqs:
-    if args.threads > 1:
-      poo.apply_async(do_seq,args=(seq,args,f.name),callback=do_output)
-    else:
-      res = do_seq(seq,args,f.name)
-      do_output(res)
-  if args.threads > 1:
-    poo.close()
-    poo.join()
-  ps.communicate()
-  fout.close()
   of = sys.stdout
   if args.output:
     if args.output[-3:]=='.gz':
       of = gzip.open(args.output,'w')
     else:
       of = open(args.output,'w')
-  cmd = 'sort -k 1,1 -k2,2n -k3,3n -S4G --parallel='+str(args.threads)
-  inf = open(fout.name)
-  p = Popen(cmd.split(),stdout=PIPE,stdin=inf)
-  for line in p.stdout:
-    of.write(line)
-  p.communicate()
-  inf.close()
+  jobs = [[seq,args] for seq in sorted(seqs)]
+  if args.threads > 1:
+    poo = Pool(processes=args.threads)
+    results = poo.imap(do_seq,jobs)
+  else:
+    results = (do_seq(x) for x in jobs)
+  for res in results:
+    of.write(res)
+  if args.threads > 1:
+    poo.close()
+    poo.join()
   of.close()
-  os.unlink(f.name)
-  os.unlink(fout.name)
+  if index_temp: os.unlink(index_temp.name)
 
-def do_output(res):
-  if not res: return
-  global ps
-  inf = StringIO.StringIO(res)
-  for line in inf:
-    ps.stdin.write(line)
-  inf.close()
-
-def do_seq(seq,args,fname):
-  cmd = 'samtools view '+args.input+' '+seq
-  p = Popen(cmd.split(),stdout=PIPE)
-  cmd = 'bedtools genomecov -i - -bg -g '+fname
-  po2 = Popen(cmd.split(),stdin=PIPE,stdout=PIPE)
-  cmd = 'sort -k 1,1 -k2,2n -k3,3n -S1G --parallel='+str(args.threads)
-  if args.tempdir: cmd += ' -T '+args.tempdir
-  po1 = Popen(cmd.split(),stdin=PIPE,stdout=po2.stdin)
-  for line in p.stdout:
-    sam = SAM(line)
-    if not sam.is_aligned(): continue
+# Pre: [chromosome, args]
+# Post: bedGraph text for that chromosome
+def do_seq(v):
+  [seq,args] = v
+  bf = BAMFile(args.input)
+  bf.get_region_index(args.index)
+  seqlen = bf.get_header().get_sequence_length(seq)
+  cov = Coverage()
+  for sam in bf.fetch_by_range(GenomicRange(seq,1,seqlen)):
     for ex in sam.get_target_transcript(min_intron=68).exons:
-      bed = "\t".join([str(x) for x in ex.get_range().get_bed_array()])
-      po1.stdin.write(bed+"\n")
-  po1.communicate()
-  res = po2.communicate()[0]
+      cov.add(ex.get_range())
+  bf.close()
+  of = StringIO.StringIO()
+  cov.write_bedgraph(of)
+  res = of.getvalue()
+  of.close()
   return res
 
 if __name__=="__main__":
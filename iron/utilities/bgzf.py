@@ -9,6 +9,8 @@ def main():
   group.add_argument('-z','--zip',action='store_true',help="compress the file or stream")
   group.add_argument('-x','--unzip',action='store_true',help="uncompress the archive or stream")
   parser.add_argument('-o','--output',help="output file")
+  parser.add_argument('--threads',type=int,default=1,help="threads to compress or decompress blocks with")
+  parser.add_argument('--level',type=int,default=9,choices=range(0,10),help="compression level")
   args = parser.parse_args()
   
   of = sys.stdout
@@ -17,17 +19,17 @@ def main():
   if args.input == '-':
     if args.unzip:
       inf = sys.stdin
-      br = Bio.Format.BGZF.reader(inf)
+      br = Bio.Format.BGZF.reader(inf,threads=args.threads)
     else: 
       inf = sys.stdin
-      bw = Bio.Format.BGZF.writer(of)
+      bw = Bio.Format.BGZF.writer(of,threads=args.threads,level=args.level)
   else: 
     if args.unzip:
       inf = open(args.input,'rb')
-      br = Bio.Format.BGZF.reader(inf)
+      br = Bio.Format.BGZF.reader(inf,threads=args.threads)
     else: 
       inf = open(args.input,'rb')
-      bw = Bio.Format.BGZF.writer(of)
+      bw = Bio.Format.BGZF.writer(of,threads=args.threads,level=args.level)
 
   if args.unzip:
     while True:
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+import argparse, sys, gzip
+from Bio.Format.Fasta import FastaHandle, write_packed_fasta
+
+# Convert a reference fasta to the 2-bit packed reference format
+# that Bio.Format.Fasta.PackedFastaFile memory maps, so worker
+# processes can share one read-only copy of a genome.
+# Bases other than ACGTN are stored as N, lower case is kept.
+
+def main():
+  args = do_inputs()
+  if args.input == '-': inf = sys.stdin
+  elif args.input[-3:] == '.gz': inf = gzip.open(args.input)
+  else: inf = open(args.input)
+  write_packed_fasta(args.output,progress(FastaHandle(inf)))
+  inf.close()
+  sys.stderr.write("\n")
+
+def progress(seqs):
+  for s in seqs:
+    sys.stderr.write("packing "+s.name+"          \r")
+    yield s
+
+def do_inputs():
+  parser = argparse.ArgumentParser(description="Pack a fasta into a memory mappable 2-bit reference",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('input',help="FASTA file, can be gzipped, or - for STDIN")
+  parser.add_argument('-o','--output',required=True,help="packed reference file to write")
+  args = parser.parse_args()
+  return args
+
+if __name__=="__main__":
+  main()
@@ -1,7 +1,7 @@
 #!/usr/bin/python
 import sys, argparse
 from ArtificalReferenceSequenceBasics import ARS, decode_ars_name
-from SequenceBasics import read_fasta_into_hash
+from Bio.Format.Fasta import FastaFile
 import GenePredBasics
 from RangeBasics import Bed
 
@@ -13,7 +13,8 @@ def main():
   args = parser.parse_args()
   of  = sys.stdout
   if args.output: of = open(args.output,'w')
-  f = read_fasta_into_hash(args.reference_fasta)
+  # exon sequences are read from the indexed fasta as they are needed
+  f = FastaFile(args.reference_fasta)
   with open(args.gpd_file) as inf:
     for line in inf:
       gpd = GenePredBasics.GenePredEntry()
@@ -25,7 +26,7 @@ def main():
         beds.append(b)
       ars.set_bounds(beds)
       ars.set_name(gpd.value('name'))
-      ars.set_sequence_from_original_reference_hash(f)
+      ars.construct_sequences(f)
       of.write(ars.get_fasta())
 
 if __name__=="__main__":
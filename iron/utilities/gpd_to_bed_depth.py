@@ -2,7 +2,7 @@
 import sys, argparse, gzip, re
 from Bio.Format.GPD import GPDStream
 from Bio.Stream import LocusStream
-from Bio.Range import ranges_to_coverage
+from Bio.Range import Coverage
 
 from multiprocessing import cpu_count, Pool
 
@@ -31,14 +31,13 @@ def main(args):
   inf.close()
 
 def do_locus(locus):
-  exranges = []
+  cov = Coverage()
   for entry in locus.get_payload():
     for exon in entry.exons:
-      exranges.append(exon.get_range())
-  covs = ranges_to_coverage(exranges)
+      cov.add(exon.get_range())
   output = []
-  for cov in covs:    
-    output.append("\t".join([str(x) for x in cov.get_bed_coordinates()])+"\t"+str(+cov.get_payload())+"\n")
+  for [chr,start,end,depth] in cov.generate_runs():
+    output.append(chr+"\t"+str(start-1)+"\t"+str(end)+"\t"+str(depth)+"\n")
   return output
 
 def generate_gpd (loci):
@@ -7,7 +7,7 @@ from tempfile import mkdtemp, gettempdir
 from subprocess import PIPE, Popen
 
 from Bio.Format.GPD import GPDStream
-from Bio.Format.Fasta import FastaData
+from Bio.Format.Fasta import FastaFile
 from Bio.Sequence import Seq
 
 # The stratified best_X_covered option requires external calls and bedtools
@@ -27,7 +27,7 @@ def main():
       inf = open(args.input)
 
   sys.stderr.write("reading in fasta\n")
-  f = FastaData(open(args.reference).read())
+  f = FastaFile(args.reference)
   sh = GPDStream(inf)
   gc_bins = range(0,args.number_of_bins)
   bin_handles = []
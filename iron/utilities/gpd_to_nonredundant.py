@@ -14,6 +14,7 @@ of_table = None
 warning_count = 0
 locus_count = 0
 downsampcount = 0
+_args = None
 
 def main():
   #do our inputs
@@ -23,23 +24,38 @@ def main():
   of_table = args.output_original_table
   global of_main
   of_main = args.output
+  # set before the pool so workers inherit args (open files can't be pickled)
+  global _args
+  _args = args
   gpdls = GenePredLocusStream(args.input)
   lcount = 0
   if args.threads > 1:
     p = Pool(processes=args.threads)
-  for locus in gpdls:
-    lcount += 1
-    # When a locus too many reads use random downsampling
-    # to reduce to a more manageable number of reads
-    if len(locus) > args.downsample:
-      locus = downsample(locus,args.downsample,500)
+  # Loci go to the workers a batch at a time and no more than a few
+  # batches per thread are waiting, so a long input is never all in memory
+  # and results are written in input order
+  pending = []
+  while True:
+    batch = gpdls.read_batch(args.batch_size)
+    if len(batch) == 0: break
+    jobs = []
+    for locus in batch:
+      lcount += 1
+      # When a locus too many reads use random downsampling
+      # to reduce to a more manageable number of reads
+      if len(locus) > args.downsample:
+        locus = downsample(locus,args.downsample,500)
+      jobs.append([lcount,locus])
     #Execute Per Locus analysis with results passed to do_results() callback
     if args.threads > 1:
-      p.apply_async(process_locus,args=(lcount,locus,args),callback=do_results)
+      while len(pending) >= args.threads*4:
+        do_batch_results(pending.pop(0).get())
+      pending.append(p.apply_async(process_batch,args=(jobs,)))
     else:
-      r = process_locus(lcount,locus,args)
-      do_results(r)
+      do_batch_results(process_batch(jobs))
   if args.threads > 1:
+    for r in pending:
+      do_batch_results(r.get())
     p.close()
     p.join()
   #Close the table output if we are making it
@@ -73,6 +89,12 @@ def downsample(locus,downsize,guarantee):
   for x in mlocus[0:downsize]: locus.append(x)
   return locus
 
+# Pre: results of process_batch
+# Post: each locus result passed to do_results in order
+def do_batch_results(outs):
+  for r in outs:
+    do_results(r)
+
 # Callback to output results
 # Pre: array contains gpdlines, tablelines, location
 #      gpdlines is the gpd output
@@ -100,6 +122,12 @@ def do_results(outs):
     of_table.write(tablelines)
   glock.release()
 
+# Pre: jobs - list of [lcount, locus]
+# Post: list of process_locus results in the same order
+#       args come from the _args global set before the pool was made
+def process_batch(jobs):
+  return [process_locus(lcount,locus,_args) for [lcount,locus] in jobs]
+
 # Run the processing of the locus
 #   Executes either a 'do_reduction' or 'do_prediction'
 #   processing of data based on args
@@ -540,6 +568,7 @@ def do_inputs():
   group.add_argument('--specific_tempdir',help="This temporary directory will be used, but will remain after executing.")
   parser.add_argument('-j','--junction_tolerance',default=0,type=int,help="how many bases to search and combine junctions")
   parser.add_argument('-v','--verbose',action='store_true')
+  parser.add_argument('--batch_size',type=int,default=20,help="INT loci sent to a thread at a time")
   parser.add_argument('--downsample',type=int,default=2000,help="Maximum read depth at locus. sample down to random subset this size")
   parser.add_argument('--predict',action='store_true',help="build out longer reads based on the inputs")
   parser.add_argument('--minimum_compatible_junctions',default=2,type=int,help="require at least this many junctions overlapped to consider two gpds compatible")
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+import argparse, sys, time, random
+from Bio.Pairwise import needleman_wunsch, needleman_wunsch_score, needleman_wunsch_scores, smith_waterman, smith_waterman_score
+
+# Time the Bio.Pairwise kernels against the list-of-lists cell by cell
+# fills they replaced (kept below as the reference)
+# Prints method, pairs, seconds, pairs per second and whether the
+# results agree with the reference
+# Pairs are a random sequence and a copy of it with --error_rate of
+# mismatches, insertions and deletions, like a read against the
+# reference near a junction.  The batch test aligns one read against
+# --options targets at a time the way junctions are chosen.
+
+def main():
+  args = do_inputs()
+  random.seed(args.seed)
+  pairs = []
+  for i in range(0,args.count):
+    s = random_seq(args.length)
+    pairs.append([mutate(s,args.error_rate),s])
+
+  [expected,t] = timed(lambda: [reference_needleman_wunsch(a,b) for [a,b] in pairs])
+  report('reference_nw',len(pairs),t,True)
+  [v,t] = timed(lambda: [needleman_wunsch(a,b) for [a,b] in pairs])
+  report('nw',len(pairs),t,v==expected)
+  [v,t] = timed(lambda: [needleman_wunsch(a,b,band=args.band) for [a,b] in pairs])
+  report('nw_band_'+str(args.band),len(pairs),t,v==expected)
+  [v,t] = timed(lambda: [needleman_wunsch_score(a,b) for [a,b] in pairs])
+  report('nw_score',len(pairs),t,v==[x[2] for x in expected])
+
+  # one query against many targets
+  batches = []
+  for [a,b] in pairs[0:max(1,args.count/args.options)]:
+    batches.append([a,[mutate(b,args.error_rate/2) for j in range(0,args.options)]])
+  n = sum([len(x[1]) for x in batches])
+  [expected,t] = timed(lambda: [[reference_needleman_wunsch(q,x)[2] for x in targets] for [q,targets] in batches])
+  report('reference_nw_options',n,t,True)
+  [v,t] = timed(lambda: [needleman_wunsch_scores([[q,x] for x in targets]) for [q,targets] in batches])
+  report('nw_scores_batch',n,t,v==expected)
+  [v,t] = timed(lambda: [needleman_wunsch_scores([[q,x] for x in targets],band=args.band) for [q,targets] in batches])
+  report('nw_scores_batch_band_'+str(args.band),n,t,v==expected)
+
+  [expected,t] = timed(lambda: [reference_smith_waterman(b,a) for [a,b] in pairs])
+  report('reference_sw',len(pairs),t,True)
+  [v,t] = timed(lambda: [smith_waterman(b,a) for [a,b] in pairs])
+  report('sw',len(pairs),t,v==expected)
+  [v,t] = timed(lambda: [smith_waterman_score(b,a) for [a,b] in pairs])
+  report('sw_score',len(pairs),t,v==[x[0] for x in expected])
+
+def timed(f):
+  start = time.time()
+  v = f()
+  return [v,time.time()-start]
+
+def report(name,pairs,elapsed,same):
+  rate = 0
+  if elapsed > 0: rate = pairs/elapsed
+  sys.stdout.write(name+"\t"+str(pairs)+"\t"+'{0:.3f}'.format(elapsed)+"\t"+'{0:.1f}'.format(rate)+"\t"+str(same)+"\n")
+
+def random_seq(length):
+  return ''.join([random.choice('ACGT') for i in range(0,length)])
+
+def mutate(seq,rate):
+  output = []
+  for c in seq:
+    r = random.random()
+    if r < rate/3: continue
+    elif r < 2*rate/3: output.extend([random.choice('ACGT'),c])
+    elif r < rate: output.append(random.choice('ACGT'))
+    else: output.append(c)
+  return ''.join(output)
+
+# The global alignment as it was filled before Bio.Pairwise
+def reference_needleman_wunsch(s1,s2):
+  F = []
+  d = -15
+  for i in range(0,len(s1)+1):
+    F.append([0]*(len(s2)+1))
+  for i in range(0,len(s1)+1):
+    F[i][0] = d*i
+  for j in range(0,len(s2)+1):
+    F[0][j] = d*j
+  for i in range(1,len(F)):
+    for j in range(1,len(F[i])):
+      match = F[i-1][j-1]+(10 if s1[i-1] == s2[j-1] else -5)
+      F[i][j] = max(match,F[i-1][j]+d,F[i][j-1]+d)
+  a1 = ''
+  a2 = ''
+  i = len(s1)
+  j = len(s2)
+  while i > 0 or j > 0:
+    if i > 0 and j > 0 and F[i][j] == F[i-1][j-1]+(10 if s1[i-1] == s2[j-1] else -5):
+      a1 = s1[i-1] + a1
+      a2 = s2[j-1] + a2
+      i -= 1
+      j -= 1
+    elif i > 0 and F[i][j] == F[i-1][j] + d:
+      a1 = s1[i-1] + a1
+      a2 = '-' + a2
+      i -= 1
+    else:
+      a1 = "-" + a1
+      a2 = s2[j-1]+a2
+      j -= 1
+  return [a1,a2,F[len(s1)][len(s2)]]
+
+# The local alignment as SmithWatermanAligner filled it before Bio.Pairwise
+def reference_smith_waterman(s1,s2,match=10,mismatch=-15,gapopen=-10,gapextend=-5):
+  M = []
+  for i in range(0,len(s2)+1):
+    M.append([])
+    for j in range(0,len(s1)+1):
+      M[i].append({'score':0,'pointer':'none'})
+  max_i = 0
+  max_j = 0
+  max_score = 0
+  for i in range(1,len(s2)+1):
+    for j in range(1,len(s1)+1):
+      if s1[j-1] == s2[i-1]: diag_score = M[i-1][j-1]['score']+match
+      else: diag_score = M[i-1][j-1]['score']+mismatch
+      if M[i-1][j]['pointer'] == 'up': up_score = M[i-1][j]['score']+gapextend
+      else: up_score = M[i-1][j]['score']+gapopen
+      if M[i-1][j]['pointer'] == 'left': left_score = M[i][j-1]['score']+gapextend
+      else: left_score = M[i][j-1]['score']+gapopen
+      if diag_score <= 0 and up_score <= 0 and left_score <= 0: continue
+      if diag_score >= up_score and diag_score >= left_score:
+        M[i][j] = {'score':diag_score,'pointer':'diagonal'}
+      elif up_score >= left_score:
+        M[i][j] = {'score':up_score,'pointer':'up'}
+      else:
+        M[i][j] = {'score':left_score,'pointer':'left'}
+      if M[i][j]['score'] > max_score:
+        max_i = i
+        max_j = j
+        max_score = M[i][j]['score']
+  a1 = ''
+  a2 = ''
+  j = max_j
+  i = max_i
+  while True:
+    if M[i][j]['pointer'] == 'none': break
+    if M[i][j]['pointer'] == 'diagonal':
+      a1 = s1[j-1]+a1
+      a2 = s2[i-1]+a2
+      i-=1
+      j-=1
+    elif M[i][j]['pointer'] == 'left':
+      a1 = s1[j-1]+a1
+      a2 = '-'+ a2
+      j-=1
+    elif M[i][j]['pointer'] == 'up':
+      a1 = '-'+a1
+      a2 = s2[i-1]+a2
+      i-=1
+  return [max_score, a1, a2, j, i]
+
+def do_inputs():
+  parser = argparse.ArgumentParser(description="Time the pairwise alignment kernels",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('--count',type=int,default=200,help="INT pairs to align")
+  parser.add_argument('--length',type=int,default=150,help="INT bases in each sequence")
+  parser.add_argument('--error_rate',type=float,default=0.1,help="FLOAT fraction of bases changed between the pair")
+  parser.add_argument('--band',type=int,default=20,help="INT diagonals either side for the banded runs")
+  parser.add_argument('--options',type=int,default=20,help="INT targets per query in the batch test")
+  parser.add_argument('--seed',type=int,default=1)
+  args = parser.parse_args()
+  return args
+
+if __name__=="__main__":
+  main()
@@ -5,6 +5,7 @@ from GenePredBasics import GenePredEntry
 from PSLBasics import PSL
 from subprocess import Popen, PIPE
 from RangeBasics import Bed
+from Bio.Range import coverage_runs
 
 def main():
   parser = argparse.ArgumentParser()
@@ -28,37 +29,21 @@ def main():
   if args.input != '-': p.communicate()
 
 def process_locus(locus, args):
-  depth = {}
   s2psl = SAMtoPSLconversionFactory()
-  unique = {}
+  starts = []
+  ends = []
   chr = locus[0].value('rname')
   for sam in locus:
     p = PSL(s2psl.convert_line(sam.get_line()))
     g = GenePredEntry(p.get_genepred_line())
     g = g.get_smoothed(args.min_intron)
     for i in range(0,g.get_exon_count()):
-      rng = str(g.value('exonStarts')[i])+"\t"+str(g.value('exonEnds')[i])
-      if rng not in unique: unique[rng] = 0
-      unique[rng]+=1
-  for bstr in unique:
-    [start,end] = bstr.split("\t")
-    for i in range(int(start),int(end)):
-      if i not in depth:  depth[i] = 0
-      depth[i] += unique[bstr] # add the number of these to the depth
+      starts.append(g.value('exonStarts')[i]+1)
+      ends.append(g.value('exonEnds')[i])
   #now we can print the depth
-  prevdepth = 0
-  prevstart = None
-  lasti = None
-  for i in sorted(depth.keys()):
-    if depth[i] < args.min_depth: continue
-    if depth[i] != prevdepth: #output what we have so far if we have something
-      if prevstart: 
-        output_depth(chr+"\t"+str(prevstart)+"\t"+str(lasti+1)+"\t"+str(prevdepth),args)
-      prevstart = i
-    prevdepth = depth[i]
-    lasti = i
-  if prevstart:
-    output_depth(chr+"\t"+str(prevstart)+"\t"+str(lasti+1)+"\t"+str(prevdepth),args)
+  for [start,end,d] in coverage_runs(starts,ends):
+    if d < args.min_depth: continue
+    output_depth(chr+"\t"+str(start-1)+"\t"+str(end)+"\t"+str(d),args)
 
 def output_depth(ostr,args):
   if args.verbose: sys.stderr.write(" ".join(ostr.split("\t")[0:3])+"                        \r")
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+import argparse, sys, os, time, random
+from subprocess import Popen, PIPE
+from tempfile import mkdtemp, gettempdir
+from shutil import rmtree
+from multiprocessing import cpu_count
+from Bio.Sort import ExternalSort
+
+# Time Bio.Sort.ExternalSort against GNU sort on the same input
+# Prints method, lines, seconds, lines per second and whether the
+# outputs agree (GNU sort is run with LC_ALL=C for byte order)
+# Use --lines to generate a random gpd-like input of that many lines
+
+_gnu_keys = {
+  'location':'-k3,3 -k5,5n -k6,6n -k4,4',
+  'name':'-k1,1 -k2,2'
+}
+
+def main():
+  args = do_inputs()
+  tdir = mkdtemp(prefix="weirathe.",dir=args.tempdir.rstrip('/'))
+  input = args.input
+  if not input:
+    input = tdir+'/input.gpd'
+    make_input(input,args.lines)
+  lines = 0
+  # GNU sort
+  gnu_out = tdir+'/gnu.txt'
+  env = dict(os.environ)
+  env['LC_ALL'] = 'C'
+  cmd = 'sort '+_gnu_keys[args.order]+' -S'+args.memory+' --parallel='+str(args.threads)+' -T '+tdir+' -o '+gnu_out+' '+input
+  start = time.time()
+  p = Popen(cmd.split(),env=env)
+  p.communicate()
+  gnu_time = time.time()-start
+  # ExternalSort
+  ext_out = tdir+'/external.txt'
+  start = time.time()
+  s = ExternalSort(format='gpd',order=args.order,buffer_size=args.buffer_size,threads=args.threads,tempdir=tdir)
+  with open(input) as inf:
+    for line in inf:
+      lines += 1
+      s.write(line)
+  with open(ext_out,'w') as of:
+    s.write_sorted(of)
+  s.close()
+  ext_time = time.time()-start
+  same = files_match(gnu_out,ext_out)
+  report('gnu_sort',lines,gnu_time,same)
+  report('external_sort',lines,ext_time,same)
+  rmtree(tdir)
+
+def report(name,lines,elapsed,same):
+  rate = 0
+  if elapsed > 0: rate = lines/elapsed
+  sys.stdout.write(name+"\t"+str(lines)+"\t"+'{0:.3f}'.format(elapsed)+"\t"+'{0:.1f}'.format(rate)+"\t"+str(same)+"\n")
+
+def files_match(f1,f2):
+  with open(f1) as inf1:
+    with open(f2) as inf2:
+      for l1 in inf1:
+        if l1 != inf2.readline(): return False
+      if inf2.readline(): return False
+  return True
+
+def make_input(fname,lines):
+  of = open(fname,'w')
+  for i in range(0,lines):
+    chr = 'chr'+str(random.randint(1,22))
+    start = random.randint(0,100000000)
+    end = start+random.randint(100,10000)
+    of.write('gene'+str(random.randint(0,lines))+"\t"+'tx'+str(i)+"\t"+chr+"\t"+random.choice(['+','-'])+"\t"+str(start)+"\t"+str(end)+"\t"+str(start)+"\t"+str(end)+"\t1\t"+str(start)+",\t"+str(end)+",\n")
+  of.close()
+
+def do_inputs():
+  parser = argparse.ArgumentParser(description="Compare external sort speed to GNU sort",formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument('input',nargs='?',help="gpd file to sort, or generate one with --lines")
+  parser.add_argument('--lines',type=int,default=1000000,help="lines of random gpd to make when no input is given")
+  parser.add_argument('--order',choices=['location','name'],default='location')
+  parser.add_argument('--threads',type=int,default=cpu_count())
+  parser.add_argument('--buffer_size',type=int,default=1000000,help="lines per run for the external sort")
+  parser.add_argument('--memory',default='4G',help="GNU sort buffer size")
+  parser.add_argument('--tempdir',default=gettempdir())
+  args = parser.parse_args()
+  return args
+
+if __name__=="__main__":
+  main()
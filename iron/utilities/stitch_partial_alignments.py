@@ -1,10 +1,18 @@
 #!/usr/bin/python
 import argparse, sys, re, json, multiprocessing
-from SequenceBasics import read_fasta_into_hash, GenericFastqFileReader, GenericFastaFileReader, rc
+from SequenceBasics import GenericFastqFileReader, GenericFastaFileReader, rc
 from GenePredBasics import GenePredFile
+from Bio.Format.Fasta import read_reference
+from Bio.Pairwise import needleman_wunsch, needleman_wunsch_scores
 import PSLBasics
 
-combo_results = []
+# The reference genome and reference splices
+#   Set in main before the pool is made so the workers inherit them
+#   when they fork.  A packed reference is a read-only memory map so
+#   every worker reads the same pages, and only chromosome names are
+#   sent with each locus.
+_ref = None
+_reference_splices = {}
 
 # This software takes as an input, partial alignments in psl format 
 # from programs such as BWA-mem.  If you only have a sam file to begin
@@ -14,27 +22,34 @@ combo_results = []
 # together within a given locus range.  For this reason, it is imperative
 # that the queries all have unique names.  Therefore the prealignment
 # fasta or fastq file will be required and checked for this.
+#
+# The psl is streamed one read at a time so the alignments of a read
+# must be together (sorted by query name, like sort.py --format psl
+# --order name).  Loci are stitched on a pool of processes and written
+# out in the order they were read.
 
 def main():
   parser = argparse.ArgumentParser(description="splice together partial alignments")
   group1 = parser.add_mutually_exclusive_group(required=True)
   group1.add_argument('--fastq_reads')
   group1.add_argument('--fasta_reads')
-  parser.add_argument('--genome',help="FASTA reference genome",required=True)
+  parser.add_argument('--genome',help="FASTA reference genome, or a packed reference from fasta_to_packed_reference.py to share one memory mapped copy between the threads",required=True)
   parser.add_argument('--genepred',help="Transcriptome genepred")
   parser.add_argument('--max_intron_size',type=int,default=100000,help="INT maximum intron size")
   parser.add_argument('--min_intron_size',type=int,default=68,help="INT minimum intron size")
   parser.add_argument('--max_gap_size',type=int,default=10,help="INT gap size in query to join")
   parser.add_argument('--max_search_expand',type=int,default=10,help="INT max search space to expand search for junction")
+  parser.add_argument('--band',type=int,default=0,help="INT only score junction choices within this many diagonals of the direct alignment, 0 for the full matrix")
   parser.add_argument('--direction_specific',action='store_true',help="The direction of the transcript is known and properly oriented already")
   parser.add_argument('--threads',type=int,default=0,help="INT number of threads to use default cpu_count")
   parser.add_argument('-o','--output',default='-',help="FILENAME output results to here rather than STDOUT which is default")
-  parser.add_argument('input_alignment',help="FILENAME input .psl file or '-' for STDIN")
+  parser.add_argument('input_alignment',help="FILENAME input .psl file or '-' for STDIN, with each read's alignments together")
   args = parser.parse_args()
 
+  global _ref, _reference_splices
   # Read our reference genome
   sys.stderr.write("Reading reference\n")
-  ref = read_fasta_into_hash(args.genome)
+  _ref = read_reference(args.genome)
 
   # Make sure our reads are unique
   sys.stderr.write("Checking for unqiuely named reads\n")
@@ -47,129 +62,126 @@ def main():
     cpu_count = args.threads
 
   #Set reference splices (if any are available)
-  reference_splices = {}
   if args.genepred:
     sys.stderr.write("Reading reference splices from genepred\n")
-    reference_splices = get_reference_splices(args)
+    _reference_splices = get_reference_splices(args)
 
-  sys.stderr.write("Reading alignments into loci\n")
-
-  # Get locus division (first stage)
-  # Each read (qName) is separated
-  # Then each locus will be specific to at chromosome (tName)
-  # Then by (strand), but keep in mind this is the is based on the read
-  # Each locus should be specific to a direction but we don't necessarily
-  # know direction based on the data we have thus far.  
   inf = sys.stdin
   if args.input_alignment != '-': inf = open(args.input_alignment,'r')
-  loci = {}
+  ofh = sys.stdout
+  if not args.output == '-':
+    ofh = open(args.output,'w')
+
+  sys.stderr.write("Work on each read in each locus with "+str(cpu_count)+" CPUs\n")
+  p = None
+  if cpu_count > 1: p = multiprocessing.Pool(processes=cpu_count)
+  # hold a few loci per process so the workers stay busy but
+  # memory stays bounded, and write results in the order they were sent
+  pending = []
+  locus_count = 0
+  for locus in stream_loci(inf,args):
+    locus_count += 1
+    [locus_set,chr] = locus
+    if locus_set[0]['qName'] not in reads:
+      sys.stderr.write("ERROR: no sequence for read "+locus_set[0]['qName']+"\n")
+      sys.exit()
+    job = (locus_set,args,chr,reads[locus_set[0]['qName']],locus_count)
+    if not p:
+      do_locus_callback(execute_locus(*job),ofh)
+      continue
+    while len(pending) >= cpu_count*4:
+      do_locus_callback(pending.pop(0).get(),ofh)
+    pending.append(p.apply_async(execute_locus,job))
+  for r in pending:
+    do_locus_callback(r.get(),ofh)
+  if p:
+    p.close()
+    p.join() 
+  sys.stderr.write("\nfinished\n")
+  ofh.close()
+
+# Get locus division
+# Each read (qName) is separated
+# Then each locus will be specific to at chromosome (tName)
+# Then by (strand), but keep in mind this is the is based on the read
+# Each locus should be specific to a direction but we don't necessarily
+# know direction based on the data we have thus far.  
+# Pre: psl file handle with each read's alignments together
+# Post: yields [locus set, chromosome] one read at a time, a read's
+#       chromosomes and strands in the order they were seen and its
+#       loci in target order
+def stream_loci(inf,args):
+  seen = set()
+  group = []
   for line in inf:
     line = line.rstrip()
     if re.match('^#',line): continue
     psl = PSLBasics.line_to_entry(line)
-    if psl['qName'] not in loci:
-      loci[psl['qName']] = {}
-    if psl['tName'] not in loci[psl['qName']]:
-      loci[psl['qName']][psl['tName']] = {}
-    if psl['strand'] not in loci[psl['qName']][psl['tName']]:
-      loci[psl['qName']][psl['tName']][psl['strand']] = {}
-    if psl['tStarts'][0] not in loci[psl['qName']][psl['tName']][psl['strand']]:
-      loci[psl['qName']][psl['tName']][psl['strand']][psl['tStarts'][0]] = []
-    loci[psl['qName']][psl['tName']][psl['strand']][psl['tStarts'][0]].append(psl)
-
-  sys.stderr.write("breaking loci by genomic distance\n")
-  for qname in loci:
-    for chr in loci[qname]:
-      for strand in loci[qname][chr]:
-        #print qname + "\t" + chr + "\t" + strand
-        starts = loci[qname][chr][strand].keys()
+    if len(group) > 0 and psl['qName'] != group[0]['qName']:
+      for locus in get_read_loci(group,args): yield locus
+      group = []
+    if len(group) == 0:
+      if psl['qName'] in seen:
+        sys.stderr.write("ERROR: alignments for "+psl['qName']+" are not together, sort the psl by query name\n")
+        sys.exit()
+      seen.add(psl['qName'])
+    group.append(psl)
+  if len(group) > 0:
+    for locus in get_read_loci(group,args): yield locus
+
+# Pre: all the alignments of one read
+# Post: list of [locus set, chromosome]
+#       alignments within max_intron_size of each other are one locus
+def get_read_loci(group,args):
+  loci = {}
+  keys = []
+  for psl in group:
+    key = (psl['tName'],psl['strand'])
+    if key not in loci:
+      loci[key] = []
+      keys.append(key)
+    loci[key].append(psl)
+  output = []
+  for key in keys:
+    current_set = []
+    last_end = -1*(args.max_intron_size+2)
+    # stable sort keeps alignments that start together in input order
+    for e in sorted(loci[key],key=lambda x: x['tStarts'][0]):
+      start = e['tStarts'][0]+1 # base-1 start of start of alignment
+      if start > last_end+args.max_intron_size:
+        # we have the start of a new set
+        if len(current_set) > 0: 
+          output.append([current_set,key[0]])
         current_set = []
-        locus_sets = []
-        last_end = -1*(args.max_intron_size+2)
-        for start in sorted(starts):
-          for e in loci[qname][chr][strand][start]:
-            start = e['tStarts'][0]+1 # base-1 start of start of alignment
-            if start > last_end+args.max_intron_size:
-              # we have the start of a new set
-              if len(current_set) > 0: 
-                locus_sets.append(current_set)
-              current_set = []
-            last_end = e['tStarts'][len(e['tStarts'])-1]+e['blockSizes'][len(e['tStarts'])-1]
-            current_set.append(e)
-        if len(current_set) > 0:
-          locus_sets.append(current_set)
-        loci[qname][chr][strand] = locus_sets # replace what was there with these ordered sets
-
-  locus_total = 0
-  for qname in loci:
-    for chr in loci[qname]:
-      for strand in loci[qname][chr]:
-        for locus_set in loci[qname][chr][strand]:
-          locus_total+=1  
-
-  sys.stderr.write("Work on each read in each locus with "+str(cpu_count)+" CPUs\n")
-  p = multiprocessing.Pool(processes=cpu_count)
-  locus_count = 0
-  for qname in loci:
-    for chr in loci[qname]:
-      for strand in loci[qname][chr]:
-        #print qname + "\t" + chr + "\t" + strand
-        for locus_set in loci[qname][chr][strand]:
-          locus_count += 1
-          onum = len(locus_set)
-          # send blank reference splices unless we have some
-          rsplices = {}
-          if chr in reference_splices: rsplices = reference_splices[chr]
-          #p.apply_async(process_locus_set,(locus_set,args,rsplices,ref[chr],reads[qname],locus_total,locus_count),callback=do_locus_callback)
-          r1 = execute_locus(locus_set,args,rsplices,ref[chr],reads[qname],locus_total,locus_count)
-          do_locus_callback(r1)
-          #nnum = len(new_locus_set)
-          #print str(onum) + " to " + str(nnum)
-          #for e in new_locus_set:
-          #  print PSLBasics.entry_to_line(e)
-  p.close()
-  p.join() 
-  sys.stderr.write("\nfinished\n")
-
-  ofh = sys.stdout
-  if not args.output == '-':
-    ofh = open(args.output,'w')
-
-  for line in combo_results:
-    ofh.write(line)
-
-def execute_locus(locus_set,args,reference_splices,ref,read,locus_total,locus_count):
-  # for this locus we will have to check both directions
-  print "before: " + str(len(locus_set))
-  print [int(x['matches']) for x in locus_set]
-  print max([int(x['matches']) for x in locus_set])
+      last_end = e['tStarts'][len(e['tStarts'])-1]+e['blockSizes'][len(e['tStarts'])-1]
+      current_set.append(e)
+    if len(current_set) > 0:
+      output.append([current_set,key[0]])
+  return output
+
+# Stitch one locus, run on the pool
+# Pre: locus set, args, chromosome name, read sequence, locus number
+# Post: [stitched psl entries, locus number]
+#       Both orientations of reference splices are tried and the one
+#       that joins the most alignments is kept (positive on a tie)
+def execute_locus(locus_set,args,chr,read,locus_count):
   rsplices_plus = {}
   rsplices_minus = {}
-  if '+' in reference_splices: rsplices_plus = reference_splices['+']
-  if '-' in reference_splices: rsplices_minus = reference_splices['-']
-  [r1 ,lt1, lc1] = process_locus_set(locus_set,args,rsplices_plus,ref,read,locus_total,locus_count,'+')
-  [r2, rt2, rc2] = process_locus_set(locus_set,args,rsplices_minus, ref, read, locus_total, locus_count, '-')
-  print "after: " 
-  print "  positive"
-  print "  "+str([int(x['matches']) for x in r1])
-  print "  "+str([int(x['misMatches']) for x in r1])
-  print "  "+str([int(x['tBaseInsert']) for x in r1])
-  print "  "+str([int(x['qBaseInsert']) for x in r1])
-  print "  negative"
-  print "  "+str([int(x['matches']) for x in r2])
-  print "  "+str([int(x['misMatches']) for x in r2])
-  print "  "+str([int(x['tBaseInsert']) for x in r2])
-  print "  "+str([int(x['qBaseInsert']) for x in r2])
-
-  #print r1
-  #print r2
-def do_locus_callback(cbr):
+  if chr in _reference_splices:
+    if '+' in _reference_splices[chr]: rsplices_plus = _reference_splices[chr]['+']
+    if '-' in _reference_splices[chr]: rsplices_minus = _reference_splices[chr]['-']
+  ref = _ref[chr]
+  r1 = process_locus_set(locus_set,args,rsplices_plus,ref,read,'+')
+  r2 = process_locus_set(locus_set,args,rsplices_minus,ref,read,'-')
+  if len(r2) < len(r1): return [r2,locus_count]
+  return [r1,locus_count]
+
+def do_locus_callback(cbr,ofh):
   if not cbr: return
-  [r,tot,cnt] = cbr
-  global combo_results
+  [r,cnt] = cbr
   for e in r:
-    combo_results.append(PSLBasics.entry_to_line(e)+"\n")
-  sys.stderr.write(str(cnt)+"/"+str(tot)+"  \r")
+    ofh.write(PSLBasics.entry_to_line(e)+"\n")
+  sys.stderr.write(str(cnt)+"  \r")
   return
 
 # now that we have our best choice, lets put them together
@@ -343,15 +355,14 @@ def do_combine_operation(best_option,left,right,read,seq,args):
   return PSLBasics.line_to_entry(combo_line)
 
 # Here is the heart of the program
-def process_locus_set(locus_set,args,reference_splices,seq,read,locus_total,locus_count,orientation):
-  print orientation
+def process_locus_set(locus_set,args,reference_splices,seq,read,orientation):
   lcount = len(locus_set)
   #print len(reference_splices)
   #print '----'
   #print lcount
   score_set = []
   if lcount == 1: # only one entry so nothing to combine
-    return [locus_set, locus_total, locus_count]
+    return locus_set
   #for speed lets do greedy joining of alignments
   stayin = True
   while stayin == True:
@@ -383,7 +394,7 @@ def process_locus_set(locus_set,args,reference_splices,seq,read,locus_total,locu
         newset.append(locus_set[j])
       locus_set = newset
       break
-  return [locus_set, locus_total, locus_count]
+  return locus_set
   #print len(locus_set)
   #print '---'
 
@@ -482,15 +493,19 @@ def combine(left,right,args,reference_splices,seq,read,orientation):
   # we can come up with options based on a needleman wunsch across the entire thing
   wread = read
   if strand == '-': wread = rc(read)
+  # only the scores are needed to choose, so they are all done in one
+  # batch without tracebacks
+  options = reference_options + candidate_options
+  band = None
+  if args.band > 0: band = args.band
+  query = wread[left['qStarts'][left_choice]:right['qStarts'][right_choice]+right['blockSizes'][right_choice]].upper()
+  scores = needleman_wunsch_scores([[query, \
+                                     seq[left['tStarts'][left_choice]:option[0]].upper() + \
+                                     seq[option[1]-1:right['tStarts'][right_choice]+right['blockSizes'][right_choice]].upper()] \
+                                    for option in options],band=band)
   newoptions = []
-  for option in reference_options + candidate_options:
-    #leftlen = len(left['qStarts'])
-    #rightlen = len(right['qStarts'])
-    [a1,a2,score] = needleman_wunsch( \
-                    wread[left['qStarts'][left_choice]:right['qStarts'][right_choice]+right['blockSizes'][right_choice]].upper(), \
-                    seq[left['tStarts'][left_choice]:option[0]].upper() + \
-                    seq[option[1]-1:right['tStarts'][right_choice]+right['blockSizes'][right_choice]].upper())
-    newoptions.append([score,a1,a2]+[option])
+  for i in range(0,len(options)):
+    newoptions.append([scores[i],None,None]+[options[i]])
 
   #best_option = get_best_option(reference_options, candidate_options, args, strand)
   #if not best_option:
@@ -707,47 +722,5 @@ def check_for_uniquely_named_reads(args):
   return reads
 
 
-def needleman_wunsch(s1,s2):
-  F = []
-  d = -15
-  for i in range(0,len(s1)+1):
-    temp = []
-    F.append(temp)
-    for j in range(0,len(s2)+1):
-      F[i].append(0)
-  for i in range(0,len(s1)+1):
-    F[i][0] = d*i
-  for j in range(0,len(s2)+1):
-    F[0][j] = d*j
-  for i in range(1,len(F)):
-    for j in range(1,len(F[i])):
-      match = F[i-1][j-1]+Snw(s1[i-1],s2[j-1])
-      deletion = F[i-1][j]+d
-      insertion = F[i][j-1]+d
-      F[i][j] = max(match,deletion,insertion)
-  a1 = ''
-  a2 = ''
-  i = len(s1)
-  j = len(s2)
-  while i > 0 or j > 0:
-    if i > 0 and j > 0 and F[i][j] == F[i-1][j-1]+Snw(s1[i-1],s2[j-1]):
-      a1 = s1[i-1] + a1
-      a2 = s2[j-1] + a2
-      i -= 1
-      j -= 1
-    elif i > 0 and F[i][j] == F[i-1][j] + d:
-      a1 = s1[i-1] + a1
-      a2 = '-' + a2
-      i -= 1
-    else:
-      a1 = "-" + a1
-      a2 = s2[j-1]+a2
-      j -= 1
-  return [a1,a2,F[len(s1)][len(s2)]] 
-
-def Snw(c1,c2):
-  if c1 == c2: return 10
-  else: return -5
-
 if __name__=="__main__":
   main()